@@ -3,6 +3,7 @@ import imp
 import logging
 import multiprocessing
 import os
+import threading
 import time
 import traceback
 
@@ -21,9 +22,12 @@ def runplots(plotter, foremen):
 
 class Actions(object):
 
-    def __init__(self, config, source):
+    def __init__(self, config, source, lock=None):
         self.config = config
         self.source = source
+        # Guards access to the task source, which may be busy in a
+        # different thread.
+        self.lock = lock if lock else threading.RLock()
 
         if config.plotdir:
             logger.info('plots in {0} will be updated automatically'.format(config.plotdir))
@@ -51,21 +55,22 @@ class Actions(object):
                 logger.exception('failed to update configuration:')
                 util.PartiallyMutable.purge()
 
-            for method, args in util.PartiallyMutable.changes():
-                if method is None:
-                    continue
-                logger.debug("executing callback '{}' with arguments {}".format(method, args))
-                attrs = method.split('.')
-                call = self
-                if attrs[0] not in ['config', 'source']:
-                    logger.error('invalid registered callback: {}'.format(method))
-                    continue
-                try:
-                    for attr in attrs:
-                        call = getattr(call, attr)
-                    call(*args)
-                except Exception:
-                    logger.exception("caught exception while executing callback '{}' with arguments {}".format(method, args))
+            with self.lock:
+                for method, args in util.PartiallyMutable.changes():
+                    if method is None:
+                        continue
+                    logger.debug("executing callback '{}' with arguments {}".format(method, args))
+                    attrs = method.split('.')
+                    call = self
+                    if attrs[0] not in ['config', 'source']:
+                        logger.error('invalid registered callback: {}'.format(method))
+                        continue
+                    try:
+                        for attr in attrs:
+                            call = getattr(call, attr)
+                        call(*args)
+                    except Exception:
+                        logger.exception("caught exception while executing callback '{}' with arguments {}".format(method, args))
 
     def take(self, force=False):
         self.update_configuration()
@@ -85,5 +90,7 @@ class Actions(object):
                         self.p.join()
                     logger.info('starting plotting process')
                     self.p = multiprocessing.Process(target=runplots, args=(self.plotter, self.config.foremen_logs))
-                    self.p.start()
+                    # do not fork while other threads hold locks
+                    with self.lock:
+                        self.p.start()
                 self.__last = now
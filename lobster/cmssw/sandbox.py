@@ -1,11 +1,17 @@
+from multiprocessing.pool import ThreadPool
+import bz2
+import collections
 import fnmatch
 import glob
 import hashlib
+import json
 import logging
+import multiprocessing
 import re
 import os
 import shutil
 import tarfile
+import tempfile
 
 import lobster.core
 import lobster.util
@@ -16,6 +22,59 @@ logger = logging.getLogger('lobster.sandbox')
 cache = {}
 
 
+class ParallelCompressor(object):
+
+    """File-like object compressing data written to it in parallel.
+
+    The data is split into chunks, which are compressed independently by
+    a pool of threads, and written to `fileobj` in order.  The result is
+    a multi-stream `bzip2` file, as produced by `pbzip2`, which can be
+    read by `bzip2` and `tar`.
+
+    Parameters
+    ----------
+        fileobj : file
+            The file to write the compressed data to.
+        threads : int
+            The number of threads to use.
+        chunksize : int
+            The size of the chunks to compress independently.
+    """
+
+    def __init__(self, fileobj, threads, chunksize=4 * 1024 ** 2):
+        self.__fileobj = fileobj
+        self.__threads = threads
+        self.__chunksize = chunksize
+        self.__pool = ThreadPool(threads)
+        self.__pending = collections.deque()
+        self.__buffer = []
+        self.__size = 0
+
+    def __submit(self):
+        if self.__size == 0:
+            return
+        data = ''.join(self.__buffer)
+        self.__buffer = []
+        self.__size = 0
+        self.__pending.append(self.__pool.apply_async(bz2.compress, (data,)))
+        # limit the amount of data held in memory
+        while len(self.__pending) > 2 * self.__threads:
+            self.__fileobj.write(self.__pending.popleft().get())
+
+    def write(self, data):
+        self.__buffer.append(data)
+        self.__size += len(data)
+        if self.__size >= self.__chunksize:
+            self.__submit()
+
+    def close(self):
+        self.__submit()
+        while self.__pending:
+            self.__fileobj.write(self.__pending.popleft().get())
+        self.__pool.close()
+        self.__pool.join()
+
+
 class Sandbox(lobster.core.Sandbox):
 
     """
@@ -24,6 +83,12 @@ class Sandbox(lobster.core.Sandbox):
     By default, all necessary directories, plus any `python` or `data`
     directories to be found under `src` are included.
 
+    The sandbox is packed into two layers: the libraries and executables
+    of the release, and the user source.  Each layer is named after a
+    hash of its content, and only repacked when its content changes, so
+    that changes to the user source only require a new user layer.
+    Layers are compressed in parallel.
+
     Parameters
     ----------
         include : list
@@ -32,11 +97,21 @@ class Sandbox(lobster.core.Sandbox):
         release : str
             The path to the CMSSW release to be used as a sandbox.
             Defaults to the environment variable `LOCALRT`.
+        recycle : str or list
+            A path to an existing sandbox to re-use, or a list of the
+            paths of its layers.
+        cache : str
+            A directory to keep sandbox layers in, which may be shared
+            between projects.  Defaults to the working directory of the
+            project.
+        threads : int
+            The number of threads to use when compressing sandbox
+            layers.  Defaults to the number of cores.
     """
 
     _mutable = {}
 
-    def __init__(self, include=None, release=None, blacklist=None, recycle=None):
+    def __init__(self, include=None, release=None, blacklist=None, recycle=None, cache=None, threads=None):
         super(Sandbox, self).__init__(recycle, blacklist)
         if release:
             self.release = os.path.expandvars(os.path.expanduser(release))
@@ -46,13 +121,14 @@ class Sandbox(lobster.core.Sandbox):
             except KeyError:
                 raise AttributeError("Need to be either in a `cmsenv` or specify a sandbox release!")
         self.include = include or []
+        self.cache = os.path.expandvars(os.path.expanduser(cache)) if cache else None
+        self.threads = threads
 
-    def __release2filename(self, indir, rel, arch):
-        """Returns a filename for a given release top, i.e., the file system
-        path of a release.
+    def __layer2filename(self, rel, arch, layer, digest):
+        """Returns a filename for a layer of a sandbox with the content
+        hash `digest`.
         """
-        p = os.path.abspath(os.path.expandvars(os.path.expanduser(indir)))
-        return "sandbox-{r}-{v}-{d}.tar.bz2".format(r=rel, v=arch, d=hashlib.sha1(p).hexdigest()[:7])
+        return "sandbox-{r}-{v}-{layer}-{d}.tar.bz2".format(r=rel, v=arch, layer=layer, d=digest[:10])
 
     def __dontpack(self, fn):
         res = ('/.' in fn and '/.SCRAM' not in fn) or '/CVS/' in fn
@@ -61,13 +137,21 @@ class Sandbox(lobster.core.Sandbox):
         return False
 
     def _recycle(self, outdir):
-        release_and_arch = re.compile(r'sandbox-(.*)-(slc.*)-[A-Fa-f0-9]*.tar.bz2$')
-        shutil.copy2(self.recycle, outdir)
-        m = release_and_arch.search(self.recycle)
+        release_and_arch = re.compile(r'sandbox-(.*)-(slc[^-]*)(?:-release|-user)?-[A-Fa-f0-9]*.tar.bz2$')
+        if isinstance(self.recycle, basestring):
+            boxes = [self.recycle]
+        else:
+            boxes = self.recycle
+        for box in boxes:
+            shutil.copy2(box, outdir)
+        m = release_and_arch.search(boxes[0])
         if not m:
             raise AttributeError("Can't determine CMSSW release and arch from recycled sandbox!")
         rtname, rtarch = m.groups()
-        return rtname, rtarch, os.path.join(outdir, os.path.split(self.recycle)[-1])
+        layers = [os.path.join(outdir, os.path.split(box)[-1]) for box in boxes]
+        if isinstance(self.recycle, basestring):
+            return rtname, rtarch, layers[0]
+        return rtname, rtarch, layers
 
     def _get_cmssw_arch(self, dirname):
         candidates = glob.glob('{}/.SCRAM/slc*'.format(dirname))
@@ -84,52 +168,169 @@ class Sandbox(lobster.core.Sandbox):
             else:
                 raise AttributeError("Can't determine CMSSW project version")
 
-    def _package(self, basedirs, outdir):
-        indir = lobster.util.findpath(basedirs, self.release)
+    def _ignore(self, fn):
+        for test in self.blacklist:
+            if fnmatch.fnmatch(os.path.split(fn)[1], test):
+                return True
+        return False
 
-        rtarch = self._get_cmssw_arch(indir)
-        rtname = self._get_cmssw_version(indir)
+    def _contents(self, indir, subdirs):
+        """Yields everything to be packed from `subdirs`.
 
-        outfile = os.path.join(outdir, self.__release2filename(indir, rtname, rtarch))
+        Returns tuples of the path, the name in the sandbox, and the names
+        `blacklist` patterns are matched against to decide if the path
+        is packed.
+        """
+        for subdir, sandboxname in subdirs:
+            inname = os.path.join(indir, subdir)
+            if not os.path.exists(inname) or self._ignore(inname):
+                continue
+            root = (os.path.basename(os.path.normpath(inname)),)
+            yield inname, sandboxname, root
+            for (path, dirs, files) in os.walk(inname):
+                dirs[:] = sorted(d for d in dirs if not self._ignore(os.path.join(path, d)))
+                for fn in sorted(dirs + files):
+                    fullname = os.path.join(path, fn)
+                    if fn in files and self._ignore(fullname):
+                        continue
+                    relname = os.path.relpath(fullname, inname)
+                    yield fullname, os.path.join(sandboxname, relname), root + tuple(relname.split(os.sep))
 
-        if os.path.exists(outfile):
-            logger.info("reusing sandbox in {0}".format(outfile))
-            return rtname, rtarch, outfile
+    def _hash(self, indir, subdirs, index):
+        """Calculate a hash of the content of `subdirs`.
 
-        def ignore_file(fn):
-            for test in self.blacklist:
-                if fnmatch.fnmatch(os.path.split(fn)[1], test):
-                    return True
-            return False
+        The hashes of file contents are memoized in `index`, keyed by
+        path, size and modification time, so that only changed files are
+        read again.
+        """
+        digest = hashlib.sha1()
 
-        logger.info("packing sandbox into {0}".format(outfile))
-        logger.debug("using release name {1} with base directory {0}".format(indir, rtname))
-        tarball = tarfile.open(outfile, "w|bz2")
+        for path, arcname, _ in self._contents(indir, subdirs):
+            digest.update(arcname + '\0')
+            if os.path.islink(path):
+                digest.update('link:' + os.readlink(path) + '\0')
+            elif os.path.isfile(path):
+                stat = os.stat(path)
+                key = [stat.st_size, stat.st_mtime]
+                known = index.get(path)
+                if not known or known[:2] != key:
+                    filehash = hashlib.sha1()
+                    with open(path, 'rb') as f:
+                        for block in iter(lambda: f.read(1024 ** 2), ''):
+                            filehash.update(block)
+                    known = key + [filehash.hexdigest()]
+                    index[path] = known
+                digest.update('{0:o}:{1}\0'.format(stat.st_mode, known[2]))
 
+        return digest.hexdigest()
+
+    def _pack(self, indir, rtname, subdirs, outfile):
+        """Pack `subdirs` into `outfile`, compressing in parallel.
+
+        The layer is written to a unique temporary file first, as several
+        projects may pack the same layer into a shared cache.
+        """
+        threads = self.threads or multiprocessing.cpu_count()
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(outfile), prefix='.sandbox-')
+        os.chmod(tmpfile, 0644)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                compressor = ParallelCompressor(f, threads)
+                tarball = tarfile.open(fileobj=compressor, mode="w|")
+
+                for subdir, sandboxname in subdirs:
+                    inname = os.path.join(indir, subdir)
+                    if not os.path.exists(inname):
+                        continue
+
+                    outname = os.path.join(rtname, sandboxname)
+                    logger.debug("packing {0}".format(subdir))
+
+                    tarball.add(inname, outname, exclude=self._ignore)
+
+                tarball.close()
+                compressor.close()
+            os.rename(tmpfile, outfile)
+        except Exception:
+            os.unlink(tmpfile)
+            raise
+
+    def _layers(self, indir):
+        """Returns the layers of the sandbox, with the subdirectories of
+        `indir` to pack into each as tuples of path and name in the
+        sandbox.
+        """
         # package bin, etc
-        subdirs = ['bin', 'cfipython', 'external', 'lib', 'python']
-        subdirs += [os.path.join('src', incl) for incl in self.include]
+        release = ['bin', 'cfipython', 'external', 'lib', 'python']
+        user = [os.path.join('src', incl) for incl in self.include]
 
         for (path, dirs, files) in os.walk(os.path.join(indir, 'src')):
             for subdir in ['data', 'python', 'interface']:
                 if subdir in dirs:
                     rtpath = os.path.join(os.path.relpath(path, indir), subdir)
-                    subdirs.append(rtpath)
+                    user.append(rtpath)
 
-        for subdir in subdirs:
-            if isinstance(subdir, tuple) or isinstance(subdir, list):
-                (subdir, sandboxname) = subdir
-            else:
-                sandboxname = subdir
-            inname = os.path.join(indir, subdir)
-            if not os.path.exists(inname):
-                continue
+        def normalize(subdirs):
+            for subdir in subdirs:
+                if isinstance(subdir, tuple) or isinstance(subdir, list):
+                    yield tuple(subdir)
+                else:
+                    yield (subdir, subdir)
+
+        return [('release', list(normalize(release))), ('user', list(normalize(user)))]
+
+    def contents(self, basedirs):
+        """Yields everything that would be packed into the sandbox.
+
+        Returns tuples of the layer, the path, the name in the sandbox,
+        and the names matched against `blacklist` patterns.
+        """
+        indir = lobster.util.findpath(basedirs, self.release)
+        for layer, subdirs in self._layers(indir):
+            for path, arcname, names in self._contents(indir, subdirs):
+                yield layer, path, arcname, names
+
+    def _package(self, basedirs, outdir):
+        indir = lobster.util.findpath(basedirs, self.release)
+
+        rtarch = self._get_cmssw_arch(indir)
+        rtname = self._get_cmssw_version(indir)
 
-            outname = os.path.join(rtname, sandboxname)
-            logger.debug("packing {0}".format(subdir))
+        cachedir = self.cache or outdir
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+
+        indexfile = os.path.join(cachedir, 'sandbox-index.json')
+        try:
+            with open(indexfile) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+
+        logger.debug("using release name {1} with base directory {0}".format(indir, rtname))
+
+        layers = []
+        for layer, subdirs in self._layers(indir):
+            digest = self._hash(indir, subdirs, index)
+            cached = os.path.join(cachedir, self.__layer2filename(rtname, rtarch, layer, digest))
+
+            if os.path.exists(cached):
+                logger.info("reusing sandbox layer in {0}".format(cached))
+            else:
+                logger.info("packing sandbox layer into {0}".format(cached))
+                self._pack(indir, rtname, subdirs, cached)
 
-            tarball.add(inname, outname, exclude=ignore_file)
+            outfile = os.path.join(outdir, os.path.basename(cached))
+            if cached != outfile and not os.path.exists(outfile):
+                try:
+                    os.link(cached, outfile)
+                except OSError:
+                    shutil.copy2(cached, outfile)
+            layers.append(outfile)
 
-        tarball.close()
+        fd, tmpfile = tempfile.mkstemp(dir=cachedir, prefix='.sandbox-index-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmpfile, indexfile)
 
-        return rtname, rtarch, outfile
+        return rtname, rtarch, layers
@@ -0,0 +1,422 @@
+from collections import defaultdict
+from contextlib import contextmanager
+import imp
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from lobster import fs, se, util
+from lobster.core.command import Command
+
+logger = logging.getLogger('lobster.bench')
+
+OPERATIONS = ['mkdir', 'stage-out', 'exists', 'ls', 'stage-in', 'remove']
+
+standin = """#!{python}
+import os
+import re
+import shutil
+import sys
+
+
+def local(url):
+    return re.sub(r'^[a-z]+://[^/]*', '', url).rstrip('/') or '/'
+
+
+name = os.path.basename(sys.argv[0])
+args = [a for a in sys.argv[1:] if not a.startswith('-')]
+try:
+    if name == 'xrdfs':
+        cmd, path = args[1], args[2].rstrip('/') or '/'
+        if cmd == 'stat':
+            isdir = os.path.isdir(path)
+            sys.stdout.write('Path:   {{0}}\\n'.format(path))
+            sys.stdout.write('Size:   {{0}}\\n'.format(os.stat(path).st_size))
+            sys.stdout.write('Flags:  {{0}} ({{1}})\\n'.format(
+                51 if isdir else 16, 'IsDir|IsReadable' if isdir else 'IsReadable'))
+        elif cmd == 'ls':
+            for entry in sorted(os.listdir(path)):
+                sys.stdout.write(os.path.join(path, entry) + '\\n')
+        elif cmd == 'mkdir':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        elif cmd == 'rm':
+            os.unlink(path)
+        elif cmd == 'rmdir':
+            os.rmdir(path)
+    elif name in ('xrdcp', 'gfal-copy'):
+        shutil.copyfile(local(args[0]), local(args[1]))
+    elif name == 'gfal-stat':
+        info = os.stat(local(args[0]))
+        isdir = os.path.isdir(local(args[0]))
+        sys.stdout.write('  File: {{0!r}}\\n'.format(args[0]))
+        sys.stdout.write('  Size: {{0}}\\t{{1}}\\n'.format(info.st_size, 'directory' if isdir else 'regular file'))
+        sys.stdout.write('Access: ({{0:04o}}/{{1}})\\n'.format(info.st_mode & 0o777, 'd' if isdir else '-'))
+    elif name == 'gfal-ls':
+        for entry in sorted(os.listdir(local(args[0]))):
+            sys.stdout.write(entry + '\\n')
+    elif name == 'gfal-mkdir':
+        if not os.path.isdir(local(args[0])):
+            os.makedirs(local(args[0]))
+    elif name == 'gfal-rm':
+        for path in map(local, args):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+except (IOError, OSError) as e:
+    sys.stderr.write('{{0}}\\n'.format(e))
+    sys.exit(54 if name == 'xrdfs' else 1)
+"""
+
+
+def parse_size(size):
+    """Convert a size with an optional suffix of `k`, `M`, or `G` to
+    bytes.
+
+    >>> parse_size('10k')
+    10240
+    """
+    units = {'k': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def load_task():
+    """Load the script run by tasks on the workers, to use its transfer
+    functions.
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'core', 'data', 'task.py')
+    return imp.load_source('lobster_task', path)
+
+
+class StandIns(object):
+
+    """Local stand-ins for storage servers, to benchmark without network
+    access.
+
+    Provides a `file` directory, mock `xrdfs`, `xrdcp`, and `gfal-*`
+    executables operating on local directories for `root` and `srm`
+    access, and launches a Chirp server if `chirp_server` is available.
+    Used as a context manager, the mock executables are used by the
+    storage elements on the master, and `env` holds the environment for
+    transfers to use them.
+    """
+
+    tools = ['xrdfs', 'xrdcp', 'gfal-copy', 'gfal-stat', 'gfal-ls', 'gfal-mkdir', 'gfal-rm']
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp(prefix='lobster_bench_')
+        self.bindir = os.path.join(self.root, 'bin')
+        os.makedirs(self.bindir)
+
+        script = os.path.join(self.bindir, 'standin')
+        with open(script, 'w') as f:
+            f.write(standin.format(python=sys.executable))
+        os.chmod(script, 0755)
+        for tool in self.tools:
+            os.symlink(script, os.path.join(self.bindir, tool))
+
+        self.urls = []
+        for protocol, url in [('file', 'file://{0}/file'),
+                              ('root', 'root://localhost/{0}/root'),
+                              ('srm', 'srm://localhost{0}/srm')]:
+            os.makedirs(os.path.join(self.root, protocol))
+            self.urls.append(url.format(self.root))
+
+        self.chirp = None
+        self.port = None
+        try:
+            self.__start_chirp(util.which('chirp_server'))
+        except KeyError:
+            logger.warning("'chirp_server' not found, skipping benchmarks of chirp access")
+
+        self.__saved = None
+
+    def __start_chirp(self, executable):
+        # tasks authenticate with globus, which is not available locally
+        for tool in ['chirp', 'chirp_get', 'chirp_put']:
+            with open(os.path.join(self.bindir, tool), 'w') as f:
+                f.write('#!/bin/sh\nexec "{0}" -a unix "$@"\n'.format(util.which(tool)))
+            os.chmod(os.path.join(self.bindir, tool), 0755)
+
+        os.makedirs(os.path.join(self.root, 'chirp'))
+        acl = os.path.join(self.root, 'acl')
+        with open(acl, 'w') as f:
+            f.write('unix:{0} rlwda\n'.format(os.environ.get('USER', 'nobody')))
+        self.port = random.randrange(9100, 10000)
+        args = [executable, '-p', str(self.port), '--root=' + self.root, '-a', 'unix', '-A', acl]
+        with open(os.devnull, 'w') as devnull:
+            self.chirp = subprocess.Popen(args, stdout=devnull, stderr=subprocess.STDOUT)
+        for i in range(50):
+            try:
+                socket.create_connection(('localhost', self.port), 1).close()
+                break
+            except socket.error:
+                time.sleep(0.2)
+        else:
+            self.chirp.terminate()
+            self.chirp = None
+            logger.warning("chirp server did not start, skipping benchmarks of chirp access")
+            return
+        self.urls.append('chirp://localhost:{0}/chirp'.format(self.port))
+
+    @property
+    def env(self):
+        return {
+            'PATH': self.bindir + os.pathsep + os.environ.get('PATH', ''),
+            'PARROT_PATH': self.bindir,
+            'LOBSTER_LCG_CP': '',
+            'LOBSTER_GFAL_COPY': os.path.join(self.bindir, 'gfal-copy')
+        }
+
+    def __enter__(self):
+        self.__saved = (se.XrootD.xrdfs, se.SRM.gfal, se.XrootD._sessions.get('localhost'))
+        se.XrootD.xrdfs = os.path.join(self.bindir, 'xrdfs')
+        se.XrootD._sessions['localhost'] = se.XrdfsSession('localhost', se.XrootD.xrdfs)
+        se.SRM.gfal = os.path.join(self.bindir, 'gfal-')
+        return self
+
+    def __exit__(self, *args):
+        se.XrootD.xrdfs, se.SRM.gfal, session = self.__saved
+        se.XrootD._sessions.pop('localhost', None)
+        if session:
+            se.XrootD._sessions['localhost'] = session
+        if self.chirp:
+            self.chirp.terminate()
+            self.chirp.wait()
+        shutil.rmtree(self.root)
+
+
+class Transfers(object):
+
+    """Stage files in and out with the functions tasks use.
+
+    Calls ``stage_in`` and ``stage_out`` of the task script in
+    `lobster/core/data/task.py`, in an environment set up like the task
+    wrapper does.  Input files are copied rather than streamed.  Tasks
+    do not stage out via `root`.
+
+    Parameters
+    ----------
+        env : dict
+            Environment variables to set while transferring.
+    """
+
+    def __init__(self, env=None):
+        self.task = load_task()
+        self.task.logger.setLevel(logging.DEBUG if logger.isEnabledFor(logging.DEBUG) else logging.WARNING)
+
+        self.env = {'LD_LIBRARY_PATH': os.environ.get('LD_LIBRARY_PATH', '')}
+        for variable, tool in [('LOBSTER_LCG_CP', 'lcg-cp'), ('LOBSTER_GFAL_COPY', 'gfal-copy')]:
+            try:
+                self.env[variable] = util.which(tool)
+            except KeyError:
+                self.env[variable] = ''
+        self.env.update(env or {})
+
+    @contextmanager
+    def environment(self, directory=None):
+        """Set up the environment of the transfers, optionally running
+        them in `directory`.
+        """
+        saved = dict(os.environ)
+        cwd = os.getcwd()
+        os.environ.update(self.env)
+        if directory:
+            os.chdir(directory)
+        try:
+            yield dict(os.environ)
+        finally:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(saved)
+
+    def supports(self, url, direction):
+        protocol = url.split(':', 1)[0]
+        return protocol in ('file', 'srm', 'gsiftp', 'chirp') or (protocol == 'root' and direction == 'in')
+
+    def stage_out(self, url, localname, remotename):
+        config = {'output': [url], 'default se': 'localhost'}
+        with self.environment() as env:
+            target, _, _ = self.task.stage_out(config, env, localname, remotename)
+        return target is not None
+
+    def upload(self, url, localname, remotename):
+        """Copy a file to `url` via `xrdcp`, for storage tasks can only
+        stage in from.
+        """
+        with self.environment() as env:
+            with open(os.devnull, 'w') as devnull:
+                args = ['xrdcp', localname, os.path.join(url, remotename)]
+                return subprocess.call(args, env=env, stdout=devnull, stderr=subprocess.STDOUT) == 0
+
+    def stage_in(self, url, remotename, directory):
+        """Stage in `remotename` from `url` to `directory`.
+        """
+        config = {'disable streaming': True}
+        with self.environment(directory) as env:
+            filename, _, _ = self.task.stage_in(config, env, remotename, [url])
+        return filename is not None
+
+
+class Results(object):
+
+    """Latencies, items processed, and bytes transferred per operation.
+    """
+
+    def __init__(self):
+        self.calls = defaultdict(list)
+
+    def run(self, operation, method, *args, **kwargs):
+        """Time `method` called with `args`, accounting it for `operation`.
+
+        The number of files handled and bytes transferred by the call can
+        be passed as `items` and `size`.  Returns `False` if the call
+        failed.
+        """
+        items = kwargs.get('items', 1)
+        size = kwargs.get('size', 0)
+        start = time.time()
+        try:
+            ok = method(*args) is not False
+        except Exception as e:
+            logger.debug("{0} failed: {1}".format(operation, e))
+            ok = False
+        self.calls[operation].append((time.time() - start, items, size if ok else 0, ok))
+        return ok
+
+    def summary(self):
+        """Returns a dictionary of the number of calls, failures, mean and
+        maximum latency in seconds, and the throughput in files and bytes
+        per second for every operation.
+        """
+        res = {}
+        for operation, calls in self.calls.items():
+            total = sum(t for t, _, _, _ in calls)
+            res[operation] = {
+                'calls': len(calls),
+                'failures': len([ok for _, _, _, ok in calls if not ok]),
+                'latency': total / len(calls),
+                'max latency': max(t for t, _, _, _ in calls),
+                'files per second': sum(n for _, n, _, ok in calls if ok) / total if total > 0 else 0.,
+                'bytes per second': sum(s for _, _, s, _ in calls) / total if total > 0 else 0.
+            }
+        return res
+
+
+class Bench(Command):
+
+    @property
+    def help(self):
+        return 'benchmark the storage access of a configuration'
+
+    def setup(self, argparser):
+        subparsers = argparser.add_subparsers(title='actions', dest='action')
+
+        storage = subparsers.add_parser('storage', help='measure the latency and throughput of storage operations')
+        storage.add_argument('--url', action='append', default=None, dest='urls',
+                             help='storage URL to benchmark, may be repeated (default: the output storage '
+                             'of the configuration)')
+        storage.add_argument('--local', action='store_true', default=False,
+                             help='benchmark local stand-ins for file, root, srm, and chirp access instead')
+        storage.add_argument('--files', default='10,100',
+                             help='comma separated numbers of files to use (default: 10,100)')
+        storage.add_argument('--sizes', default='1k,1M',
+                             help='comma separated file sizes to use, with optional k, M, or G suffix '
+                             '(default: 1k,1M)')
+        storage.add_argument('--json', default=None, metavar='FILE',
+                             help='save the results to FILE')
+
+    def benchmark(self, url, count, size, transfers):
+        """Run the storage operations for `count` files of `size` bytes
+        against `url`, returning the `Results`.
+        """
+        results = Results()
+        scratch = tempfile.mkdtemp()
+        try:
+            se.StorageConfiguration(output=[url]).activate()
+
+            directory = 'lobster_bench_{0:08x}'.format(random.getrandbits(32))
+            block = os.urandom(min(size, 1 << 20))
+            names = ['{0}.dat'.format(i) for i in range(count)]
+            for name in names:
+                with open(os.path.join(scratch, name), 'wb') as f:
+                    for offset in range(0, size, len(block) or 1):
+                        f.write(block[:size - offset])
+
+            results.run('mkdir', fs.makedirs, directory)
+            if transfers.supports(url, 'out'):
+                for name in names:
+                    results.run('stage-out', transfers.stage_out, url,
+                                os.path.join(scratch, name), os.path.join(directory, name), size=size)
+            else:
+                logger.info("tasks can't stage out via {0}, uploading files without timing".format(url))
+                for name in names:
+                    transfers.upload(url, os.path.join(scratch, name), os.path.join(directory, name))
+            for name in names:
+                results.run('exists', fs.exists, os.path.join(directory, name))
+            results.run('ls', lambda: list(fs.ls(directory)), items=count)
+            if transfers.supports(url, 'in'):
+                incoming = os.path.join(scratch, 'in')
+                os.makedirs(incoming)
+                for name in names:
+                    results.run('stage-in', transfers.stage_in, url, os.path.join(directory, name), incoming, size=size)
+                    if os.path.exists(os.path.join(incoming, name)):
+                        os.unlink(os.path.join(incoming, name))
+            results.run('remove', fs.remove, *[os.path.join(directory, name) for name in names], items=count)
+
+            try:
+                fs.remove(directory)
+            except Exception as e:
+                logger.warning("failed to remove benchmark directory {0}: {1}".format(directory, e))
+        finally:
+            se.FileSystem.configure([], [])
+            shutil.rmtree(scratch)
+        return results
+
+    def report(self, url, count, size, summary):
+        logger.info("{0}: {1} files of {2} bytes".format(url, count, size))
+        logger.info('{0:<10} {1:>8} {2:>9} {3:>14} {4:>14} {5:>12} {6:>12}'.format(
+            'operation', 'calls', 'failures', 'latency [ms]', 'max [ms]', 'files/s', 'MB/s'))
+        logger.info('-' * 85)
+        for operation in OPERATIONS:
+            if operation not in summary:
+                continue
+            stats = summary[operation]
+            logger.info('{0:<10} {1:>8} {2:>9} {3:>14.1f} {4:>14.1f} {5:>12.1f} {6:>12}'.format(
+                operation, stats['calls'], stats['failures'], stats['latency'] * 1000, stats['max latency'] * 1000,
+                stats['files per second'],
+                '{0:.2f}'.format(stats['bytes per second'] / 1024. ** 2) if stats['bytes per second'] > 0 else '-'))
+
+    def storage(self, urls, args, transfers):
+        counts = [int(n) for n in args.files.split(',')]
+        sizes = [parse_size(s) for s in args.sizes.split(',')]
+
+        res = []
+        for url in urls:
+            for count in counts:
+                for size in sizes:
+                    summary = self.benchmark(url, count, size, transfers).summary()
+                    self.report(url, count, size, summary)
+                    res.append({'url': url, 'files': count, 'size': size, 'operations': summary})
+        return res
+
+    def run(self, args):
+        if args.local:
+            with StandIns() as standins:
+                res = self.storage(standins.urls, args, Transfers(standins.env))
+        else:
+            res = self.storage(args.urls or args.config.storage.output, args, Transfers())
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(res, f, indent=2)
@@ -804,7 +804,11 @@ class Plotter(object):
             'time_send', 'time_receive', 'time_status_msgs',
             'time_internal', 'time_polling', 'time_application'
         ]
-        lobster_labels = ['status', 'create', 'action', 'update', 'fetch', 'return']
+        # stages of the main loop; task creation and return run in a
+        # helper thread and overlap with these, `sync` is the time the main
+        # loop is blocked waiting for the helper thread
+        lobster_labels = ['status', 'submit', 'action', 'update', 'fetch', 'sync']
+        source_labels = ['create', 'return']
         return_labels = ['dash', 'handler', 'updates', 'elk', 'transfers', 'cleanup', 'propagate', 'sqlite']
 
         times = stats[:, headers['timestamp']]
@@ -814,15 +818,18 @@ class Plotter(object):
 
         def diff(label):
             label = 'total_{}_time'.format(label) if 'time' not in label else label
+            if label not in headers:
+                # logs written by older versions
+                return np.zeros(len(times) - 1)
             quant = stats[:, headers[label]]
             return (quant - np.roll(quant, 1, 0))[1:]
 
         wq_stats = dict((label, diff(label)) for label in wq_labels)
-        lobster_stats = dict((label, diff(label)) for label in lobster_labels)
+        lobster_stats = dict((label, diff(label)) for label in lobster_labels + source_labels)
         return_stats = dict((label, diff('source_' + label)) for label in return_labels)
 
         time_diff = ((times - np.roll(times, 1, 0)) * 1e6)[1:]
-        everything = np.sum(lobster_stats.values(), axis=0)
+        everything = np.sum([lobster_stats[label] for label in lobster_labels], axis=0)
         other = time_diff - everything
 
         self.plot(
@@ -837,6 +844,20 @@ class Plotter(object):
             ymax=1.
         )
 
+        idle = np.maximum(time_diff - np.sum([lobster_stats[label] for label in source_labels], axis=0), 0)
+
+        self.plot(
+            [
+                (centers, np.divide(lobster_stats[label], time_diff)) for label in source_labels
+            ] + [
+                (centers, np.divide(idle, time_diff))
+            ],
+            'Source fraction', os.path.join(category, 'source-fraction'),
+            modes=[Plotter.STACK | Plotter.TIME],
+            labels=source_labels + ['idle'],
+            ymax=1.
+        )
+
         # This is the odd one out, since WQ only provides us with an idle
         # fraction
         idle_total = np.multiply(
@@ -8,12 +8,17 @@ import psutil
 import resource
 import signal
 import sys
+import threading
 import time
 import traceback
 
-from lobster import actions, util
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from lobster import actions, fs, util
 from lobster.commands.status import Status
 from lobster.core.command import Command
+from lobster.core.fetch import FetchController
 from lobster.core.source import TaskProvider
 
 import work_queue as wq
@@ -46,7 +51,7 @@ class Terminate(Command):
 class Process(Command, util.Timing):
 
     def __init__(self):
-        util.Timing.__init__(self, 'action', 'create', 'fetch', 'return', 'status', 'update')
+        util.Timing.__init__(self, 'action', 'create', 'fetch', 'return', 'status', 'submit', 'sync', 'update')
 
     @property
     def help(self):
@@ -72,6 +77,8 @@ class Process(Command, util.Timing):
             statsfile.write(
                 " ".join(
                     ["#timestamp", "units_left"] +
+                    sorted(self.fetcher.attributes.keys()) +
+                    ["allocated_cores_{}".format(k) for k in sorted(self.source.allocations.keys())] +
                     ["total_{}_time".format(k) for k in sorted(self.times.keys())] +
                     ["total_source_{}_time".format(k) for k in sorted(self.source.times.keys())] +
                     self.log_attributes
@@ -89,6 +96,8 @@ class Process(Command, util.Timing):
             now = datetime.datetime.now()
             statsfile.write(" ".join(map(str,
                                          [int(int(now.strftime('%s')) * 1e6 + now.microsecond), left] +
+                                         [v for (k, v) in sorted(self.fetcher.attributes.items())] +
+                                         [v for (k, v) in sorted(self.source.allocations.items())] +
                                          [self.times[k] for k in sorted(self.times.keys())] +
                                          [self.source.times[k] for k in sorted(self.source.times.keys())] +
                                          [getattr(stats, a) for a in self.log_attributes]
@@ -179,10 +188,121 @@ class Process(Command, util.Timing):
             except Exception:
                 pass
 
+    @contextmanager
+    def synchronized(self):
+        """Obtain exclusive access to the task source.
+
+        Time spent waiting for the helper thread to finish is accounted
+        for as `sync`.
+        """
+        with self.measure('sync'):
+            self.__lock.acquire()
+        try:
+            yield
+        finally:
+            self.__lock.release()
+
+    def __refresh(self):
+        # Needs to be called with the lock held.  The main thread only
+        # looks at this snapshot, to avoid waiting for the database.
+        self.__state = (self.source.done(), self.source.tasks_left(), self.source.work_left())
+
+    def __create(self, total, have):
+        with self.__lock:
+            with self.measure('create'):
+                tasks = self.source.obtain(total, have)
+                self.__refresh()
+        return tasks
+
+    def __release(self, tasks):
+        with self.__lock:
+            try:
+                start = time.time()
+                with self.measure('return'):
+                    cancel = self.source.release(tasks)
+                    self.__refresh()
+                return len(tasks), time.time() - start, cancel
+            except Exception:
+                tb = traceback.format_exc()
+                logger.critical("cannot recover from the following exception:\n" + tb)
+                util.sendemail("Your Lobster project has crashed from the following exception:\n" + tb, self.config)
+                for task in tasks:
+                    logger.critical(
+                        "tried to return task {0} from {1}".format(task.tag, task.hostname))
+                raise
+
+    def __released(self, releasing):
+        """Collect the result of releasing tasks, and cancel tasks that
+        have been superseded by a duplicate.  Cancelled tasks are handed
+        back to the source with the next batch of returned tasks.
+        """
+        count, duration, cancel = releasing.get()
+        self.fetcher.released(count, duration)
+        for id in cancel:
+            task = self.queue.cancel_by_tasktag(id)
+            if task:
+                logger.info("cancelled task {0}, superseded by a duplicate".format(id))
+                self.__cancelled.append(task)
+
+    def __drain(self, pool, creating, releasing):
+        """Wait for outstanding work of the helper thread to finish, and
+        hand tasks cancelled in the meantime back to the source.
+        """
+        pool.close()
+        with self.measure('sync'):
+            pool.join()
+        if releasing is not None:
+            self.__released(releasing)
+        if len(self.__cancelled) > 0:
+            tasks = self.__cancelled
+            self.__cancelled = []
+            self.__release(tasks)
+        if creating is not None:
+            tasks = creating.get()
+            if len(tasks) > 0:
+                logger.info("not submitting {0} tasks created during shutdown".format(len(tasks)))
+
+    def submit(self, tasks, expiry=None):
+        wq_max_retries = self.config.advanced.wq_max_retries
+
+        submitted = []
+        for category, cmd, id, inputs, outputs, env, dir in tasks:
+            task = wq.Task(cmd)
+            task.specify_category(category)
+            task.specify_tag(id)
+            task.specify_max_retries(wq_max_retries)
+            task.specify_monitor_output(os.path.join(dir, 'resource_monitor'))
+
+            for k, v in env.items():
+                task.specify_environment_variable(k, v)
+
+            for (local, remote, cache) in inputs:
+                cache_opt = wq.WORK_QUEUE_CACHE if cache else wq.WORK_QUEUE_NOCACHE
+                if os.path.isfile(local) or os.path.isdir(local):
+                    task.specify_input_file(str(local), str(remote), cache_opt)
+                else:
+                    logger.critical("cannot send file to worker: {0}".format(local))
+                    raise NotImplementedError
+
+            for (local, remote) in outputs:
+                task.specify_output_file(str(local), str(remote))
+
+            if expiry:
+                task.specify_end_time(expiry * 10 ** 6)
+            self.queue.submit(task)
+            submitted.append(task)
+        self.source.submitted(submitted)
+
     def sprint(self):
+        # All interaction with the task source (and hence the database) is
+        # serialized by this lock.  Task creation and the release of
+        # returned tasks are handed to a helper thread, so that the main
+        # thread can keep talking to WQ in the meantime.
+        self.__lock = threading.RLock()
+
         with util.PartiallyMutable.unlock():
             self.source = TaskProvider(self.config)
-        action = actions.Actions(self.config, self.source)
+        action = actions.Actions(self.config, self.source, self.__lock)
 
         logger.info("using wq from {0}".format(wq.__file__))
         logger.info("running Lobster version {0}".format(util.get_version()))
@@ -200,7 +320,11 @@ class Process(Command, util.Timing):
         self.queue.specify_keepalive_timeout(300)
         # self.queue.tune("short-timeout", 600)
         self.queue.tune("transfer-outlier-factor", 4)
-        self.queue.specify_algorithm(wq.WORK_QUEUE_SCHEDULE_RAND)
+        if getattr(self.config.storage, 'locality', False):
+            # prefer workers that have the input files of a task cached
+            self.queue.specify_algorithm(wq.WORK_QUEUE_SCHEDULE_FILES)
+        else:
+            self.queue.specify_algorithm(wq.WORK_QUEUE_SCHEDULE_RAND)
         if self.config.advanced.full_monitoring:
             self.queue.enable_monitoring_full(None)
         else:
@@ -212,15 +336,13 @@ class Process(Command, util.Timing):
         abort_threshold = self.config.advanced.abort_threshold
         abort_multiplier = self.config.advanced.abort_multiplier
 
-        wq_max_retries = self.config.advanced.wq_max_retries
-
         if util.checkpoint(self.config.workdir, 'KILLED') == 'PENDING':
             util.register_checkpoint(self.config.workdir, 'KILLED', 'RESTART')
 
-        # time in seconds to wait for WQ to return tasks, with minimum wait
-        # time in case no more tasks are waiting
-        interval = 120
-        interval_minimum = 30
+        # determines the time to wait for WQ to return tasks, with minimum
+        # wait time in case no more tasks are waiting, and how many tasks
+        # to return to the source at once
+        self.fetcher = FetchController()
 
         tasks_left = 0
         units_left = 0
@@ -246,11 +368,22 @@ class Process(Command, util.Timing):
             if 'wall_time' not in constraints:
                 self.queue.activate_fast_abort_category(category.name, abort_multiplier)
 
+        with self.synchronized():
+            self.__refresh()
+
+        pool = ThreadPool(1)
+        creating = None
+        releasing = None
+        self.__cancelled = []
+
         proxy_email_sent = False
-        while not self.source.done():
+        while not self.__state[0]:
             with self.measure('status'):
-                tasks_left = self.source.tasks_left()
-                units_left = self.source.work_left()
+                if releasing is not None and releasing.ready():
+                    self.__released(releasing)
+                    releasing = None
+
+                _, tasks_left, units_left = self.__state
 
                 logger.debug("expecting {0} tasks, still".format(tasks_left))
                 self.queue.specify_num_tasks_left(tasks_left)
@@ -258,25 +391,19 @@ class Process(Command, util.Timing):
                 for c in categories + ['all']:
                     self.log(c, units_left)
 
-                if util.checkpoint(self.config.workdir, 'KILLED') == 'PENDING':
-                    util.register_checkpoint(
-                        self.config.workdir, 'KILLED', str(datetime.datetime.utcnow()))
+            if util.checkpoint(self.config.workdir, 'KILLED') == 'PENDING':
+                util.register_checkpoint(
+                    self.config.workdir, 'KILLED', str(datetime.datetime.utcnow()))
 
-                    # let the task source shut down gracefully
-                    logger.info("terminating task source")
+                # let the task source shut down gracefully
+                logger.info("terminating task source")
+                self.__drain(pool, creating, releasing)
+                with self.synchronized():
                     self.source.terminate()
-                    logger.info("terminating gracefully")
-                    break
-
-            with self.measure('create'):
-                have = {}
-                for c in categories:
-                    cstats = self.queue.stats_category(c)
-                    have[c] = {'running': cstats.tasks_running, 'queued': cstats.tasks_waiting}
-
-                stats = self.queue.stats_hierarchy
-                tasks = self.source.obtain(stats.total_cores, have)
+                logger.info("terminating gracefully")
+                break
 
+            with self.measure('submit'):
                 expiry = None
                 if self.config.advanced.proxy:
                     expiry = self.config.advanced.proxy.expires()
@@ -287,30 +414,22 @@ class Process(Command, util.Timing):
                         util.sendemail("Your proxy is about to expire.\n" + "Timeleft: " + str(datetime.timedelta(seconds=proxy_time_left)), self.config)
                         proxy_email_sent = True
 
-                for category, cmd, id, inputs, outputs, env, dir in tasks:
-                    task = wq.Task(cmd)
-                    task.specify_category(category)
-                    task.specify_tag(id)
-                    task.specify_max_retries(wq_max_retries)
-                    task.specify_monitor_output(os.path.join(dir, 'resource_monitor'))
+                if creating is not None and creating.ready():
+                    self.submit(creating.get(), expiry)
+                    creating = None
 
-                    for k, v in env.items():
-                        task.specify_environment_variable(k, v)
+                # tasks for the next cycle are created in the background,
+                # based on the current state of the queue, unless Lobster
+                # is about to stop
+                killed = util.checkpoint(self.config.workdir, 'KILLED') == 'PENDING'
+                if creating is None and not killed:
+                    have = {}
+                    for c in categories:
+                        cstats = self.queue.stats_category(c)
+                        have[c] = {'running': cstats.tasks_running, 'queued': cstats.tasks_waiting}
 
-                    for (local, remote, cache) in inputs:
-                        cache_opt = wq.WORK_QUEUE_CACHE if cache else wq.WORK_QUEUE_NOCACHE
-                        if os.path.isfile(local) or os.path.isdir(local):
-                            task.specify_input_file(str(local), str(remote), cache_opt)
-                        else:
-                            logger.critical("cannot send file to worker: {0}".format(local))
-                            raise NotImplementedError
-
-                    for (local, remote) in outputs:
-                        task.specify_output_file(str(local), str(remote))
-
-                    if expiry:
-                        task.specify_end_time(expiry * 10 ** 6)
-                    self.queue.submit(task)
+                    stats = self.queue.stats_hierarchy
+                    creating = pool.apply_async(self.__create, (stats.total_cores, have))
 
             with self.measure('status'):
                 stats = self.queue.stats_hierarchy
@@ -321,8 +440,17 @@ class Process(Command, util.Timing):
                     stats.tasks_waiting,
                     units_left))
 
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("storage element statistics: {0}".format(fs.statistics()))
+
+                self.fetcher.adjust(stats.tasks_waiting, tasks_left)
+                interval = self.fetcher.interval
+                interval_minimum = self.fetcher.interval_minimum
+
+            # does not wait for task creation running in the background,
+            # which is only locked out briefly
             with self.measure('update'):
-                self.source.update(self.queue)
+                self.source.update(self.queue, self.__lock)
 
             # recurring actions are triggered here; plotting etc should run
             # while we have WQ hand us back tasks w/o any database
@@ -331,24 +459,50 @@ class Process(Command, util.Timing):
                 if action:
                     action.take()
 
+            starttime = time.time()
+            tasks = self.__cancelled
+            self.__cancelled = []
+            while True:
+                # submit freshly created tasks as soon as they are ready,
+                # instead of waiting for the next cycle
+                if creating is not None and creating.ready():
+                    with self.measure('submit'):
+                        self.submit(creating.get(), expiry)
+                    creating = None
+
+                remaining = int(starttime + interval - time.time())
+                if remaining <= 0 or self.__state[0] or len(tasks) >= self.fetcher.batch:
+                    break
+                elif len(tasks) > 0 and interval - remaining >= interval_minimum and self.queue.stats.tasks_waiting == 0:
+                    break
+
+                # The work_queue bindings may hold the GIL while waiting,
+                # which would stall the helper thread.  While it is busy,
+                # only wait in one second slices.  Otherwise, only wait in
+                # short slices if there is anything to submit in the
+                # background.
+                busy = any(job is not None and not job.ready() for job in (creating, releasing))
+                if busy:
+                    timeout = 1
+                elif creating is None:
+                    timeout = remaining
+                else:
+                    timeout = min(remaining, 5)
+
+                with self.measure('fetch'):
+                    task = self.queue.wait(timeout)
+                    if task:
+                        if task.return_status == 0:
+                            successful_tasks += 1
+                        elif task.return_status in self.config.advanced.bad_exit_codes:
+                            logger.warning(
+                                "blacklisting host {0} due to bad exit code from task {1}".format(task.hostname, task.tag))
+                            self.queue.blacklist(task.hostname)
+                        tasks.append(task)
+
             with self.measure('fetch'):
-                starttime = time.time()
-                task = self.queue.wait(interval)
-                tasks = []
-                while task:
-                    if task.return_status == 0:
-                        successful_tasks += 1
-                    elif task.return_status in self.config.advanced.bad_exit_codes:
-                        logger.warning(
-                            "blacklisting host {0} due to bad exit code from task {1}".format(task.hostname, task.tag))
-                        self.queue.blacklist(task.hostname)
-                    tasks.append(task)
-
-                    remaining = int(starttime + interval - time.time())
-                    if (interval - remaining < interval_minimum or self.queue.stats.tasks_waiting > 0) and remaining > 0:
-                        task = self.queue.wait(remaining)
-                    else:
-                        task = None
+                self.fetcher.returned(len(tasks), time.time() - starttime)
+
                 # TODO do we really need this?  We have everything based on
                 # categories by now, so this should not be needed.
                 if abort_threshold > 0 and successful_tasks >= abort_threshold and not abort_active:
@@ -356,18 +510,19 @@ class Process(Command, util.Timing):
                         "activating fast abort with multiplier: {0}".format(abort_multiplier))
                     abort_active = True
                     self.queue.activate_fast_abort(abort_multiplier)
+
             if len(tasks) > 0:
-                try:
-                    with self.measure('return'):
-                        self.source.release(tasks)
-                except Exception:
-                    tb = traceback.format_exc()
-                    logger.critical("cannot recover from the following exception:\n" + tb)
-                    util.sendemail("Your Lobster project has crashed from the following exception:\n" + tb, self.config)
-                    for task in tasks:
-                        logger.critical(
-                            "tried to return task {0} from {1}".format(task.tag, task.hostname))
-                    raise
+                # only keep one batch of tasks in flight to the source
+                if releasing is not None:
+                    with self.measure('sync'):
+                        releasing.wait()
+                    self.__released(releasing)
+                releasing = pool.apply_async(self.__release, (tasks,))
+        else:
+            self.__drain(pool, creating, releasing)
+            self.source.finish()
+            units_left = self.__state[2]
+
         if units_left == 0:
             logger.info("no more work left to do")
             util.sendemail("Your Lobster project is done!", self.config)
@@ -0,0 +1,348 @@
+from collections import defaultdict
+import bz2
+import fnmatch
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+from lobster import util
+from lobster.core.command import Command
+
+logger = logging.getLogger('lobster.sandbox')
+
+Entry = util.record('Entry', 'layer', 'path', 'arcname', 'names', 'size')
+
+# names which can't be blacklisted without breaking the sandbox
+ESSENTIAL = ['bin', 'cfipython', 'external', 'lib', 'python', 'src', '.SCRAM']
+
+
+def traced(logfile):
+    """Returns the paths of all files successfully accessed according to
+    the `strace` output in `logfile`, both as accessed and resolved.
+
+    Calls which did not finish within the trace count as successful.
+    """
+    call = re.compile(r'\w+\((?:[A-Z_]+, |\d+, )?"([^"]+)"')
+    failed = re.compile(r'= -1 E[A-Z]+')
+    paths = set()
+    with open(logfile) as f:
+        for line in f:
+            m = call.search(line)
+            if not m or failed.search(line):
+                continue
+            path = m.group(1)
+            if os.path.isabs(path):
+                paths.add(path)
+                paths.add(os.path.realpath(path))
+    return paths
+
+
+def trace(pset, logfile):
+    """Run `cmsRun` on the parameter set `pset` in a scratch directory,
+    recording file accesses with `strace` in `logfile`.
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        cmd = ['strace', '-f', '-q', '-e', 'trace=file,process', '-o', logfile,
+               'cmsRun', os.path.abspath(pset)]
+        logger.info("tracing file accesses of '{0}'".format(' '.join(cmd)))
+        with open(os.devnull, 'w') as devnull:
+            res = subprocess.call(cmd, cwd=workdir, stdout=devnull, stderr=subprocess.STDOUT)
+        if res != 0:
+            logger.warning("traced cmsRun exited with code {0}, file accesses may be incomplete".format(res))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def ratio(files, sample=8 * 1024 ** 2, chunk=1024 ** 2):
+    """Estimate the compression ratio of `files` by compressing the
+    beginning of the largest ones.
+    """
+    raw = 0
+    compressed = 0
+    for entry in sorted(files, key=lambda e: e.size, reverse=True):
+        if raw >= sample or entry.size == 0:
+            break
+        with open(entry.path, 'rb') as f:
+            data = f.read(chunk)
+        raw += len(data)
+        compressed += len(bz2.compress(data))
+    return float(compressed) / raw if raw > 0 else 1.
+
+
+def megabytes(size):
+    return '{0:.1f} MB'.format(size / 1024. ** 2)
+
+
+class Profile(object):
+
+    """The content of a sandbox, as it would be packed.
+
+    Parameters
+    ----------
+        sandbox : Sandbox
+            The sandbox to inspect.
+        basedirs : list
+            The directories to look for the release of the sandbox in.
+    """
+
+    def __init__(self, sandbox, basedirs):
+        self.sandbox = sandbox
+        self.release = os.path.realpath(util.findpath(basedirs, sandbox.release))
+        self.files = []
+        self.__byname = defaultdict(list)
+        self.__byext = defaultdict(list)
+
+        for layer, path, arcname, names in sandbox.contents(basedirs):
+            if os.path.islink(path):
+                size = 0
+            elif os.path.isfile(path):
+                size = os.path.getsize(path)
+            else:
+                continue
+            entry = Entry(layer, path, arcname, names, size)
+            self.files.append(entry)
+            for name in set(names):
+                self.__byname[name].append(entry)
+            for ext in set(os.path.splitext(name)[1] for name in names):
+                if ext:
+                    self.__byext[ext].append(entry)
+
+    def size(self, layer=None):
+        return sum(e.size for e in self.files if layer in (None, e.layer))
+
+    def largest(self, count):
+        """Returns the `count` largest files and directories, as lists of
+        tuples of size and name in the sandbox.
+        """
+        dirs = defaultdict(int)
+        for entry in self.files:
+            parent = os.path.dirname(entry.arcname)
+            while parent:
+                dirs[parent] += entry.size
+                parent = os.path.dirname(parent)
+        files = sorted(((e.size, e.arcname) for e in self.files), reverse=True)
+        return files[:count], sorted(((s, d) for d, s in dirs.items()), reverse=True)[:count]
+
+    def duplicates(self):
+        """Returns groups of files with identical content, as tuples of the
+        wasted size and the files, most wasteful first.
+        """
+        bysize = defaultdict(list)
+        for entry in self.files:
+            if entry.size > 0:
+                bysize[entry.size].append(entry)
+
+        groups = []
+        for size, entries in bysize.items():
+            if len(entries) < 2:
+                continue
+            byhash = defaultdict(list)
+            for entry in entries:
+                digest = hashlib.sha1()
+                with open(entry.path, 'rb') as f:
+                    for block in iter(lambda: f.read(1024 ** 2), ''):
+                        digest.update(block)
+                byhash[digest.hexdigest()].append(entry)
+            for same in byhash.values():
+                if len(same) > 1:
+                    groups.append((size * (len(same) - 1), same))
+        return sorted(groups, key=lambda (wasted, same): wasted, reverse=True)
+
+    def removed(self, pattern):
+        """Returns the files that adding `pattern` to the `blacklist` would
+        remove from the sandbox.
+        """
+        if not any(c in pattern for c in '*?['):
+            return list(self.__byname.get(pattern, []))
+        elif pattern.startswith('*.') and pattern.count('.') == 1 and not any(c in pattern[1:] for c in '*?['):
+            return list(self.__byext.get(pattern[1:], []))
+        return [e for e in self.files if any(fnmatch.fnmatch(n, pattern) for n in e.names)]
+
+    def unused(self, used):
+        """Returns the files not contained in the set of paths `used`.
+
+        Symbolic links are used when anything below them is.
+        """
+        touched = set(used)
+        for path in used:
+            parent = os.path.dirname(path)
+            while parent not in touched and parent != os.path.dirname(parent):
+                touched.add(parent)
+                parent = os.path.dirname(parent)
+        return [e for e in self.files
+                if e.path not in touched and os.path.realpath(e.path) not in touched]
+
+    def prune(self, used, minimum=1024 ** 2):
+        """Returns `blacklist` patterns only removing files not in `used`,
+        as tuples of the pattern and the files it removes, largest first.
+
+        Patterns are file and directory names, and extensions.  Files
+        removed by a previous pattern do not count towards the savings of
+        the following ones, which have to save at least `minimum` bytes.
+        """
+        unused = set(e.path for e in self.unused(used))
+        candidates = set()
+        for entry in self.files:
+            if entry.path not in unused:
+                continue
+            for name in entry.names:
+                if name not in ESSENTIAL and not any(c in name for c in '*?['):
+                    candidates.add(name)
+                ext = os.path.splitext(name)[1]
+                if ext and not any(c in ext for c in '*?['):
+                    candidates.add('*' + ext)
+
+        scored = []
+        for pattern in candidates:
+            files = self.removed(pattern)
+            if all(e.path in unused for e in files):
+                scored.append((sum(e.size for e in files), pattern, files))
+        scored.sort(key=lambda (size, pattern, files): (-size, pattern))
+
+        taken = set()
+        patterns = []
+        for size, pattern, files in scored:
+            files = [e for e in files if e.path not in taken]
+            if sum(e.size for e in files) < minimum:
+                continue
+            taken.update(e.path for e in files)
+            patterns.append((pattern, files))
+        return patterns
+
+    def missing(self, used):
+        """Returns the files in the `src` directory of the release which
+        are in the set of paths `used`, but not part of the sandbox, as
+        paths relative to `src`.
+        """
+        src = os.path.join(self.release, 'src') + os.sep
+        packed = set(os.path.realpath(e.path) for e in self.files)
+        res = set()
+        for path in used:
+            if path.startswith(src) and os.path.isfile(path) and path not in packed:
+                res.add(os.path.relpath(path, src))
+        return sorted(res)
+
+
+class Sandbox(Command):
+
+    @property
+    def help(self):
+        return 'inspect the content of sandboxes'
+
+    def setup(self, argparser):
+        subparsers = argparser.add_subparsers(title='actions', dest='action')
+
+        inspect = subparsers.add_parser('inspect', help='report large and duplicate files, and suggest what to prune')
+        inspect.add_argument('--top', type=int, default=20,
+                             help='number of largest paths and duplicates to report (default: 20)')
+        inspect.add_argument('--trace', default=None, metavar='PSET',
+                             help='trace the files opened by cmsRun with PSET to suggest pruning')
+        inspect.add_argument('--trace-log', default=None, metavar='FILE',
+                             help='use an existing strace output to suggest pruning')
+        inspect.add_argument('--min-size', type=float, default=1., metavar='MB',
+                             help='minimum savings of a suggested pattern in MB (default: 1)')
+        inspect.add_argument('--bandwidth', type=float, default=10., metavar='MB/S',
+                             help='bandwidth to project transfer time savings with in MB/s (default: 10)')
+        inspect.add_argument('--transfers', type=int, default=1,
+                             help='number of sandbox transfers to project savings for (default: 1)')
+
+    def seconds(self, size, args):
+        return size / (args.bandwidth * 1024 ** 2) * args.transfers
+
+    def inspect(self, profile, args, used=None):
+        blacklist = list(profile.sandbox.blacklist)
+        include = list(profile.sandbox.include)
+
+        for layer in ('release', 'user'):
+            files = [e for e in profile.files if e.layer == layer]
+            size = profile.size(layer)
+            logger.info("{0} layer: {1} files, {2} ({3} compressed, estimated)".format(
+                layer, len(files), megabytes(size), megabytes(size * ratio(files))))
+
+        files, dirs = profile.largest(args.top)
+        logger.info("largest directories:\n" + '\n'.join(
+            '{0:>12} {1}'.format(megabytes(s), d) for s, d in dirs))
+        logger.info("largest files:\n" + '\n'.join(
+            '{0:>12} {1}'.format(megabytes(s), f) for s, f in files))
+
+        duplicates = profile.duplicates()
+        if duplicates:
+            wasted = sum(w for w, same in duplicates)
+            logger.info("{0} groups of duplicate files, wasting {1}:\n".format(len(duplicates), megabytes(wasted)) +
+                        '\n'.join('{0:>12} {1}'.format(megabytes(w), ', '.join(e.arcname for e in same))
+                                  for w, same in duplicates[:args.top]))
+
+        if used is None:
+            logger.info("use --trace or --trace-log to find files not needed by cmsRun and get pruning suggestions")
+            return
+
+        unused = profile.unused(used)
+        logger.info("{0} files with {1} not opened by the traced cmsRun".format(
+            len(unused), megabytes(sum(e.size for e in unused))))
+
+        patterns = profile.prune(used, args.min_size * 1024 ** 2)
+        pruned = [e for pattern, files in patterns for e in files]
+        for pattern, files in patterns:
+            size = sum(e.size for e in files)
+            logger.info("blacklisting '{0}' removes {1} files, {2}".format(pattern, len(files), megabytes(size)))
+        blacklist += [pattern for pattern, files in patterns]
+
+        for path in profile.missing(used):
+            if any(fnmatch.fnmatch(n, p) for n in path.split(os.sep) for p in profile.sandbox.blacklist):
+                logger.warning("'{0}' is opened by cmsRun, but removed by the blacklist".format(path))
+            else:
+                logger.warning("'{0}' is opened by cmsRun, but not in the sandbox".format(path))
+                include.append(path)
+
+        if len(pruned) == 0 and include == profile.sandbox.include:
+            logger.info("no changes to suggest")
+            return
+
+        size = sum(e.size for e in pruned)
+        compressed = size * ratio(pruned)
+        logger.info(("suggested sandbox settings:\n" +
+                     "    blacklist={0!r},\n" +
+                     "    include={1!r},\n" +
+                     "projected savings: {2} ({3} compressed, estimated), " +
+                     "{4:.1f} s of transfers for {5} transfer(s) at {6} MB/s").format(
+            blacklist, include, megabytes(size), megabytes(compressed),
+            self.seconds(compressed, args), args.transfers, args.bandwidth))
+
+    def run(self, args):
+        from lobster.cmssw.sandbox import Sandbox as CMSSWSandbox
+
+        config = args.config
+        basedirs = [config.base_directory, config.startup_directory]
+
+        used = None
+        if args.trace_log:
+            used = traced(args.trace_log)
+        elif args.trace:
+            fd, logfile = tempfile.mkstemp(suffix='.strace')
+            os.close(fd)
+            try:
+                trace(args.trace, logfile)
+                used = traced(logfile)
+            finally:
+                os.unlink(logfile)
+
+        boxes = []
+        labels = defaultdict(list)
+        for wflow in config.workflows:
+            for box in (wflow.sandbox if hasattr(wflow.sandbox, '__iter__') else [wflow.sandbox]):
+                if id(box) not in labels:
+                    boxes.append(box)
+                labels[id(box)].append(wflow.label)
+
+        for box in boxes:
+            workflows = ', '.join(labels[id(box)])
+            if not isinstance(box, CMSSWSandbox) or box.recycle is not None:
+                logger.info("skipping recycled sandbox of workflow(s) {0}".format(workflows))
+                continue
+            logger.info("inspecting sandbox of workflow(s) {0} with release {1}".format(workflows, box.release))
+            self.inspect(Profile(box, basedirs), args, used)
@@ -0,0 +1,462 @@
+from collections import defaultdict, deque
+import bisect
+import heapq
+import json
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+
+from lobster import util
+from lobster.core import unit
+from lobster.core.command import Command
+from lobster.core.create import Algo
+from lobster.core.dataset import FileInfo
+
+logger = logging.getLogger('lobster.simulate')
+
+
+class Workload(object):
+
+    """Task outcomes as recorded in an existing working directory.
+
+    Processing tasks are modelled by an overhead and a per-unit processing
+    time, both taken from a randomly picked successful historical task of
+    the same workflow.  Failures happen with the historical failure rate,
+    and take as long as a randomly picked failed historical task.
+
+    Parameters
+    ----------
+        db : sqlite3.Connection
+            The database of the working directory to replay.
+        seed : int
+            The seed for the random number generator.
+    """
+
+    def __init__(self, db, seed=0):
+        self.__random = random.Random(seed)
+        self.__successful = defaultdict(list)
+        self.__failed = defaultdict(list)
+        self.tasksize = {}
+
+        rows = db.execute("""
+            select
+                workflows.label,
+                tasks.type,
+                tasks.status,
+                tasks.units,
+                max(tasks.time_on_worker, 0),
+                max(tasks.time_epilogue_end - tasks.time_stage_in_end, 0),
+                tasks.bytes_bare_output,
+                tasks.bytes_output
+            from tasks join workflows on tasks.workflow = workflows.id
+            where tasks.status in (2, 3, 6, 7, 8)
+            order by tasks.id""")
+        for label, type_, status, units, duration, processing, bare, total in rows:
+            key = (label, type_)
+            if type_ == unit.PROCESS and label not in self.tasksize:
+                self.tasksize[label] = units
+            if status == unit.FAILED:
+                self.__failed[key].append(duration)
+            else:
+                self.__successful[key].append((units, duration, min(processing, duration), bare, total))
+
+    def failure_rate(self, label, type_=unit.PROCESS):
+        key = (label, type_)
+        total = len(self.__failed[key]) + len(self.__successful[key])
+        return len(self.__failed[key]) / float(total) if total > 0 else 0.
+
+    def sample(self, label, units, type_=unit.PROCESS, default=3600):
+        """Returns if a task failed, its duration, processing time, and
+        bare and total output size, for a task with `units` units.
+        """
+        key = (label, type_)
+        if self.__random.random() < self.failure_rate(label, type_):
+            duration = self.__random.choice(self.__failed[key])
+            return True, duration, 0, 0, 0
+
+        if len(self.__successful[key]) == 0:
+            return False, default, default, 0, 0
+
+        size, duration, processing, bare, total = self.__random.choice(self.__successful[key])
+        scale = units / float(max(size, 1))
+        if type_ == unit.MERGE:
+            return False, duration, processing, bare, total
+        overhead = duration - processing
+        return False, int(overhead + processing * scale), int(processing * scale), int(bare * scale), int(total * scale)
+
+
+class Capacity(object):
+
+    """The number of cores available over time.
+
+    Read from the `total_cores` column of a `lobster_stats_all.log`, as
+    a step function of the time since the first entry.  Beyond the end
+    of the log, the last value is used, starting at `end`.
+
+    Parameters
+    ----------
+        filename : str
+            The stats log to read, or `None` to use a constant number of
+            cores.
+        cores : int
+            The constant number of cores to use instead of the log.
+    """
+
+    def __init__(self, filename=None, cores=None):
+        self.__steps = []
+        if cores is not None:
+            self.__steps = [(0, cores)]
+        elif filename and os.path.isfile(filename):
+            with open(filename) as f:
+                headers = f.readline()[1:].split()
+                index = headers.index('total_cores')
+                start = None
+                for line in f:
+                    if line.startswith('#'):
+                        continue
+                    values = line.split()
+                    if len(values) != len(headers):
+                        continue
+                    timestamp = float(values[0]) / 1e6
+                    if start is None:
+                        start = timestamp
+                    self.__steps.append((timestamp - start, int(float(values[index]))))
+        if len(self.__steps) == 0:
+            raise ValueError("no core counts available; specify the number of cores to use")
+
+        self.__starts = [start for (start, _) in self.__steps]
+        self.end = self.__starts[-1]
+
+    def __call__(self, time):
+        index = max(0, bisect.bisect_right(self.__starts, time) - 1)
+        return self.__steps[index][1]
+
+    def integral(self, time):
+        """Returns the core-seconds available until `time`.
+        """
+        total = 0
+        steps = self.__steps + [(time, 0)]
+        for (start, cores), (end, _) in zip(steps[:-1], steps[1:]):
+            if start >= time:
+                break
+            total += cores * (min(end, time) - start)
+        return total
+
+
+class Simulation(util.Timing):
+
+    """Replay a workload against the real task creation and unit store.
+
+    The unit store of the working directory is copied and reset to its
+    initial state, and then driven like `lobster process` would: every
+    `interval` seconds, finished tasks are returned to the store and new
+    ones are created by `Algo`.  Tasks run on a simulated queue whose
+    capacity follows `capacity`, with outcomes drawn from `workload`.
+
+    Parameters
+    ----------
+        config : Configuration
+            The configuration of the working directory, with the working
+            directory pointing to the copy of the database to use.
+        workload : Workload
+            The task outcomes to draw from.
+        capacity : Capacity
+            The number of cores available over time.
+        interval : int
+            The simulated time between two iterations of the main loop.
+    """
+
+    def __init__(self, config, workload, capacity, interval=60):
+        util.Timing.__init__(self, 'create', 'release', 'status')
+        self.config = config
+        self.workload = workload
+        self.capacity = capacity
+        self.interval = interval
+
+        self.store = unit.UnitStore(config)
+        self.algo = Algo(config)
+
+        self.categories = [c.name for c in config.categories if c.name != 'merge']
+        self.merge_cores = 1
+        for c in config.categories:
+            if c.name == 'merge':
+                self.merge_cores = c.cores or 1
+
+        self.now = 0
+        self.last = 0
+        self.queue = deque()
+        self.running = []
+        self.finished = []
+        self.busy = 0
+        self.used = 0
+        self.outputs = {}
+
+        self.tasks = 0
+        self.failed = 0
+        self.merges = 0
+        self.progress = []
+
+    def create(self):
+        with self.measure('create'):
+            have = {}
+            for c in self.categories:
+                have[c] = {'running': 0, 'queued': 0}
+            for (category, cores, task) in self.queue:
+                if category in have:
+                    have[category]['queued'] += 1
+            for (_, _, (category, cores, task, result)) in self.running:
+                if category in have:
+                    have[category]['running'] += 1
+
+            remaining = dict((wflow, self.store.work_left(wflow.label)) for wflow in self.config.workflows)
+
+            taskinfos = []
+            for wflow in self.config.workflows:
+                taskinfos += self.store.pop_unmerged_tasks(wflow.label, wflow.merge_size, 10)
+            for label, ntasks, taper in self.algo.run(self.capacity(self.now), have, remaining):
+                taskinfos += self.store.pop_units(label, ntasks, taper)
+
+        for task in taskinfos:
+            wflow = getattr(self.config.workflows, task[1])
+            if task[-1]:
+                self.queue.append(('merge', self.merge_cores, task))
+            else:
+                self.queue.append((wflow.category.name, wflow.category.cores or 1, task))
+
+    def dispatch(self):
+        while len(self.queue) > 0 and self.busy + self.queue[0][1] <= self.capacity(self.now):
+            category, cores, task = self.queue.popleft()
+            id, label, files, units, arg, merge = task
+            default = getattr(self.config.workflows, label).category.runtime or 3600
+            result = self.workload.sample(label, len(units), unit.MERGE if merge else unit.PROCESS, default)
+            self.busy += cores
+            heapq.heappush(self.running, (self.now + result[1], int(id), (category, cores, task, result)))
+
+    def release(self):
+        update = defaultdict(list)
+        propagate = defaultdict(dict)
+
+        for end, (category, cores, task, result) in self.finished:
+            id, label, files, units, arg, merge = task
+            failed, duration, processing, bare, total = result
+            wflow = getattr(self.config.workflows, label)
+
+            task_update = unit.TaskUpdate()
+            task_update.id = id
+            task_update.host = 'simulated'
+            task_update.allocated_cores = cores
+            task_update.status = unit.FAILED if failed else unit.SUCCESSFUL
+            task_update.exit_code = 1 if failed else 0
+            task_update.time_submit = end - duration
+            task_update.time_stage_in_end = end - duration
+            task_update.time_epilogue_end = end - duration + processing
+            task_update.time_retrieved = end
+            task_update.time_on_worker = duration
+            task_update.bytes_bare_output = bare
+            task_update.bytes_output = total
+
+            self.tasks += 1
+            if failed:
+                self.failed += 1
+            if merge:
+                self.merges += 1
+                merged = [self.outputs.get(t, ([], 0)) for (t, _, _, _) in units]
+                lumis = sum((ls for (ls, _) in merged), [])
+                total = sum(size for (_, size) in merged)
+                source = 'tasks'
+                file_update = []
+            else:
+                lumis = [(run, lumi) for (_, _, run, lumi) in units]
+                source = 'units_' + label
+                file_update = [(0, 1 if failed else 0, fid) for (fid, _) in files]
+                if not failed:
+                    self.outputs[int(id)] = (lumis, total)
+                    self.progress.append((end, len(units)))
+            task_update.units_processed = 0 if failed else len(units)
+
+            update[(label, source)].append((task_update, file_update, []))
+
+            if not failed and (wflow.merge_size <= 0 or merge):
+                info = FileInfo()
+                info.lumis = lumis
+                info.size = total
+                for dep in wflow.dependents:
+                    propagate[dep.label]['{0}_{1}.root'.format(label, id)] = info
+
+        self.finished = []
+
+        with self.measure('release'):
+            if len(update) > 0:
+                self.store.update_units(update)
+            for label, infos in propagate.items():
+                unique_args = getattr(self.config.workflows, label).unique_arguments
+                self.store.register_files(infos, label, unique_args)
+
+    def done(self):
+        with self.measure('status'):
+            return self.store.merged() and self.store.unfinished_units() == 0
+
+    def run(self, limit=None):
+        """Run the simulation until all work is done, no progress can be
+        made, or `limit` seconds of simulated time have passed.  No
+        progress can be made when no tasks are running, and the number
+        of cores will not change anymore.
+        """
+        while True:
+            self.release()
+            if self.done() and len(self.running) == 0:
+                break
+            self.create()
+            self.dispatch()
+
+            if len(self.queue) == 0 and len(self.running) == 0:
+                logger.warning("no more tasks can be created, stopping")
+                break
+            if len(self.running) == 0 and self.now >= self.capacity.end:
+                logger.warning("not enough cores to run the queued tasks, stopping")
+                break
+            if limit and self.now >= limit:
+                logger.warning("reached time limit, stopping")
+                break
+
+            cycle = self.now + self.interval
+            while len(self.running) > 0 and self.running[0][0] <= cycle:
+                end, _, data = heapq.heappop(self.running)
+                self.now = self.last = end
+                self.busy -= data[1]
+                self.used += data[1] * data[3][1]
+                self.finished.append((end, data))
+                self.dispatch()
+            self.now = cycle
+
+    def report(self):
+        """Returns a summary of the simulation.
+
+        The tail is the time it took to process the last 5% of units.
+        Times are given in seconds.
+        """
+        total = sum(n for (_, n) in self.progress)
+        tail = 0
+        done = 0
+        for end, n in sorted(self.progress):
+            done += n
+            if done >= 0.95 * total:
+                tail = self.last - end
+                break
+
+        available = self.capacity.integral(self.last)
+        # tasks still running when stopping early only count up to the end
+        used = self.used
+        for end, _, (_, cores, _, result) in self.running:
+            used += cores * max(0, self.last - (end - result[1]))
+
+        return {
+            'makespan': self.last,
+            'tail': tail,
+            'utilization': used / float(available) if available > 0 else 0.,
+            'tasks': self.tasks,
+            'tasks_failed': self.failed,
+            'tasks_merge': self.merges,
+            'units': total,
+            'db_time': sum(self.times.values()) / 1e6,
+            'db_time_create': self.times['create'] / 1e6,
+            'db_time_release': self.times['release'] / 1e6,
+            'db_time_status': self.times['status'] / 1e6
+        }
+
+
+class Simulate(Command):
+
+    @property
+    def help(self):
+        return 'replay the workload of a project with a simulated queue'
+
+    def setup(self, argparser):
+        argparser.add_argument('--cores', type=int, default=None,
+                               help='number of cores to simulate; default is to follow the recorded worker pool')
+        argparser.add_argument('--interval', type=int, default=60,
+                               help='simulated time between task creation cycles in seconds (default: 60)')
+        argparser.add_argument('--limit', type=int, default=None,
+                               help='stop after this many seconds of simulated time')
+        argparser.add_argument('--seed', type=int, default=0,
+                               help='seed for the random task outcomes (default: 0)')
+        argparser.add_argument('--json', default=None, metavar='FILE',
+                               help='also save the results to FILE')
+        argparser.add_argument('--keep', default=None, metavar='DIR',
+                               help='keep the simulated database in DIR')
+
+    def reset(self, db, config, workload):
+        """Reset a copy of the database to the state before processing.
+        """
+        with db:
+            db.execute("delete from tasks")
+            db.execute("drop table if exists estimators")
+            db.execute("""update workflows set
+                units_done=0, units_running=0, units_stuck=0, merged=0, transfers='{}'""")
+            for wflow in config.workflows:
+                if wflow.parent:
+                    # these are populated by the simulation
+                    db.execute("delete from units_{0}".format(wflow.label))
+                    db.execute("delete from files_{0}".format(wflow.label))
+                else:
+                    db.execute("update units_{0} set status=0, failed=0, task=null".format(wflow.label))
+                    db.execute("""update files_{0} set
+                        units_done=0, units_running=0, events_read=0, skipped=0""".format(wflow.label))
+                if wflow.label in workload.tasksize:
+                    db.execute("update workflows set tasksize=? where label=?",
+                               (workload.tasksize[wflow.label], wflow.label))
+
+    def run(self, args):
+        config = args.config
+        workdir = config.workdir
+
+        db = sqlite3.connect(os.path.join(workdir, 'lobster.db'))
+        workload = Workload(db, args.seed)
+        start, end = db.execute("""
+            select min(time_submit), max(time_retrieved)
+            from tasks
+            where time_submit > 0 and time_retrieved > 0""").fetchone()
+        db.close()
+
+        capacity = Capacity(os.path.join(workdir, 'lobster_stats_all.log'), args.cores)
+
+        simdir = args.keep if args.keep else tempfile.mkdtemp()
+        if not os.path.isdir(simdir):
+            os.makedirs(simdir)
+        shutil.copy(os.path.join(workdir, 'lobster.db'), os.path.join(simdir, 'lobster.db'))
+
+        try:
+            db = sqlite3.connect(os.path.join(simdir, 'lobster.db'))
+            self.reset(db, config, workload)
+            db.close()
+
+            with util.PartiallyMutable.unlock():
+                config.workdir = simdir
+                for wflow in config.workflows:
+                    if wflow.parent:
+                        parent = getattr(config.workflows, wflow.parent.label)
+                        if wflow.label not in [w.label for w in parent.dependents]:
+                            parent.register(wflow)
+
+            simulation = Simulation(config, workload, capacity, args.interval)
+            with simulation.store.db:
+                for wflow in config.workflows:
+                    simulation.store.update_workflow_stats(wflow.label)
+            simulation.run(args.limit)
+        finally:
+            if not args.keep:
+                shutil.rmtree(simdir)
+
+        results = simulation.report()
+        if start and end:
+            results['makespan_recorded'] = end - start
+
+        logger.info("simulation results:\n\t" + "\n\t".join(
+            "{0:20} {1}".format(k, v) for k, v in sorted(results.items())))
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
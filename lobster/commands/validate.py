@@ -1,15 +1,80 @@
+from multiprocessing.pool import ThreadPool
+import heapq
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
 
 from lobster import fs
+from lobster.core.cleanup import Cleanup
 from lobster.core.command import Command
 from lobster.core.unit import UnitStore
 
 
 logger = logging.getLogger('lobster.validate')
 
+FAILED = 0
+MERGED = 1
+SUCCESSFUL = 2
+
+
+def spill(items):
+    """Write `items` to a temporary file, returning the file.
+    """
+    f = tempfile.TemporaryFile()
+    for item in items:
+        f.write(json.dumps(item) + '\n')
+    f.seek(0)
+    return f
+
+
+def unspill(f):
+    for line in f:
+        item = json.loads(line)
+        yield tuple(item) if isinstance(item, list) else item
+
+
+def external_sort(items, chunksize=500000):
+    """Sort `items`, keeping at most `chunksize` of them in memory.
+
+    Sorted chunks are written to temporary files, and merged when the
+    result is iterated over.
+    """
+    chunks = []
+    buf = []
+    for item in items:
+        buf.append(item)
+        if len(buf) >= chunksize:
+            chunks.append(spill(sorted(buf)))
+            buf = []
+    if len(chunks) == 0:
+        return iter(sorted(buf))
+    chunks.append(spill(sorted(buf)))
+    return heapq.merge(*[unspill(f) for f in chunks])
+
+
+def merge_join(listing, expected):
+    """Join the sorted iterables `listing` of file names and `expected` of
+    tuples of file name, kind, and task id.
+
+    Yields every expected tuple, together with a flag whether the file
+    name is contained in the listing.
+    """
+    listing = iter(listing)
+    current = next(listing, None)
+    for filename, kind, task in expected:
+        while current is not None and current < filename:
+            current = next(listing, None)
+        yield filename, kind, task, current == filename
+
 
 class Validate(Command):
 
+    # number of files to remove at a time while validating
+    batch = 10000
+
     @property
     def help(self):
         return 'validate task output and remove output files for failed tasks'
@@ -17,6 +82,10 @@ class Validate(Command):
     def setup(self, argparser):
         argparser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False,
                                help='only print (do not remove) files to be cleaned')
+        argparser.add_argument('--threads', type=int, default=4,
+                               help='number of workflows to validate at the same time (default: 4)')
+        argparser.add_argument('--restart', action='store_true', default=False,
+                               help='ignore the results of an interrupted validation')
 
     def print_stats(self, stats):
         width = max([len(x) for x in stats])
@@ -41,63 +110,171 @@ class Validate(Command):
                                                                   sum(c for f, m, c in stats.values()),
                                                                   width=width))
 
-    def process_workflow(self, store, stats, wflow):
-        files = set(fs.ls(wflow.label))
-        delete = []
-        missing = []
+    def expected_outputs(self, store, wflow):
+        """Returns the sorted outputs of failed, merged, and successful
+        tasks of `wflow`, as tuples of file name, kind, and task id.
+        """
+        def outputs():
+            for kind, tasks in ((FAILED, store.failed_tasks), (MERGED, store.merged_tasks),
+                                (SUCCESSFUL, store.successful_tasks)):
+                for task, task_type in tasks(wflow.label):
+                    for _, filename in wflow.get_outputs(task):
+                        yield filename, kind, task
+        return external_sort(outputs())
+
+    def listing(self, label):
+        count = 0
+        for filename in fs.iterls(label):
+            count += 1
+            if count % 100000 == 0:
+                logger.info("listed {0} files for {1}".format(count, label))
+            yield filename
 
-        cleaned = any(w.cleanup_input for w in wflow.dependents)
+    def process_workflow(self, label, expected, cleaned, remove=None, check_missing=True):
+        """Compare the output directory of the workflow `label` with the
+        sorted `expected` outputs.
+
+        If `cleaned`, all files are stale, since the dependents of the
+        workflow finished and should have cleaned up.  Missing outputs of
+        successful tasks are only looked for with `check_missing`.  Files
+        to delete are passed to `remove` in batches, if given.  Returns
+        the tasks with missing output, and the counts of files of failed
+        tasks, merged tasks, and ones that should have been cleaned up.
+        """
+        delete = []
+        missing = set()
+        stats = [0, 0, 0]
 
-        for task, task_type in store.failed_tasks(wflow.label):
-            for _, filename in wflow.get_outputs(task):
-                if filename in files:
-                    logger.info("found output from failed task: {0}".format(filename))
-                    stats[wflow.label][0] += 1
-                    delete.append(filename)
+        def stale(filename):
+            delete.append(filename)
+            if len(delete) >= self.batch:
+                flush()
 
-        for task, task_type in store.merged_tasks(wflow.label):
-            for _, filename in wflow.get_outputs(task):
-                if filename in files:
-                    logger.info("found output from intermediate merged task: {0}".format(filename))
-                    stats[wflow.label][1] += 1
-                    delete.append(filename)
+        def flush():
+            if remove and len(delete) > 0:
+                remove(*delete)
+            del delete[:]
 
         if cleaned:
-            for w in wflow.dependents:
-                if not w.cleanup_input:
-                    continue
-                if store.unfinished_units(w.label) == 0:
-                    for fn in files:
-                        logger.warning('found output from tasks that should have been cleaned up: {}'.format(fn))
-                    stats[wflow.label][2] += len(files)
-                    delete.extend(files)
-            else:
-                logger.error("can't validate workflow {}, as its dependents have not completed and cleaned it up".format(wflow.label))
+            for filename in self.listing(label):
+                logger.warning('found output from tasks that should have been cleaned up: {}'.format(filename))
+                stats[2] += 1
+                stale(filename)
+            flush()
+            return sorted(missing), stats
+
+        for filename, kind, task, present in merge_join(external_sort(self.listing(label)), expected):
+            if kind == FAILED and present:
+                logger.info("found output from failed task: {0}".format(filename))
+                stats[0] += 1
+                stale(filename)
+            elif kind == MERGED and present:
+                logger.info("found output from intermediate merged task: {0}".format(filename))
+                stats[1] += 1
+                stale(filename)
+            elif kind == SUCCESSFUL and not present and check_missing:
+                logger.warning('output file is missing for {0}'.format(task))
+                missing.add(task)
+        flush()
+
+        return sorted(missing), stats
+
+    def resume_cleanup(self, args):
+        cleanup = Cleanup(args.config.workdir)
+        outstanding = cleanup.outstanding()
+        if len(outstanding) == 0:
+            return
+
+        logger.info('outstanding removals in the cleanup journal: {0}'.format(
+            ', '.join('{0} {1} files'.format(count, reason) for reason, count in sorted(outstanding.items()))))
+        if args.dry_run:
+            return
+
+        left = cleanup.drain()
+        if left > 0:
+            logger.warning('{0} files could not be removed and remain in the cleanup journal'.format(left))
         else:
-            for task, task_type in store.successful_tasks(wflow.label):
-                for _, filename in wflow.get_outputs(task):
-                    if filename not in files:
-                        missing.append(task)
-                        logger.warning('output file is missing for {0}'.format(task))
+            logger.info('removed all outstanding files')
 
-        return delete, missing
+    def load_checkpoint(self, filename, summary, restart):
+        if restart or not os.path.exists(filename):
+            return {}
+        try:
+            with open(filename) as f:
+                checkpoint = json.load(f)
+        except ValueError:
+            return {}
+        if checkpoint.get('tasks') != summary:
+            logger.info('tasks changed since the interrupted validation, starting over')
+            return {}
+        logger.info('resuming validation, skipping {0} validated workflows'.format(len(checkpoint['workflows'])))
+        return checkpoint['workflows']
+
+    def save_checkpoint(self, filename, summary, results):
+        tmpfile = filename + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump({'tasks': summary, 'workflows': results}, f)
+        os.rename(tmpfile, filename)
 
     def run(self, args):
+        self.resume_cleanup(args)
+
         store = UnitStore(args.config)
-        stats = dict((w.label, [0, 0, 0]) for w in args.config.workflows)
+        checkpoint = os.path.join(args.config.workdir, 'validation.json')
+        summary = store.task_summary()
+        results = self.load_checkpoint(checkpoint, summary, args.restart)
 
-        missing = []
+        jobs = []
         for wflow in args.config.workflows:
-            logger.info('validating output files for {0}'.format(wflow.label))
+            if wflow.label in results:
+                continue
 
-            delete, missed = self.process_workflow(store, stats, wflow)
-            missing += missed
+            # outputs consumed by dependents cleaning up their input are
+            # not missing, and only all stale once these finished
+            cleaning = [w for w in wflow.dependents if w.cleanup_input]
+            cleaned = len(cleaning) > 0
+            if any(store.unfinished_units(w.label) > 0 for w in cleaning):
+                logger.error("can't validate the cleanup of workflow {}, as its dependents have not completed".format(wflow.label))
+                cleaned = False
 
-            if not args.dry_run and len(delete) > 0:
-                fs.remove(*delete)
+            jobs.append((wflow, cleaned, len(cleaning) == 0))
+
+        # the store can only be used by one thread at a time
+        lock = threading.Lock()
+        remove = None if args.dry_run else fs.remove
+
+        def validate((wflow, cleaned, check_missing)):
+            expected = None
+            if not cleaned:
+                # sorting reads all outputs from the store before returning
+                with lock:
+                    expected = self.expected_outputs(store, wflow)
+            return wflow.label, self.process_workflow(wflow.label, expected, cleaned, remove, check_missing)
+
+        total = len(jobs)
+        pool = ThreadPool(max(1, min(args.threads, total)))
+        start = time.time()
+        try:
+            for done, (label, (missing, stats)) in enumerate(pool.imap_unordered(validate, jobs)):
+                results[label] = {'missing': missing, 'stats': stats}
+                if not args.dry_run:
+                    self.save_checkpoint(checkpoint, summary, results)
+                logger.info('validated output files for {0} ({1}/{2}, {3:.0f} s)'.format(
+                    label, done + 1, total, time.time() - start))
+        finally:
+            pool.close()
+            pool.join()
+
+        missing = []
+        for label, result in sorted(results.items()):
+            missing += result['missing']
 
         logger.info('finished validating')
 
+        stats = dict((w.label, [0, 0, 0]) for w in args.config.workflows)
+        for label, result in results.items():
+            stats[label] = result['stats']
+
         if sum(sum(stats.values(), [])) == 0:
             logger.info('no files found to cleanup')
         else:
@@ -110,3 +287,6 @@ class Validate(Command):
             verb = 'would have' if args.dry_run else 'have'
             template = 'the following {0} been marked as failed because their output could not be found: {1}'
             logger.warning(template.format(verb, ', '.join(map(str, missing))))
+
+        if not args.dry_run and os.path.exists(checkpoint):
+            os.unlink(checkpoint)
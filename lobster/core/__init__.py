@@ -1,7 +1,7 @@
 from config import AdvancedOptions, Config
 from create import Algo
 from sandbox import Sandbox
-from task import TaskHandler, MergeTaskHandler
+from task import TaskHandler, MergeTaskHandler, PilotTask
 from workflow import Category, Workflow
 from dataset import Dataset, EmptyDataset, ParentDataset, ProductionDataset, MultiProductionDataset
 from lobster.se import StorageConfiguration
@@ -10,5 +10,5 @@ __all__ = [
     'Algo', 'Config', 'AdvancedOptions', 'Category', 'Workflow',
     'Dataset', 'EmptyDataset', 'ParentDataset', 'ProductionDataset', 'MultiProductionDataset',
     'Sandbox', 'StorageConfiguration',
-    'TaskHandler', 'MergeTaskHandler'
+    'TaskHandler', 'MergeTaskHandler', 'PilotTask'
 ]
@@ -0,0 +1,233 @@
+import Queue
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import Counter
+
+from lobster import fs
+
+logger = logging.getLogger('lobster.cleanup')
+
+
+class Cleanup(object):
+
+    """Removes files in the background, recording them in a journal.
+
+    Every batch of files to remove is appended to a journal in the
+    working directory before it is queued, and marked as done once it has
+    been removed, so that no removal is lost when Lobster stops.  Batches
+    still outstanding in the journal are queued again when starting, and
+    can be removed with `drain`, i.e., by ``lobster validate``.
+
+    Failed removals are retried with an exponential backoff, and given up
+    on for the current session after `retries` attempts.
+
+    Parameters
+    ----------
+        workdir : str
+            The working directory to keep the journal in.
+        retries : int
+            How often to retry removing a batch of files.
+        delay : float
+            The time to wait before retrying to remove a batch of files
+            for the first time, in seconds.  Doubles with each retry.
+        compact : int
+            After how many removed batches to rewrite the journal with the
+            outstanding batches only.
+        size : int
+            How many files to pass to the storage element at most at once
+            when removing a batch, so that stopping does not have to wait
+            for the removal of a large batch.
+    """
+
+    def __init__(self, workdir, retries=5, delay=60, compact=1000, size=1000):
+        self.journal = os.path.join(workdir, 'cleanup.journal')
+        self.retries = retries
+        self.delay = delay
+        self.compact = compact
+        self.size = size
+
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__attempts = Counter()
+        self.__abandoned = set()
+        self.__next = 0
+        self.__done = 0
+
+        self.__queue = Queue.Queue()
+        self.__thread = None
+        self.__stopping = False
+
+        self.__load()
+
+    def __load(self):
+        if not os.path.exists(self.journal):
+            return
+
+        with open(self.journal) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # incomplete entry written when stopping abruptly
+                    continue
+                if 'done' in entry:
+                    self.__pending.pop(entry['done'], None)
+                else:
+                    self.__pending[entry['id']] = (entry['reason'], entry['paths'])
+                    self.__next = max(self.__next, entry['id'] + 1)
+
+    def __compact(self):
+        # needs to be called with the lock held
+        tmpfile = self.journal + '.tmp'
+        with open(tmpfile, 'w') as f:
+            for id_, (reason, paths) in sorted(self.__pending.items()):
+                f.write(json.dumps({'id': id_, 'reason': reason, 'paths': paths}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmpfile, self.journal)
+        self.__done = 0
+
+    def __write(self, entry):
+        # needs to be called with the lock held
+        with open(self.journal, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __remove(self, id_):
+        """Try to remove a batch of files.  Returns `True` if successful.
+        """
+        with self.__lock:
+            if id_ not in self.__pending:
+                return True
+            reason, paths = self.__pending[id_]
+
+        try:
+            with fs.default():
+                for i in range(0, len(paths), self.size):
+                    if self.__stopping:
+                        # the batch stays in the journal
+                        return False
+                    fs.remove(*paths[i:i + self.size])
+        except Exception as e:
+            logger.warning("failed to remove {0} files ({1}): {2}".format(len(paths), reason, e))
+            return False
+
+        with self.__lock:
+            self.__write({'done': id_})
+            del self.__pending[id_]
+            self.__done += 1
+            if self.__done >= self.compact:
+                self.__compact()
+        return True
+
+    def __run(self):
+        retries = []
+        while not self.__stopping:
+            # retries that are due go first, so that newly added files
+            # can not hold them off
+            if len(retries) > 0 and retries[0][0] <= time.time():
+                id_ = heapq.heappop(retries)[1]
+            else:
+                try:
+                    if len(retries) > 0:
+                        id_ = self.__queue.get(True, max(0.1, retries[0][0] - time.time()))
+                    else:
+                        id_ = self.__queue.get()
+                except Queue.Empty:
+                    continue
+            if id_ is None or self.__stopping:
+                break
+
+            if self.__remove(id_):
+                continue
+
+            self.__attempts[id_] += 1
+            if self.__attempts[id_] > self.retries:
+                with self.__lock:
+                    self.__abandoned.add(id_)
+                    count = len(self.__pending[id_][1])
+                logger.error("giving up on removing {0} files after {1} attempts, "
+                             "use 'lobster validate' to retry".format(count, self.__attempts[id_]))
+            else:
+                due = time.time() + self.delay * 2 ** (self.__attempts[id_] - 1)
+                heapq.heappush(retries, (due, id_))
+
+    def add(self, paths, reason):
+        """Record `paths` to be removed, giving the `reason` why.
+        """
+        if len(paths) == 0:
+            return
+        with self.__lock:
+            id_ = self.__next
+            self.__next += 1
+            self.__pending[id_] = (reason, list(paths))
+            self.__write({'id': id_, 'reason': reason, 'paths': list(paths)})
+        if self.__thread:
+            self.__queue.put(id_)
+
+    def outstanding(self):
+        """Returns the number of files still to be removed, per reason.
+        """
+        res = Counter()
+        with self.__lock:
+            for reason, paths in self.__pending.values():
+                res[reason] += len(paths)
+        return res
+
+    def start(self):
+        """Start removing files in the background, beginning with the
+        ones outstanding in the journal.
+        """
+        with self.__lock:
+            self.__compact()
+            ids = sorted(self.__pending.keys())
+        self.__thread = threading.Thread(target=self.__run, name='cleanup')
+        self.__thread.daemon = True
+        self.__thread.start()
+        for id_ in ids:
+            self.__queue.put(id_)
+
+    def stop(self, wait=False, timeout=None):
+        """Stop removing files in the background.
+
+        With `wait`, all files are removed, or given up on, first, for at
+        most `timeout` seconds, if given.  Otherwise, outstanding files
+        are left in the journal.  Waiting for a removal in progress is
+        bounded by `timeout`, too, after which the background thread is
+        left behind.
+        """
+        if not self.__thread:
+            return
+        if wait:
+            end = None if timeout is None else time.time() + timeout
+            while self.__thread.is_alive() and (end is None or time.time() < end):
+                with self.__lock:
+                    if all(id_ in self.__abandoned for id_ in self.__pending):
+                        break
+                time.sleep(min(1, max(0, end - time.time())) if end else 1)
+        self.__stopping = True
+        self.__queue.put(None)
+        if timeout is None:
+            self.__thread.join()
+        else:
+            self.__thread.join(max(0, end - time.time()) if wait else timeout)
+            if self.__thread.is_alive():
+                logger.warning("stopped waiting for the removal of files in progress, "
+                               "outstanding files are kept in the journal")
+        self.__thread = None
+
+    def drain(self):
+        """Try once to remove all files outstanding in the journal.
+        Returns the number of files that could not be removed.
+        """
+        with self.__lock:
+            ids = sorted(self.__pending.keys())
+        for id_ in ids:
+            self.__remove(id_)
+        return sum(self.outstanding().values())
@@ -153,6 +153,10 @@ class AdvancedOptions(Configurable):
     Attributes modifiable at runtime:
 
     * `payload`
+    * `share_by_priority`
+    * `speculation_age`
+    * `speculation_limit`
+    * `speculation_threshold`
     * `threshold_for_failure`
     * `threshold_for_skipping`
 
@@ -172,6 +176,10 @@ class AdvancedOptions(Configurable):
         dashboard : :class:`~lobster.cmssw.Dashboard`
             Use the CMS dashboard to report task status.  Set or `False` to
             disable.
+        discovery_threads : int
+            How many workflows to set up and query datasets for
+            concurrently when creating a project.  Set to 1 to discover
+            workflows one after another.
         dump_core : bool
             Produce core dumps.  Useful to debug `WorkQueue`.
         email : str
@@ -191,6 +199,23 @@ class AdvancedOptions(Configurable):
         proxy : :class:`~lobster.cmssw.Proxy`
             An authentication mechanism to access data.  Set to `False` to
             disable.
+        share_by_priority : bool
+            Share cores between workflows according to their `priority`
+            and `deadline`, rather than proportional to their remaining
+            work.
+        speculation_age : float
+            How long a task has to be running, as a multiple of the average
+            runtime of successful tasks of its workflow, before a duplicate
+            may be created for it.
+        speculation_limit : int
+            How many duplicates to create at most per workflow each time
+            tasks are created.
+        speculation_threshold : float
+            When no more units are left to be assigned to tasks, and the
+            units still running make up less than this fraction of a
+            workflow, duplicates of the oldest running tasks are created.
+            The first duplicate to succeed is kept, and the other one
+            cancelled.  Set to 0 to disable.
         threshold_for_failure : int
             How often a single unit may fail to be processed before Lobster
             will not attempt to process it any longer.
@@ -212,6 +237,10 @@ class AdvancedOptions(Configurable):
     _mutable = {
         'bad_exit_codes': (None, [], False),
         'payload': (None, [], False),
+        'share_by_priority': (None, [], False),
+        'speculation_age': (None, [], False),
+        'speculation_limit': (None, [], False),
+        'speculation_threshold': (None, [], False),
         'threshold_for_failure': ('source.update_stuck', [], False),
         'threshold_for_skipping': ('source.update_stuck', [], False),
         'xrootd_servers': ('source.copy_siteconf', [], False)
@@ -222,6 +251,7 @@ class AdvancedOptions(Configurable):
                  abort_multiplier=4,
                  bad_exit_codes=None,
                  dashboard=None,
+                 discovery_threads=4,
                  dump_core=False,
                  email=None,
                  full_monitoring=False,
@@ -229,6 +259,10 @@ class AdvancedOptions(Configurable):
                  osg_version=None,
                  payload=10,
                  proxy=None,
+                 share_by_priority=False,
+                 speculation_age=1.5,
+                 speculation_limit=10,
+                 speculation_threshold=0.,
                  threshold_for_failure=30,
                  threshold_for_skipping=30,
                  wq_max_retries=10,
@@ -252,12 +286,17 @@ class AdvancedOptions(Configurable):
             self.dashboard = cmssw.Dashboard()
         elif not dashboard:
             self.dashboard = cmssw.Monitor()
+        self.discovery_threads = discovery_threads
         self.dump_core = dump_core
         self.email = email
         self.full_monitoring = full_monitoring
         self.log_level = log_level
         self.payload = payload
         self.proxy = proxy if proxy is not None else cmssw.Proxy()
+        self.share_by_priority = share_by_priority
+        self.speculation_age = speculation_age
+        self.speculation_limit = speculation_limit
+        self.speculation_threshold = speculation_threshold
         self.threshold_for_failure = threshold_for_failure
         self.threshold_for_skipping = threshold_for_skipping
         self.wq_max_retries = wq_max_retries
@@ -2,17 +2,66 @@ from collections import defaultdict
 
 import logging
 import math
+import time
 
 logger = logging.getLogger('lobster.algo')
 
 
+def share(capacity, demands, weights):
+    """Split `capacity` between consumers with weighted max-min fairness.
+
+    Consumers receive capacity proportional to their weight, but never
+    more than they demand.  Capacity not used by one consumer is split
+    between the remaining ones.  Consumers without weight only receive
+    what is left after everybody else has been satisfied, proportional to
+    their demand.
+
+    Parameters
+    ----------
+        capacity : float
+            The capacity to split.
+        demands : dict
+            The demand of each consumer.
+        weights : dict
+            The weight of each consumer.
+
+    Returns
+    -------
+        allocation : dict
+            The capacity allocated to each consumer.
+    """
+    allocation = dict((k, 0.) for k in demands)
+
+    for weighted in (True, False):
+        active = set(k for (k, v) in demands.items() if v > 0 and (weights.get(k, 0) > 0) == weighted)
+        while len(active) > 0 and capacity > 0:
+            weight = dict((k, weights[k] if weighted else demands[k]) for k in active)
+            total = float(sum(weight.values()))
+            satisfied = [k for k in active if demands[k] - allocation[k] <= capacity * weight[k] / total]
+            if len(satisfied) == 0:
+                for k in active:
+                    allocation[k] += capacity * weight[k] / total
+                capacity = 0
+                break
+            for k in satisfied:
+                capacity -= demands[k] - allocation[k]
+                allocation[k] = demands[k]
+                active.remove(k)
+
+    return allocation
+
+
 class Algo(object):
 
     """A task creation algorithm
 
     Attempts to be fair when creating tasks by making sure that tasks are
     created evenly for every category and every workflow in each category
-    based on the remaining work per workflow and cores used.
+    based on the remaining work per workflow and cores used.  With
+    `share_by_priority` set in the advanced options, the cores to fill
+    are shared between workflows according to their priority instead,
+    while making sure that workflows with a deadline are allotted enough
+    cores to meet it.
 
     Parameters
     ----------
@@ -22,6 +71,77 @@ class Algo(object):
 
     def __init__(self, config):
         self.__config = config
+        self.allocations = dict((w.label, 0) for w in config.workflows)
+
+    def allocate(self, fill_cores, demands, now=None):
+        """Allocate cores to workflows.
+
+        By default, the cores are split proportional to the remaining
+        workload of each workflow, weighed by the cores per task.  With
+        `share_by_priority` set in the advanced options, they are
+        allocated in the following steps instead.
+
+        Steps
+        -----
+        1. Every workflow with a priority > 0 is allotted the cores for
+           one task, to avoid starvation
+        2. Workflows with a deadline are allotted the cores needed to
+           process their remaining tasks in time, earliest deadline first,
+           assuming tasks take the runtime of their category (one hour if
+           not set)
+        3. The remaining cores are shared by priority, see :func:`share`
+
+        Parameters
+        ----------
+            fill_cores : int
+                How many cores to allocate.
+            demands : dict
+                A dictionary with workflows as keys, and the number of
+                tasks that can be created as values.
+            now : float
+                The current time, for testing.
+
+        Returns
+        -------
+            allocation : dict
+                The cores allocated for each workflow.
+        """
+        if now is None:
+            now = time.time()
+
+        allocation = dict((wflow, 0.) for wflow in demands)
+        left = dict((wflow, (wflow.category.cores or 1) * tasks) for (wflow, tasks) in demands.items())
+        capacity = float(fill_cores)
+
+        if not getattr(self.__config.advanced, 'share_by_priority', False):
+            workload = sum(left.values())
+            if workload > 0:
+                allocation.update((wflow, capacity * cores / workload) for (wflow, cores) in left.items())
+            return allocation
+
+        def allot(wflow, cores):
+            cores = min(cores, left[wflow], capacity)
+            allocation[wflow] += cores
+            left[wflow] -= cores
+            return capacity - cores
+
+        for wflow in demands:
+            if getattr(wflow, 'priority', 1.) > 0:
+                capacity = allot(wflow, wflow.category.cores or 1)
+
+        with_deadline = [w for w in demands if getattr(w, 'deadline', None)]
+        for wflow in sorted(with_deadline, key=lambda w: w.deadline):
+            remaining = time.mktime(wflow.deadline.timetuple()) - now
+            work = allocation[wflow] + left[wflow]
+            if remaining > 0:
+                work *= (wflow.category.runtime or 3600) / remaining
+            capacity = allot(wflow, work - allocation[wflow])
+
+        fair = share(capacity, left, dict((w, getattr(w, 'priority', 1.)) for w in demands))
+        for wflow, cores in fair.items():
+            allocation[wflow] += cores
+
+        return allocation
 
     def run(self, total_cores, queued, remaining):
         """Run the task creation algorithm.
@@ -32,13 +152,13 @@ class Algo(object):
 
         Steps
         -----
-        1. Calculate remaining workload, weighed by cores, per category
+        1. Calculate remaining workload, weighed by cores, per workflow
         2. Determine how many cores need to be filled
-        3. Go through workflows:
-           1. Determine the fraction of category workload versus the total
-              workload
-           2. Do the same for the workflow workload versus the category
-              workload
+        3. Allocate these cores to workflows, see :meth:`allocate`
+        4. Go through workflows:
+           1. Determine the fraction of cores allocated to the category
+              versus all allocated cores
+           2. Do the same for the workflow versus the category
            3. Use the first fraction to calculate how many tasks should be
               created for the category
            4. Adjust for mininum queued and maximum total task requirements
@@ -73,19 +193,26 @@ class Algo(object):
                 and the task taper adjustment.
         """
         # Remaining workload
-        workloads = defaultdict(int)
+        demands = {}
         for wflow, (complete, units, tasks) in remaining.items():
             if not complete and tasks < 1.:
                 logger.debug("workflow {} has not enough units available to form new tasks".format(wflow.label))
                 continue
             elif units == 0:
                 continue
-            task_cores = wflow.category.cores or 1
-            workloads[wflow.category.name] += task_cores * tasks
+            demands[wflow] = tasks
 
         # How many cores we need to occupy: have at least 10% of the
         # available cores provisioned with waiting work
         fill_cores = total_cores + max(int(0.1 * total_cores), self.__config.advanced.payload)
+
+        allocation = self.allocate(fill_cores, demands)
+        self.allocations = dict((w.label, 0) for w in self.__config.workflows)
+        self.allocations.update((w.label, int(round(cores))) for (w, cores) in allocation.items())
+
+        workloads = defaultdict(float)
+        for wflow, cores in allocation.items():
+            workloads[wflow.category.name] += cores
         total_workload = sum(workloads.values())
 
         if total_workload == 0:
@@ -94,11 +221,11 @@ class Algo(object):
         # contains (workflow label, tasks, taper)
         data = []
         for wflow, (complete, units, tasks) in remaining.items():
-            if not complete and tasks < 1. or units == 0:
+            if wflow not in allocation or allocation[wflow] == 0:
                 continue
             task_cores = wflow.category.cores or 1
             category_fraction = workloads[wflow.category.name] / float(total_workload)
-            workflow_fraction = task_cores * tasks / float(workloads[wflow.category.name])
+            workflow_fraction = allocation[wflow] / float(workloads[wflow.category.name])
 
             needed_category_tasks = category_fraction * fill_cores / task_cores
 
@@ -121,10 +248,12 @@ class Algo(object):
 
             logger.debug(("creating tasks for {w.label} (category: {w.category.name}):\n" +
                           "\tcategory task limit: ({w.category.tasks_min}, {w.category.tasks_max})\n" +
+                          "\tcores allocated: {5:.1f}\n" +
                           "\tcategory tasks needed: {0}\n" +
                           "\tworkflow tasks needed: {1}\n" +
                           "\tworkflow tasks available: {2} (complete: {4})\n" +
-                          "\ttask taper: {3}").format(needed_category_tasks, needed_workflow_tasks, tasks, taper, complete, w=wflow))
+                          "\ttask taper: {3}").format(needed_category_tasks, needed_workflow_tasks, tasks, taper, complete,
+                                                      allocation[wflow], w=wflow))
 
             data.append((wflow.label, needed_workflow_tasks, taper))
 
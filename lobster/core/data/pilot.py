@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Run several Lobster tasks within one prepared environment.
+
+Usage: pilot.py taskdir...
+
+Each task directory holds the inputs specific to one task, most notably
+its `parameters.json`, and receives the outputs of this task.  All other
+inputs are shared between the tasks, and linked into the task
+directories.  Only the first task bears the cost of setting up the
+environment, which is reflected in the wrapper timing of the tasks.
+"""
+
+from datetime import datetime
+import os
+import shutil
+import subprocess
+import sys
+
+if len(sys.argv) < 2:
+    print "usage: {0} taskdir...".format(sys.argv[0])
+    sys.exit(1)
+
+taskdirs = sys.argv[1:]
+timing = ['t_wrapper_start', 't_wrapper_ready']
+
+status = 0
+for n, taskdir in enumerate(taskdirs):
+    for name in os.listdir('.'):
+        if name in taskdirs or name in timing or os.path.exists(os.path.join(taskdir, name)):
+            continue
+        os.symlink(os.path.abspath(name), os.path.join(taskdir, name))
+
+    now = datetime.now().strftime('%s')
+    for name in timing:
+        if n == 0:
+            shutil.copy(name, taskdir)
+        else:
+            with open(os.path.join(taskdir, name), 'w') as f:
+                f.write(now + '\n')
+
+    print "==== running task {0} of {1} in {2} @ {3} ====".format(n + 1, len(taskdirs), taskdir, datetime.now())
+    sys.stdout.flush()
+
+    res = subprocess.call([sys.executable, 'task.py', 'parameters.json'], cwd=taskdir)
+    print "==== task in {0} returned {1} ====".format(taskdir, res)
+    if res != 0:
+        status = res
+
+sys.exit(status)
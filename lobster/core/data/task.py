@@ -3,8 +3,10 @@
 from collections import defaultdict, Counter
 from contextlib import contextmanager
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 import atexit
 import gzip
+import itertools
 import json
 import logging
 import os
@@ -16,8 +18,10 @@ import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
+import zlib
 
 sys.path.append('python')
 
@@ -26,13 +30,15 @@ from WMCore.FwkJobReport.Report import Report
 from WMCore.Services.Dashboard.DashboardAPI import DashboardAPI
 from WMCore.Storage.SiteLocalConfig import loadSiteLocalConfig
 
-import ROOT
+try:
+    from XRootD import client as xrdclient
+except ImportError:
+    xrdclient = None
 
-ROOT.gROOT.SetBatch(True)
-ROOT.PyConfig.IgnoreCommandLineOptions = True
-ROOT.gErrorIgnoreLevel = ROOT.kError
-
-from ROOT import TFile
+try:
+    import Chirp as chirp
+except ImportError:
+    chirp = None
 
 
 class Dash(object):
@@ -160,13 +166,66 @@ for prod in process.producers.values():
 """
 
 
+class SpawnTimer(object):
+
+    """Accounts the overhead of spawning subprocesses per task phase.
+
+    The overhead is the time spent setting up the output file and
+    starting the process, and reading its output back afterwards.  The
+    statistics are a plain dictionary to be included in the task report,
+    mapping each phase to the number of subprocesses, their overhead,
+    and their total wall time.
+    """
+
+    def __init__(self):
+        self.phase = 'setup'
+        self.stats = {}
+        self.__lock = threading.Lock()
+
+    def add(self, overhead, wall):
+        with self.__lock:
+            stats = self.stats.setdefault(self.phase, {'count': 0, 'overhead': 0., 'wall': 0.})
+            stats['count'] += 1
+            stats['overhead'] += overhead
+            stats['wall'] += wall
+
+
+spawns = SpawnTimer()
+
+
+class EndpointTimer(object):
+
+    """Accounts the stage-in and stage-out attempts per storage endpoint.
+
+    The statistics are a plain dictionary to be included in the task
+    report, mapping each input or output URL tried to the number of
+    successful and failed attempts, and their total time.  They are used
+    by the master to order the URLs passed to subsequent tasks.
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.__lock = threading.Lock()
+
+    def add(self, url, success, start):
+        with self.__lock:
+            stats = self.stats.setdefault(url, {'success': 0, 'failure': 0, 'time': 0.})
+            stats['success' if success else 'failure'] += 1
+            stats['time'] += time.time() - start
+
+
+endpoints = EndpointTimer()
+
+
 def run_subprocess(*args, **kwargs):
     logger.info("executing '{}'".format(" ".join(*args)))
 
     retry = kwargs.pop('retry', {})
     capture = kwargs.pop('capture', False)
 
+    start = time.time()
     outfd, outfn = tempfile.mkstemp()
+    os.close(outfd)
 
     logger.debug("using {} to store command output".format(outfn))
 
@@ -175,7 +234,9 @@ def run_subprocess(*args, **kwargs):
         kwargs['stderr'] = subprocess.STDOUT
         p = subprocess.Popen(*args, **kwargs)
 
+    spawned = time.time()
     _, _ = p.communicate()
+    finished = time.time()
 
     p.stdout = ""
     with open(outfn, 'r') as fd:
@@ -186,6 +247,9 @@ def run_subprocess(*args, **kwargs):
                     p.stdout += line
     os.unlink(outfn)
 
+    end = time.time()
+    spawns.add(spawned - start + end - finished, end - start)
+
     if p.returncode in retry:
         logger.info("retrying command")
         if retry[p.returncode] > 0:
@@ -196,21 +260,108 @@ def run_subprocess(*args, **kwargs):
     return p
 
 
-def calculate_alder32(data):
-    """Try to calculate checksums for output files.
-    """
+xrootd_sessions = {}
 
-    for fn in data['files']['output_info'].keys():
-        checksum = '0'
-        try:
-            p = subprocess.Popen(['edmFileUtil', '-a', fn], stdout=subprocess.PIPE)
-            stdout = p.communicate()[0]
+# XrdCl status codes of socket and connection errors, and of operations
+# that timed out
+xrootd_unreachable = set(range(101, 111) + [206])
 
-            if p.returncode == 0:
-                checksum = stdout.split()[-2]
-        except Exception:
-            pass
-        data['files']['output_info'][fn]['adler32'] = checksum
+
+chirp_sessions = {}
+
+
+def chirp_stat(server, path):
+    """Returns the size of `path` on the Chirp `server`, or `None` if it
+    cannot be accessed.
+
+    Keeps one connection per server when the Chirp python bindings are
+    available, and falls back to the `chirp` executable otherwise.
+    """
+    if chirp:
+        try:
+            if server not in chirp_sessions:
+                chirp_sessions[server] = chirp.Client(server, authentication=['globus'], timeout=900)
+            return chirp_sessions[server].stat(path).size
+        except Exception as e:
+            chirp_sessions.pop(server, None)
+            logger.info("chirp stat of {0} on {1} failed: {2}".format(path, server, e))
+
+    args = [
+        os.path.join(os.environ.get("PARROT_PATH", "bin"), "chirp"),
+        "--timeout",
+        "900",
+        server,
+        "stat",
+        path
+    ]
+    p = run_subprocess(args, capture=True)
+    match = re.search(r"[Ss]ize:\s*([0-9]*)", p.stdout)
+    if p.returncode != 0 or not match:
+        return None
+    return int(match.groups()[0])
+
+
+def xrootd_stat(server, path, debug=False):
+    """Returns the size of `path` on the XrootD `server`, or `None` if it
+    cannot be accessed.
+
+    Keeps one session per server when the XrootD python bindings are
+    available, and falls back to `xrdfs` otherwise, or if the server
+    could not be reached through the session.
+    """
+    path = '/' + path.lstrip('/')
+    if xrdclient:
+        if server not in xrootd_sessions:
+            xrootd_sessions[server] = xrdclient.FileSystem('root://' + server)
+        status, info = xrootd_sessions[server].stat(path, timeout=300)
+        if status.ok:
+            return info.size
+        logger.info("xrootd stat of {0} on {1} failed: {2}".format(path, server, status.message))
+        if status.code not in xrootd_unreachable:
+            return None
+        xrootd_sessions.pop(server, None)
+
+    timeout = '300'  # if the server is bogus, xrdfs hangs instead of returning an error
+    args = [
+        "timeout",
+        timeout,
+        "xrdfs",
+        server,
+        "stat",
+        path
+    ]
+    if debug:
+        args = ["env", "XRD_LOGLEVEL=Debug"] + args
+    p = run_subprocess(args, retry={53: 5}, capture=True)
+    match = re.search(r"[Ss]ize:\s*([0-9]*)", p.stdout)
+    if p.returncode != 0 or not match:
+        return None
+    return int(match.groups()[0])
+
+
+def checksum(filename, target=None, blocksize=1 << 20):
+    """Calculate the adler32 checksum of a file.
+
+    If `target` is given, the file is copied there at the same time, so
+    that it only has to be read once.
+    """
+    value = 1
+    out = open(target, 'wb') if target else None
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                block = f.read(blocksize)
+                if not block:
+                    break
+                value = zlib.adler32(block, value)
+                if out:
+                    out.write(block)
+    finally:
+        if out:
+            out.close()
+    if target:
+        shutil.copystat(filename, target)
+    return '{0:08x}'.format(value & 0xffffffff)
 
 
 def check_execution(exitcode, update=None, timing=None):
@@ -243,6 +394,8 @@ def check_execution(exitcode, update=None, timing=None):
     def decorator(fct):
         def wrapper(data, *args, **kwargs):
             ecode = kwargs.pop('exitcode', exitcode)
+            phase = spawns.phase
+            spawns.phase = fct.func_name
             try:
                 result = fct(data, *args, **kwargs)
             except Exception:
@@ -254,6 +407,7 @@ def check_execution(exitcode, update=None, timing=None):
                 logger.error("call to '{}' failed, exiting with exit code {}".format(fct.func_name, ecode))
                 sys.exit(ecode)
             finally:
+                spawns.phase = phase
                 if timing:
                     data['task_timing'][timing] = int(datetime.now().strftime('%s'))
             return result
@@ -271,65 +425,45 @@ def check_output(config, localname, remotename):
     If file, XrootD, or Chirp are not in the output access methods,
     return True.
     """
-    def compare(stat, file):
-        # If there's no local file, there's nothing to compare
-        if not os.path.isfile(file):
+    def compare_size(remote, file):
+        try:
+            size = os.stat(file).st_size
+        except OSError:
+            # If there's no local file, there's nothing to compare
             return False
 
-        size = os.path.getsize(file)
-        match = re.search("[Ss]ize:\s*([0-9]*)", stat)
-        if match:
-            if int(size) == int(match.groups()[0]):
-                return True
-            else:
-                logger.error("size mismatch after transfer")
-                logger.debug("remote size: {0}".format(match.groups()[0]))
-                logger.debug("local size: {0}".format(size))
-                return False
+        if remote is None:
+            raise RuntimeError('checking output for {0} failed'.format(file))
+        elif size == remote:
+            return True
         else:
-            raise RuntimeError('checking output for {0} failed: {1}'.format(file, stat))
+            logger.error("size mismatch after transfer")
+            logger.debug("remote size: {0}".format(remote))
+            logger.debug("local size: {0}".format(size))
+            return False
 
     for output in config['output']:
         if output.startswith('file://'):
-            path = output.replace('file://', '')
-            args = [
-                "stat",
-                os.path.join(path, remotename)
-            ]
-            p = run_subprocess(args, retry={53: 5}, capture=True)
+            path = os.path.join(output.replace('file://', ''), remotename)
+            try:
+                remote = os.stat(path).st_size
+            except OSError as e:
+                logger.info("stat of {0} failed: {1}".format(path, e))
+                remote = None
             try:
-                return compare(p.stdout, localname)
+                return compare_size(remote, localname)
             except RuntimeError as e:
                 logger.error(e)
         if output.startswith('root://'):
             server, path = re.match("root://([a-zA-Z0-9:.\-]+)/(.*)", output).groups()
-            timeout = '300'  # if the server is bogus, xrdfs hangs instead of returning an error
-            args = [
-                "timeout",
-                timeout,
-                "xrdfs",
-                server,
-                "stat",
-                os.path.join(path, remotename)
-            ]
-            p = run_subprocess(args, retry={53: 5}, capture=True)
             try:
-                return compare(p.stdout, localname)
+                return compare_size(xrootd_stat(server, os.path.join(path, remotename)), localname)
             except RuntimeError as e:
                 logger.error(e)
-        elif output.startswith("chirp://"):
+        if output.startswith('chirp://'):
             server, path = re.match("chirp://([a-zA-Z0-9:.\-]+)/(.*)", output).groups()
-            args = [
-                os.path.join(os.environ.get("PARROT_PATH", "bin"), "chirp"),
-                "--timeout",
-                "900",
-                server,
-                "stat",
-                os.path.join(path, remotename)
-            ]
-            p = run_subprocess(args, capture=True)
             try:
-                return compare(p.stdout, localname)
+                return compare_size(chirp_stat(server, os.path.join(path, remotename)), localname)
             except RuntimeError as e:
                 logger.error(e)
 
@@ -338,7 +472,10 @@ def check_output(config, localname, remotename):
 
 @check_execution(exitcode=211, update={'stageout_exit_code': 211, 'output_size': 0}, timing='stage_out_end')
 def check_outputs(data, config):
+    verified = config.get('verified output files', [])
     for local, remote in config['output files']:
+        if local in verified:
+            continue
         if not check_output(config, local, remote):
             raise IOError("could not verify output file '{}'".format(remote))
 
@@ -367,12 +504,289 @@ def check_parrot_cache(data):
                     data['cache']['type'] = 0
 
 
+def stage_in(config, env, file, inputs, fast_track=False):
+    """Find a way to access a single input file.
+
+    Tries to access the file via the access methods in `inputs`, in the
+    order specified, until one is successful.  With `fast_track`, xrootd
+    access is not verified before using it.
+
+    Returns the filename to pass to the executable, or `None` if no
+    access method succeeded, the last access method tried (`None` if the
+    file was transferred by WQ or is accessed via AAA), and the transfer
+    statistics.
+    """
+    transfers = defaultdict(Counter)
+
+    # If the file has been transferred by WQ, there's no need to
+    # monkey around with the input list
+    if os.path.exists(os.path.basename(file)):
+        filename = 'file:' + os.path.basename(file)
+        logger.info("WQ transfer of input file {} detected".format(file))
+        transfers['wq']['stage-in success'] += 1
+        return filename, None, transfers
+
+    # When the config specifies no "input," this implies to use
+    # AAA to access data in, e.g., DBS
+    if len(inputs) == 0:
+        filename = file
+        logger.info("AAA access to input file {} detected".format(file))
+        transfers['root']['stage-in success'] += 1
+        return filename, None, transfers
+
+    # Since we didn't find the file already here and we're not
+    # using AAA, we need to go through the list of inputs and find
+    # one that will allow us to access the file
+    for input in inputs:
+        start = time.time()
+        if input.startswith('file://'):
+            path = os.path.join(input.replace('file://', '', 1), file)
+            logger.info("Trying local access method")
+            if os.path.exists(path) and os.access(path, os.R_OK):
+                filename = 'file:' + path
+                logger.info("Local access to input file {} detected".format(path))
+                transfers['file']['stage-in success'] += 1
+                endpoints.add(input, True, start)
+                return filename, input, transfers
+            else:
+                logger.info("Local access to input file unavailable")
+                transfers['file']['stage-in failure'] += 1
+                # depends on the worker, not the endpoint
+                continue
+        elif input.startswith('root://'):
+            logger.info("Trying xrootd access method")
+            server, path = re.match("root://([a-zA-Z0-9:.\-]+)/(.*)", input).groups()
+
+            if fast_track or xrootd_stat(server, os.path.join(path, file), debug=True) is not None:
+                if config['disable streaming']:
+                    logger.info("streaming has been disabled, attempting stage-in")
+                    args = [
+                        "env",
+                        "XRD_LOGLEVEL=Debug",
+                        "xrdcp",
+                        os.path.join(input, file.lstrip('/')),
+                        os.path.basename(file)
+                    ]
+
+                    p = run_subprocess(args)
+                    if p.returncode == 0:
+                        filename = 'file:' + os.path.basename(file)
+                        transfers['xrdcp']['stage-in success'] += 1
+                        endpoints.add(input, True, start)
+                        return filename, input, transfers
+                    else:
+                        transfers['xrdcp']['stage-in failure'] += 1
+                else:
+                    logger.info("will stream using xrootd instead of copying")
+                    filename = os.path.join(input, file)
+                    transfers['root']['stage-in success'] += 1
+                    endpoints.add(input, True, start)
+                    return filename, input, transfers
+            else:
+                logger.info("xrootd access to input file unavailable")
+                # no transfer was attempted
+                continue
+        elif input.startswith('srm://') or input.startswith('gsiftp://'):
+            logger.info("Trying srm access method")
+            prg = []
+            if len(os.environ["LOBSTER_LCG_CP"]) > 0 and not input.startswith('gsiftp://'):
+                prg = [os.environ["LOBSTER_LCG_CP"], "-b", "-v", "-D", "srmv2", "--sendreceive-timeout", "600"]
+            elif len(os.environ["LOBSTER_GFAL_COPY"]) > 0:
+                # FIXME gfal is very picky about its environment
+                prg = [os.environ["LOBSTER_GFAL_COPY"]]
+
+            args = prg + [
+                os.path.join(input, file),
+                os.path.basename(file)
+            ]
+
+            pruned_env = dict(env)
+            for k in ['LD_LIBRARY_PATH', 'PATH']:
+                pruned_env[k] = ':'.join([x for x in os.environ[k].split(':') if 'CMSSW' not in x])
+
+            p = run_subprocess(args, env=pruned_env)
+            if p.returncode == 0:
+                logger.info('Successfully copied input with SRM')
+                filename = 'file:' + os.path.basename(file)
+                transfers['srm']['stage-in success'] += 1
+                endpoints.add(input, True, start)
+                return filename, input, transfers
+            else:
+                logger.error('Unable to copy input with SRM')
+                transfers['srm']['stage-in failure'] += 1
+        elif input.startswith("chirp://"):
+            logger.info("Trying chirp access method")
+            server, path = re.match("chirp://([a-zA-Z0-9:.\-]+)/(.*)", input).groups()
+            remotename = os.path.join(path, file)
+
+            args = [
+                os.path.join(os.environ.get("PARROT_PATH", "bin"), "chirp_get"),
+                "-a",
+                "globus",
+                "-d",
+                "all",
+                "--timeout",
+                "900",
+                server,
+                remotename,
+                os.path.basename(remotename)
+            ]
+            p = run_subprocess(args, env=env)
+            if p.returncode == 0:
+                logger.info('Successfully copied input with Chirp')
+                filename = 'file:' + os.path.basename(file)
+                transfers['chirp']['stage-in success'] += 1
+                endpoints.add(input, True, start)
+                return filename, input, transfers
+            else:
+                logger.error('Unable to copy input with Chirp')
+                transfers['chirp']['stage-in failure'] += 1
+        else:
+            logger.warning('skipping unhandled stage-in method: {0}'.format(input))
+            continue
+        endpoints.add(input, False, start)
+
+    return None, input, transfers
+
+
+class StagedInputs(object):
+
+    """Input files made available by a stage-in running in the background.
+
+    Used to overlap stage-in and processing: the files are handed out in
+    batches, in order, as their transfers finish.  Once the stage-in
+    finished, `end` holds the time it did, and `failed` whether it was
+    interrupted by an error.
+    """
+
+    def __init__(self):
+        self.__staged = []
+        self.__done = False
+        self.__condition = threading.Condition()
+        self.end = None
+        self.failed = False
+
+    def put(self, filename):
+        with self.__condition:
+            self.__staged.append(filename)
+            self.__condition.notify_all()
+
+    def finish(self, failed=False):
+        with self.__condition:
+            self.end = int(datetime.now().strftime('%s'))
+            self.failed = failed
+            self.__done = True
+            self.__condition.notify_all()
+
+    def wait(self):
+        """Wait for the first staged file.  Returns `False` if the
+        stage-in finished without any file.
+        """
+        with self.__condition:
+            while not self.__done and not self.__staged:
+                # Waiting with a timeout keeps the main thread interruptible
+                self.__condition.wait(1)
+            return len(self.__staged) > 0
+
+    def take(self, everything=False):
+        """Returns the files staged since the last call, waiting for at
+        least one.  With `everything` set, waits for the stage-in to
+        finish.  An empty list signals that no files are left.
+        """
+        with self.__condition:
+            while not self.__done and (everything or not self.__staged):
+                self.__condition.wait(1)
+            batch, self.__staged = self.__staged, []
+            return batch
+
+
+def pipelined(config):
+    """Check if processing should overlap with the stage-in.
+
+    Only worthwhile when input files are copied to the worker, i.e., with
+    streaming disabled, or input access via SRM or Chirp only.
+    """
+    copied = config['disable streaming'] or (
+        len(config['input']) > 0
+        and all(i.startswith(('srm://', 'gsiftp://', 'chirp://')) for i in config['input']))
+    return 'cmsRun' in config['executable'] \
+        and config.get('pipeline', {}).get('runs', 1) > 1 \
+        and copied \
+        and not config['gridpack'] \
+        and config['mask']['events'] < 0 \
+        and len(config['mask']['files']) > 1
+
+
+def stage_inputs(data, config, env, files):
+    """Stage in `files`, yielding the filenames to use for the successful
+    transfers in the order of `files`.
+
+    Adds the transfer statistics to `data`, and the file map to `config`.
+    """
+    # Updated while processing the results, so that pending transfers
+    # pick up the fast track
+    state = {'inputs': list(config['input']), 'fast track': False}
+    successes = defaultdict(int)
+
+    def attempt(file):
+        return stage_in(config, env, file, state['inputs'], state['fast track'])
+
+    threads = min(config.get('stage-in threads', 1), len(files))
+    if threads > 1:
+        logger.info("staging in {0} files with {1} parallel transfers".format(len(files), threads))
+        pool = ThreadPool(threads)
+        results = pool.imap(attempt, files)
+    else:
+        pool = None
+        results = itertools.imap(attempt, files)
+
+    try:
+        for file in files:
+            filename, input, transfers = next(results)
+
+            for protocol, counts in transfers.items():
+                data['transfers'][protocol].update(counts)
+
+            if filename is None:
+                logger.critical('no stage out method succeeded for: {0}'.format(file))
+                continue
+
+            # Replace rather than update the file map, as it may be read
+            # by another thread when processing is pipelined
+            mapping = dict(config['file map'])
+            mapping[filename] = file
+            config['file map'] = mapping
+
+            if input is not None:
+                successes[input] += 1
+
+                if config.get('accelerate stage-in', 0) > 0 and not state['fast track']:
+                    method, count = max(successes.items(), key=lambda (x, y): y)
+                    if count > config['accelerate stage-in']:
+                        logger.info("Bypassing further access checks and using '{0}' for input".format(method))
+                        config['input'] = [method]
+                        state['inputs'] = [method]
+                        state['fast track'] = True
+
+            yield filename
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
 @check_execution(exitcode=179, timing='stage_in_end')
 def copy_inputs(data, config, env):
     """Copies input files if desired.
 
     Tries to access each input file via the specified access methods.
     Access methods are traversed in the order specified until one is successful.
+    With 'stage-in threads' set, several files are staged in at the same
+    time, while the order of input files is preserved.
+
+    When processing is pipelined, only waits for the first input file,
+    and returns a `StagedInputs` object that receives the remaining
+    files as the stage-in continues in the background.
     """
     config['file map'] = {}
 
@@ -380,172 +794,181 @@ def copy_inputs(data, config, env):
         return
 
     files = list(config['mask']['files'])
-    config['mask']['files'] = []
+    staged = stage_inputs(data, config, env, files)
 
-    fast_track = False
-    successes = defaultdict(int)
+    if pipelined(config):
+        inputs = StagedInputs()
+        config['mask']['files'] = []
 
-    for file in files:
-        # If the file has been transferred by WQ, there's no need to
-        # monkey around with the input list
-        if os.path.exists(os.path.basename(file)):
-            filename = 'file:' + os.path.basename(file)
-            config['mask']['files'].append(filename)
-            config['file map'][filename] = file
+        def feed():
+            try:
+                for filename in staged:
+                    config['mask']['files'] = config['mask']['files'] + [filename]
+                    inputs.put(filename)
+            except Exception:
+                logger.error("stage-in of input files failed while processing")
+                with mangler.output('trace'):
+                    for l in traceback.format_exc().splitlines():
+                        logger.error(l)
+                inputs.finish(failed=True)
+            else:
+                inputs.finish()
 
-            logger.info("WQ transfer of input file {} detected".format(file))
-            data['transfers']['wq']['stage-in success'] += 1
-            continue
+        thread = threading.Thread(target=feed)
+        thread.daemon = True
+        thread.start()
 
-        # When the config specifies no "input," this implies to use
-        # AAA to access data in, e.g., DBS
-        if len(config['input']) == 0:
-            config['mask']['files'].append(file)
-            config['file map'][file] = file
-            logger.info("AAA access to input file {} detected".format(file))
-            data['transfers']['root']['stage-in success'] += 1
-            continue
+        if not inputs.wait():
+            raise RuntimeError("no stage-in method succeeded")
+        logger.info("starting processing while input files are staged in")
+        return inputs
 
-        # Since we didn't find the file already here and we're not
-        # using AAA, we need to go through the list of inputs and find
-        # one that will allow us to access the file
-        for input in config['input']:
-            if input.startswith('file://'):
-                path = os.path.join(input.replace('file://', '', 1), file)
-                logger.info("Trying local access method")
-                if os.path.exists(path) and os.access(path, os.R_OK):
-                    filename = 'file:' + path
-                    config['mask']['files'].append(filename)
-                    config['file map'][filename] = file
-
-                    logger.info("Local access to input file {} detected".format(path))
-                    data['transfers']['file']['stage-in success'] += 1
-                    break
-                else:
-                    logger.info("Local access to input file unavailable")
-                    data['transfers']['file']['stage-in failure'] += 1
-            elif input.startswith('root://'):
-                logger.info("Trying xrootd access method")
-                server, path = re.match("root://([a-zA-Z0-9:.\-]+)/(.*)", input).groups()
-                timeout = '300'  # if the server is bogus, xrdfs hangs instead of returning an error
-                args = [
-                    "env",
-                    "XRD_LOGLEVEL=Debug",
-                    "timeout",
-                    timeout,
-                    "xrdfs",
-                    server,
-                    "stat",
-                    os.path.join(path, file)
-                ]
-
-                if fast_track or run_subprocess(args, retry={53: 5}).returncode == 0:
-                    if config['disable streaming']:
-                        logger.info("streaming has been disabled, attempting stage-in")
-                        args = [
-                            "env",
-                            "XRD_LOGLEVEL=Debug",
-                            "xrdcp",
-                            os.path.join(input, file.lstrip('/')),
-                            os.path.basename(file)
-                        ]
-
-                        p = run_subprocess(args)
-                        if p.returncode == 0:
-                            filename = 'file:' + os.path.basename(file)
-                            config['mask']['files'].append(filename)
-                            config['file map'][filename] = file
-                            data['transfers']['xrdcp']['stage-in success'] += 1
-                            break
-                        else:
-                            data['transfers']['xrdcp']['stage-in failure'] += 1
-                    else:
-                        logger.info("will stream using xrootd instead of copying")
-                        filename = os.path.join(input, file)
-                        config['mask']['files'].append(filename)
-                        config['file map'][filename] = file
-                        data['transfers']['root']['stage-in success'] += 1
-                        break
-                else:
-                    logger.info("xrootd access to input file unavailable")
-            elif input.startswith('srm://') or input.startswith('gsiftp://'):
-                logger.info("Trying srm access method")
-                prg = []
-                if len(os.environ["LOBSTER_LCG_CP"]) > 0 and not input.startswith('gsiftp://'):
-                    prg = [os.environ["LOBSTER_LCG_CP"], "-b", "-v", "-D", "srmv2", "--sendreceive-timeout", "600"]
-                elif len(os.environ["LOBSTER_GFAL_COPY"]) > 0:
-                    # FIXME gfal is very picky about its environment
-                    prg = [os.environ["LOBSTER_GFAL_COPY"]]
-
-                args = prg + [
-                    os.path.join(input, file),
-                    os.path.basename(file)
-                ]
-
-                pruned_env = dict(env)
-                for k in ['LD_LIBRARY_PATH', 'PATH']:
-                    pruned_env[k] = ':'.join([x for x in os.environ[k].split(':') if 'CMSSW' not in x])
-
-                p = run_subprocess(args, env=pruned_env)
-                if p.returncode == 0:
-                    logger.info('Successfully copied input with SRM')
-                    filename = 'file:' + os.path.basename(file)
-                    config['mask']['files'].append(filename)
-                    config['file map'][filename] = file
-                    data['transfers']['srm']['stage-in success'] += 1
-                    break
-                else:
-                    logger.error('Unable to copy input with SRM')
-                    data['transfers']['srm']['stage-in failure'] += 1
-            elif input.startswith("chirp://"):
-                logger.info("Trying chirp access method")
-                server, path = re.match("chirp://([a-zA-Z0-9:.\-]+)/(.*)", input).groups()
-                remotename = os.path.join(path, file)
-
-                args = [
-                    os.path.join(os.environ.get("PARROT_PATH", "bin"), "chirp_get"),
+    config['mask']['files'] = list(staged)
+
+    if not config['mask']['files']:
+        raise RuntimeError("no stage-in method succeeded")
+
+    logger.info("modified input files")
+    with mangler.output('input'):
+        for fn in config['mask']['files']:
+            logger.debug(fn)
+
+
+@check_execution(exitcode=179)
+def check_inputs(data, inputs):
+    """Check the outcome of a stage-in that continued while processing.
+
+    Records when the stage-in actually finished as
+    `stage_in_background_end`, and fails if it was interrupted by an
+    error.  `stage_in_end` is kept as the time processing could start, as
+    the time between it and the end of the epilogue is taken as the
+    processing time.
+    """
+    if inputs is None:
+        return
+    if inputs.end:
+        data['task_timing']['stage_in_background_end'] = inputs.end
+    if inputs.failed:
+        raise RuntimeError("stage-in failed while processing")
+
+
+def run_checksummed(args, filename, env):
+    """Run the transfer command `args` while calculating the checksum of
+    `filename`.
+
+    The file is read for the checksum while the transfer command runs,
+    so that the checksum does not add to the duration of the stage-out.
+    If this fails, the checksum is calculated after the transfer.
+    Returns the process and the checksum.
+    """
+    pool = ThreadPool(1)
+    result = pool.apply_async(checksum, (filename,))
+    pool.close()
+    p = run_subprocess(args, env=env)
+    try:
+        return p, result.get()
+    except Exception as e:
+        logger.error("could not calculate checksum of {0} during the transfer: {1}".format(filename, e))
+    return p, checksum(filename)
+
+
+def stage_out(config, env, localname, remotename):
+    """Stage out a single output file.
+
+    Attempts the stage-out methods in the order specified until one is
+    successful.  The adler32 checksum is calculated while copying for
+    local stage-out, and alongside the transfer command otherwise.
+
+    Returns the storage element the file was staged out to, or `None` if
+    no method succeeded, the checksum, and the transfer statistics.
+    """
+    server_re = re.compile("[a-zA-Z]+://([a-zA-Z0-9:.\-]+)/")
+    transfers = defaultdict(Counter)
+    adler32 = None
+
+    for output in config['output']:
+        start = time.time()
+        if output.startswith('file://'):
+            rn = os.path.join(output.replace('file://', ''), remotename)
+            if os.path.isdir(os.path.dirname(rn)):
+                logger.info("local access detected")
+                logger.info("attempting stage-out with a checksummed copy from '{0}' to '{1}'".format(localname, rn))
+                try:
+                    adler32 = checksum(localname, rn)
+                    if check_output(config, localname, remotename):
+                        transfers['file']['stageout success'] += 1
+                        endpoints.add(output, True, start)
+                        return config['default se'], adler32, transfers
+                except Exception as e:
+                    logger.critical(e)
+                    transfers['file']['stageout failure'] += 1
+            else:
+                # depends on the worker, not the endpoint
+                continue
+        elif output.startswith('srm://') or output.startswith('gsiftp://'):
+            protocol = output[:output.find(':')]
+            prg = []
+            if len(os.environ["LOBSTER_LCG_CP"]) > 0 and output.startswith('srm://'):
+                prg = [os.environ["LOBSTER_LCG_CP"], "-b", "-v", "-D", "srmv2", "--sendreceive-timeout", "600"]
+            elif len(os.environ["LOBSTER_GFAL_COPY"]) > 0:
+                # FIXME gfal is very picky about its environment
+                prg = [os.environ["LOBSTER_GFAL_COPY"]]
+            else:
+                # no tool to attempt a transfer on this worker
+                transfers[protocol]['stageout failure'] += 1
+                continue
+
+            args = prg + [
+                "file://" + os.path.join(os.getcwd(), localname),
+                os.path.join(output, remotename)
+            ]
+
+            pruned_env = dict(env)
+            for k in ['LD_LIBRARY_PATH', 'PATH']:
+                pruned_env[k] = ':'.join([x for x in os.environ[k].split(':') if 'CMSSW' not in x])
+
+            ldpath = pruned_env.get('LD_LIBRARY_PATH', '')
+            if ldpath != '':
+                ldpath += ':'
+            ldpath += os.path.join(os.path.dirname(os.path.dirname(prg[0])), 'lib64')
+            pruned_env['LD_LIBRARY_PATH'] = ldpath
+
+            p, adler32 = run_checksummed(args, localname, env=pruned_env)
+            if p.returncode == 0 and check_output(config, localname, remotename):
+                transfers[protocol]['stageout success'] += 1
+                match = server_re.match(args[-1])
+                endpoints.add(output, True, start)
+                return match.group(1) if match else config['default se'], adler32, transfers
+            else:
+                transfers[protocol]['failure'] += 1
+        elif output.startswith("chirp://"):
+            server, path = re.match("chirp://([a-zA-Z0-9:.\-]+)/(.*)", output).groups()
+
+            args = [os.path.join(os.environ.get("PARROT_PATH", "bin"), "chirp_put"),
                     "-a",
                     "globus",
                     "-d",
                     "all",
                     "--timeout",
                     "900",
+                    localname,
                     server,
-                    remotename,
-                    os.path.basename(remotename)
-                ]
-                p = run_subprocess(args, env=env)
-                if p.returncode == 0:
-                    logger.info('Successfully copied input with Chirp')
-                    filename = 'file:' + os.path.basename(file)
-                    config['mask']['files'].append(filename)
-                    config['file map'][filename] = file
-                    data['transfers']['chirp']['stage-in success'] += 1
-                    break
-                else:
-                    logger.error('Unable to copy input with Chirp')
-                    data['transfers']['chirp']['stage-in failure'] += 1
+                    os.path.join(path, remotename)]
+
+            p, adler32 = run_checksummed(args, localname, env=env)
+            if p.returncode == 0 and check_output(config, localname, remotename):
+                transfers['chirp']['stageout success'] += 1
+                match = server_re.match(args[-1])
+                endpoints.add(output, True, start)
+                return match.group(1) if match else config['default se'], adler32, transfers
             else:
-                logger.warning('skipping unhandled stage-in method: {0}'.format(input))
+                transfers['chirp']['stageout failure'] += 1
         else:
-            logger.critical('no stage out method succeeded for: {0}'.format(file))
-            successes[input] -= 1
-        successes[input] += 1
-
-        if config.get('accelerate stage-in', 0) > 0 and not fast_track:
-            method, count = max(successes.items(), key=lambda (x, y): y)
-            if count > config['accelerate stage-in']:
-                logger.info("Bypassing further access checks and using '{0}' for input".format(method))
-                config['input'] = [method]
-                fast_track = True
-
-    if not config['mask']['files']:
-        raise RuntimeError("no stage-in method succeeded")
+            logger.warning('skipping unhandled stage-out method: {0}'.format(output))
+            continue
+        endpoints.add(output, False, start)
 
-    logger.info("modified input files")
-    with mangler.output('input'):
-        for fn in config['mask']['files']:
-            logger.debug(fn)
+    return None, adler32, transfers
 
 
 @check_execution(exitcode=210, update={'stageout_exit_code': 210}, timing='stage_out_end')
@@ -556,16 +979,16 @@ def copy_outputs(data, config, env):
     transferring them.  Otherwise, attempt stage-out methods in the order
     specified in the config['storage']['output'] section of the user's
     Lobster configuration. For successful tasks, file sizes are added up
-    and inserted into the task data.
+    and inserted into the task data.  With 'stage-out threads' set,
+    several files are staged out at the same time.
     """
     outsize = 0
     outsize_bare = 0
 
-    server_re = re.compile("[a-zA-Z]+://([a-zA-Z0-9:.\-]+)/")
     target_se = []
     default_se = config['default se']
 
-    transferred = []
+    outputs = []
     for localname, remotename in config['output files']:
         # prevent stageout of data for failed tasks
         if os.path.exists(localname) and data['exe_exit_code'] != 0:
@@ -587,84 +1010,37 @@ def copy_outputs(data, config, env):
             except Exception as e:
                 logger.error("file size detection for {} failed with: {}".format(localname, e))
 
-        for output in config['output']:
-            if output.startswith('file://'):
-                rn = os.path.join(output.replace('file://', ''), remotename)
-                if os.path.isdir(os.path.dirname(rn)):
-                    logger.info("local access detected")
-                    logger.info("attempting stage-out with `shutil.copy2('{0}', '{1}')`".format(localname, rn))
-                    try:
-                        shutil.copy2(localname, rn)
-                        if check_output(config, localname, remotename):
-                            transferred.append(localname)
-                            target_se.append(default_se)
-                            data['transfers']['file']['stageout success'] += 1
-                            break
-                    except Exception as e:
-                        logger.critical(e)
-                        data['transfers']['file']['stageout failure'] += 1
-            elif output.startswith('srm://') or output.startswith('gsiftp://'):
-                protocol = output[:output.find(':')]
-                prg = []
-                if len(os.environ["LOBSTER_LCG_CP"]) > 0 and output.startswith('srm://'):
-                    prg = [os.environ["LOBSTER_LCG_CP"], "-b", "-v", "-D", "srmv2", "--sendreceive-timeout", "600"]
-                elif len(os.environ["LOBSTER_GFAL_COPY"]) > 0:
-                    # FIXME gfal is very picky about its environment
-                    prg = [os.environ["LOBSTER_GFAL_COPY"]]
-                else:
-                    data['transfers'][protocol]['stageout failure'] += 1
-                    continue
-
-                args = prg + [
-                    "file://" + os.path.join(os.getcwd(), localname),
-                    os.path.join(output, remotename)
-                ]
-
-                pruned_env = dict(env)
-                for k in ['LD_LIBRARY_PATH', 'PATH']:
-                    pruned_env[k] = ':'.join([x for x in os.environ[k].split(':') if 'CMSSW' not in x])
-
-                ldpath = pruned_env.get('LD_LIBRARY_PATH', '')
-                if ldpath != '':
-                    ldpath += ':'
-                ldpath += os.path.join(os.path.dirname(os.path.dirname(prg[0])), 'lib64')
-                pruned_env['LD_LIBRARY_PATH'] = ldpath
-
-                p = run_subprocess(args, env=pruned_env)
-                if p.returncode == 0 and check_output(config, localname, remotename):
-                    transferred.append(localname)
-                    match = server_re.match(args[-1])
-                    if match:
-                        target_se.append(match.group(1))
-                    data['transfers'][protocol]['stageout success'] += 1
-                    break
-                else:
-                    data['transfers'][protocol]['failure'] += 1
-            elif output.startswith("chirp://"):
-                server, path = re.match("chirp://([a-zA-Z0-9:.\-]+)/(.*)", output).groups()
-
-                args = [os.path.join(os.environ.get("PARROT_PATH", "bin"), "chirp_put"),
-                        "-a",
-                        "globus",
-                        "-d",
-                        "all",
-                        "--timeout",
-                        "900",
-                        localname,
-                        server,
-                        os.path.join(path, remotename)]
-                p = run_subprocess(args, env=env)
-                if p.returncode == 0 and check_output(config, localname, remotename):
-                    transferred.append(localname)
-                    match = server_re.match(args[-1])
-                    if match:
-                        target_se.append(match.group(1))
-                    data['transfers']['chirp']['stageout success'] += 1
-                    break
-                else:
-                    data['transfers']['chirp']['stageout failure'] += 1
-            else:
-                logger.warning('skipping unhandled stage-out method: {0}'.format(output))
+        outputs.append((localname, remotename))
+
+    def attempt(names):
+        return stage_out(config, env, *names)
+
+    threads = min(config.get('stage-out threads', 1), len(outputs))
+    if threads > 1:
+        logger.info("staging out {0} files with {1} parallel transfers".format(len(outputs), threads))
+        pool = ThreadPool(threads)
+        results = pool.map(attempt, outputs)
+        pool.close()
+        pool.join()
+    else:
+        results = map(attempt, outputs)
+
+    transferred = []
+    for (localname, remotename), (se, adler32, transfers) in zip(outputs, results):
+        for protocol, counts in transfers.items():
+            data['transfers'][protocol].update(counts)
+
+        if se is None:
+            continue
+        transferred.append(localname)
+        target_se.append(se)
+
+        for fn, info in data['files']['output_info'].items():
+            if adler32 and os.path.basename(fn) == os.path.basename(localname):
+                info['adler32'] = adler32
+
+    # outputs have been verified after their transfer
+    config['verified output files'] = transferred
 
     if set([ln for ln, _ in config['output files']]) - set(transferred):
         raise RuntimeError("no stage-out method succeeded")
@@ -828,6 +1204,20 @@ def extract_cmssw_times(log_filename, default=None):
     return (finit, fopen, first)
 
 
+def load_root():
+    """Import ROOT, set up for batch use.
+
+    Only needed to inspect output files, and loading ROOT takes a while.
+    """
+    import ROOT
+
+    ROOT.gROOT.SetBatch(True)
+    ROOT.PyConfig.IgnoreCommandLineOptions = True
+    ROOT.gErrorIgnoreLevel = ROOT.kError
+
+    return ROOT
+
+
 def get_bare_size(filename):
     """Get the output_bare_size.
 
@@ -837,7 +1227,7 @@ def get_bare_size(filename):
 
     Extracts Events->TTree::GetZipBytes()
     """
-    rootfile = TFile(filename, "READ")
+    rootfile = load_root().TFile(filename, "READ")
     if rootfile.IsZombie():
         raise IOError("Can't open ROOT file '{0}'".format(filename))
 
@@ -851,11 +1241,125 @@ def get_bare_size(filename):
     return size
 
 
+def merge_fwk_reports(data, previous):
+    """Add the framework report information of previous runs to `data`.
+
+    Parameters
+    ----------
+    data : dict
+        The task data, containing the information of the latest run.
+    previous : dict
+        The task data before the latest run, with the entries replaced
+        by `parse_fwk_report`.
+    """
+    files = data['files']
+    files['info'].update(previous['files']['info'])
+    files['skipped'] = previous['files']['skipped'] + files['skipped']
+
+    for fn, info in previous['files']['output_info'].items():
+        if fn not in files['output_info']:
+            files['output_info'][fn] = info
+            continue
+        current = files['output_info'][fn]
+        current['events'] = int(current['events']) + int(info['events'])
+        for run, lumis in info['runs'].items():
+            current['runs'].setdefault(run, [])
+            current['runs'][run] = list(lumis) + list(current['runs'][run])
+
+    for key in ('events_written', 'cpu_time', 'events_per_run'):
+        data[key] += previous[key]
+
+
+def run_pipelined(data, config, env, inputs):
+    """Run `cmsRun` over the input files while they are staged in.
+
+    Runs `cmsRun` sequentially, each time over the input files staged in
+    since the previous run started, with at most config['pipeline']['runs']
+    runs.  The framework reports of the runs are combined, and the outputs
+    merged with `merge_cfg.py` or `hadd`, like in merge tasks.  Returns
+    the process of the last run.
+    """
+    settings = config['pipeline']
+    runtime = config.get('task runtime')
+    start = time.time()
+
+    parts = defaultdict(list)
+    p = None
+    run = 0
+    while True:
+        run += 1
+        files = inputs.take(everything=run >= settings['runs'])
+        if not files:
+            break
+        if runtime and time.time() - start >= runtime:
+            logger.info("task runtime exceeded, not processing {0} remaining input files".format(len(files)))
+            break
+
+        logger.info("starting run {0} over {1} input files".format(run, len(files)))
+        with mangler.output('input'):
+            for fn in files:
+                logger.debug(fn)
+
+        subconfig = dict(config)
+        subconfig['mask'] = dict(config['mask'], files=files)
+        if runtime:
+            subconfig['task runtime'] = int(runtime - (time.time() - start))
+
+        pset_mod = config['pset'].replace(".py", "_mod{0}.py".format(run))
+        shutil.copy2(config['pset'], pset_mod)
+        edit_process_source(pset_mod, subconfig)
+
+        report = 'report_{0}.xml'.format(run)
+        cmd = [config['executable'], '-j', report, pset_mod]
+        cmd.extend([str(arg) for arg in config['arguments']])
+
+        p = run_subprocess(cmd, env=env)
+        logger.info("run {0} returned with exit code {1}.".format(run, p.returncode))
+        shutil.copy2(report, 'report.xml')
+
+        previous = dict(data)
+        previous['files'] = dict(data['files'])
+        if p.returncode != 0:
+            parse_fwk_report(data, config, report, exitcode=p.returncode)
+            merge_fwk_reports(data, previous)
+            return p
+
+        parse_fwk_report(data, config, report)
+        merge_fwk_reports(data, previous)
+
+        for localname, _ in config['output files']:
+            if os.path.exists(localname):
+                part = 'part{0}_{1}'.format(run, localname)
+                os.rename(localname, part)
+                parts[localname].append(part)
+
+    for localname, files in parts.items():
+        if len(files) == 1:
+            os.rename(files[0], localname)
+            continue
+
+        logger.info("merging {0} parts of {1}".format(len(files), localname))
+        if settings['edm output']:
+            cmd = ['cmsRun', 'merge_cfg.py', 'outputFile=' + localname,
+                   'inputFiles=' + ','.join('file:' + f for f in files)]
+        else:
+            cmd = ['hadd', '-n', '0', '-f', localname] + files
+        merge = run_subprocess(cmd, env=env)
+        if merge.returncode != 0:
+            raise RuntimeError("failed to merge parts of {0}".format(localname))
+        for f in files:
+            os.unlink(f)
+
+    return p
+
+
 @check_execution(exitcode=185, timing='processing_end')
-def run_command(data, config, env):
+def run_command(data, config, env, inputs=None):
     cmd = config['executable']
     args = config['arguments']
-    if 'cmsRun' in cmd:
+    if inputs is not None:
+        p = run_pipelined(data, config, env, inputs)
+    elif 'cmsRun' in cmd:
         pset = config['pset']
         pset_mod = pset.replace(".py", "_mod.py")
         shutil.copy2(pset, pset_mod)
@@ -875,7 +1379,8 @@ def run_command(data, config, env):
         if config.get('append inputs to args', False):
             cmd.extend([str(f) for f in config['mask']['files']])
 
-    p = run_subprocess(cmd, env=env)
+    if inputs is None:
+        p = run_subprocess(cmd, env=env)
     logger.info("executable returned with exit code {0}.".format(p.returncode))
     data['exe_exit_code'] = p.returncode
     data['task_exit_code'] = data['exe_exit_code']
@@ -884,9 +1389,13 @@ def run_command(data, config, env):
 
     if 'cmsRun' in config['executable']:
         if p.returncode == 0:
-            parse_fwk_report(data, config, 'report.xml')
-            calculate_alder32(data)
-        else:
+            # reports of pipelined runs have been parsed already
+            if inputs is None:
+                parse_fwk_report(data, config, 'report.xml')
+            # checksums are calculated during stage-out
+            for info in data['files']['output_info'].values():
+                info['adler32'] = '0'
+        elif inputs is None:
             parse_fwk_report(data, config, 'report.xml', exitcode=p.returncode)
     else:
         data['files']['info'] = dict((f, [0, []]) for f in config['file map'].values())
@@ -1049,6 +1558,7 @@ data = {
     'output_storage_element': '',
     'task_timing': {
         'stage_in_end': 0,
+        'stage_in_background_end': 0,
         'prologue_end': 0,
         'wrapper_start': 0,
         'wrapper_ready': 0,
@@ -1057,37 +1567,41 @@ data = {
         'stage_out_end': 0,
     },
     'events_per_run': 0,
-    'transfers': defaultdict(Counter)
+    'transfers': defaultdict(Counter),
+    'subprocess_overhead': spawns.stats,
+    'endpoints': endpoints.stats
 }
 
-configfile = sys.argv[1]
-with open(configfile) as f:
-    config = json.load(f)
+if __name__ == '__main__':
+    configfile = sys.argv[1]
+    with open(configfile) as f:
+        config = json.load(f)
 
-monitor.configure(config)
+    monitor.configure(config)
 
-atexit.register(send_final_dashboard_update, data, config)
-atexit.register(write_report, data)
-atexit.register(write_zipfiles, data)
+    atexit.register(send_final_dashboard_update, data, config)
+    atexit.register(write_report, data)
+    atexit.register(write_zipfiles, data)
 
-logger.info('data is {0}'.format(str(data)))
-env = os.environ
-env['X509_USER_PROXY'] = 'proxy'
+    logger.info('data is {0}'.format(str(data)))
+    env = os.environ
+    env['X509_USER_PROXY'] = 'proxy'
 
-extract_wrapper_times(data)
-copy_inputs(data, config, env)
+    extract_wrapper_times(data)
+    inputs = copy_inputs(data, config, env)
 
-logger.info("updated parameters are")
-with mangler.output("json"):
-    for l in json.dumps(config, sort_keys=True, indent=2).splitlines():
-        logger.debug(l)
+    logger.info("updated parameters are")
+    with mangler.output("json"):
+        for l in json.dumps(config, sort_keys=True, indent=2).splitlines():
+            logger.debug(l)
 
-send_initial_dashboard_update(data, config)
+    send_initial_dashboard_update(data, config)
 
-run_prologue(data, config, env)
-run_command(data, config, env)
-run_epilogue(data, config, env)
+    run_prologue(data, config, env)
+    run_command(data, config, env, inputs)
+    check_inputs(data, inputs)
+    run_epilogue(data, config, env)
 
-copy_outputs(data, config, env)
-check_outputs(data, config)
-check_parrot_cache(data)
+    copy_outputs(data, config, env)
+    check_outputs(data, config)
+    check_parrot_cache(data)
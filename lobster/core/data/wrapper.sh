@@ -25,20 +25,132 @@ log() {
 	fi
 }
 
+private_dir() {
+	# create the directory $1 only accessible by the current user, or
+	# verify that an existing one is
+	mkdir -m 700 "$1" 2> /dev/null
+	[ -d "$1" -a ! -L "$1" -a -O "$1" ] && [ "$(stat -c %a "$1")" = 700 ]
+}
+
+load_probes() {
+	# read the key=value lines of the cache, accepting only known keys
+	[ -n "$probe_cache" -a -r "$probe_cache" ] || return 1
+	while IFS= read -r line; do
+		value=${line#*=}
+		case ${line%%=*} in
+			LOBSTER_LCG_CP) LOBSTER_LCG_CP=$value;;
+			LOBSTER_GFAL_COPY) LOBSTER_GFAL_COPY=$value;;
+			LOBSTER_PROXY_INFO) LOBSTER_PROXY_INFO=$value;;
+			LOBSTER_PROBED_HTTP_PROXY) LOBSTER_PROBED_HTTP_PROXY=$value;;
+			LOBSTER_PROBED_FRONTIER_PROXY) LOBSTER_PROBED_FRONTIER_PROXY=$value;;
+			LOBSTER_PARROT_OK) LOBSTER_PARROT_OK=$value;;
+		esac
+	done < "$probe_cache"
+}
+
+save_probes() {
+	[ -n "$probe_cached" -o -z "$probe_cache" ] && return
+	tmp=$(mktemp "$probe_cache.XXXXXX") || return
+	printf '%s=%s\n' \
+		LOBSTER_LCG_CP "$LOBSTER_LCG_CP" \
+		LOBSTER_GFAL_COPY "$LOBSTER_GFAL_COPY" \
+		LOBSTER_PROXY_INFO "$LOBSTER_PROXY_INFO" \
+		LOBSTER_PROBED_HTTP_PROXY "$HTTP_PROXY" \
+		LOBSTER_PROBED_FRONTIER_PROXY "$FRONTIER_PROXY" \
+		LOBSTER_PARROT_OK "$LOBSTER_PARROT_OK" > "$tmp"
+	mv -f "$tmp" "$probe_cache"
+	probe_cached=1
+}
+
+prepare_release() {
+	scramv1 project -f CMSSW $LOBSTER_CMSSW_VERSION || exit_on_error $? 173 "Failed to create new release"
+	for layer in $sandbox; do
+		tar xjf "$layer" || exit_on_error $? 170 "Failed to unpack sandbox!"
+	done
+	(cd $LOBSTER_CMSSW_VERSION && scramv1 runtime -sh) > cmsenv.sh || exit_on_error $? 174 "The command 'cmsenv' failed!"
+}
+
+evict_releases() {
+	# remove the least recently used releases until enough disk space
+	# is free, skipping releases in use by other tasks
+	for complete in $(ls -1tr "$release_cache"/*/.complete 2> /dev/null); do
+		[ "$(df -Pm "$release_cache" | awk 'NR == 2 {print $4}')" -ge "$release_free" ] && break
+		old=${complete%/.complete}
+		[ "$old" = "$1" ] && continue
+		log "evicting cached release $old"
+		( flock -n 9 && rm -rf "$old" ) 9> "$old.lock"
+	done
+}
+
+cache_release() {
+	# prepare the release in the cache directory $1 if needed, and link
+	# it into the working directory, while holding a lock against
+	# concurrent tasks
+	(
+		flock -w 3600 9 || exit 1
+		if [ ! -f "$1/.complete" ]; then
+			evict_releases "$1"
+			rm -rf "$1"
+			mkdir -p "$1" && cd "$1" && prepare_release && touch .complete || exit $?
+			cd "$basedir"
+		fi
+		touch "$1/.complete"
+		# only share the compiled parts with the cache, as tasks may
+		# modify the rest of the release in place
+		mkdir -p "$LOBSTER_CMSSW_VERSION" || exit $?
+		for part in $(ls -A "$1/$LOBSTER_CMSSW_VERSION"); do
+			case "$part" in
+				bin|lib|external)
+					cp -al "$1/$LOBSTER_CMSSW_VERSION/$part" "$LOBSTER_CMSSW_VERSION" 2> /dev/null || \
+						cp -a "$1/$LOBSTER_CMSSW_VERSION/$part" "$LOBSTER_CMSSW_VERSION" || exit $?
+					;;
+				*)
+					cp -a "$1/$LOBSTER_CMSSW_VERSION/$part" "$LOBSTER_CMSSW_VERSION" || exit $?
+					;;
+			esac
+		done
+		sed -e "s|$1/$LOBSTER_CMSSW_VERSION|$basedir/$LOBSTER_CMSSW_VERSION|g" "$1/cmsenv.sh" > cmsenv.sh
+	) 9> "$1.lock"
+}
+
 date +%s > t_wrapper_start
 log "startup" "wrapper started" "echo -e 'hostname: $(hostname)\nkernel: $(uname -a)'"
 
-log "trace" "tracing google" traceroute -w 1 www.google.com
-log "env" "environment at startup" env
-log "cpu" "cpu info" cat /proc/cpuinfo
+# The results of probing the worker environment are the same for all
+# tasks on a worker until it reboots, and are cached in the shared
+# temporary directory of the worker, in a directory private to the
+# user.  The cache location is passed on when the wrapper restarts
+# itself within parrot.
+if [ -z "${LOBSTER_PROBE_CACHE+x}" ]; then
+	probe_key=$(echo "$(hostname) $(cat /proc/sys/kernel/random/boot_id 2>/dev/null) $HTTP_PROXY $LOBSTER_CVMFS_PROXY $LOBSTER_FRONTIER_PROXY ${PARROT_PATH:-./bin}"|cksum|cut -d' ' -f1)
+	probe_dir=${WORKER_TMPDIR:-${TMPDIR:-/tmp}}/lobster_probes_$(whoami)
+	if private_dir "$probe_dir"; then
+		export LOBSTER_PROBE_CACHE=$probe_dir/$probe_key
+	else
+		log "not caching worker probes, $probe_dir is not private"
+		export LOBSTER_PROBE_CACHE=
+	fi
+fi
+probe_cache=$LOBSTER_PROBE_CACHE
+probe_cached=
 
-# determine locally present stage-out method
-LOBSTER_LCG_CP=$(command -v lcg-cp)
-LOBSTER_GFAL_COPY=$(command -v gfal-copy)
-export LOBSTER_LCG_CP LOBSTER_GFAL_COPY
+if load_probes; then
+	probe_cached=1
+	log "using cached worker probes from $probe_cache"
+	log "env" "environment at startup" env
+else
+	log "trace" "tracing google" traceroute -w 1 www.google.com
+	log "env" "environment at startup" env
+	log "cpu" "cpu info" cat /proc/cpuinfo
 
-# determine grid proxy needs
-LOBSTER_PROXY_INFO=$(command -v grid-proxy-init)
+	# determine locally present stage-out method
+	LOBSTER_LCG_CP=$(command -v lcg-cp)
+	LOBSTER_GFAL_COPY=$(command -v gfal-copy)
+
+	# determine grid proxy needs
+	LOBSTER_PROXY_INFO=$(command -v grid-proxy-init)
+fi
+export LOBSTER_LCG_CP LOBSTER_GFAL_COPY
 
 unset PARROT_HELPER
 export PYTHONPATH=python:$PYTHONPATH
@@ -55,7 +167,10 @@ elif [ ! \( -f "/cvmfs/cms.cern.ch/cmsset_default.sh" \
 		-a -n "$LOBSTER_PROXY_INFO" \
 		-a \( -n "$LOBSTER_GFAL_COPY" -o -n "$LOBSTER_LCG_CP" \) \
 		-a -f /cvmfs/cms.cern.ch/SITECONF/local/JobConfig/site-local-config.xml \) ]; then
-	if [ -f /etc/cvmfs/default.local ]; then
+	if [ -n "$probe_cached" ]; then
+		export HTTP_PROXY=$LOBSTER_PROBED_HTTP_PROXY
+		export FRONTIER_PROXY=$LOBSTER_PROBED_FRONTIER_PROXY
+	elif [ -f /etc/cvmfs/default.local ]; then
 		log "conf" "trying to determine proxy with" cat /etc/cvmfs/default.local
 
 		cvmfsproxy=$(cat /etc/cvmfs/default.local|perl -ne '$file  = ""; while (<>) { s/\\\n//; $file .= $_ }; my $proxy = (grep /PROXY/, split("\n", $file))[0]; $proxy =~ s/^.*="?|"$//g; print $proxy;')
@@ -70,11 +185,13 @@ elif [ ! \( -f "/cvmfs/cms.cern.ch/cmsset_default.sh" \
 		export HTTP_PROXY=${HTTP_PROXY:-$GLIDEIN_Proxy_URL}
 	fi
 
-	# Last safeguard, if everything else fails.  We need a
-	# proxy for parrot!
-	export FRONTIER_PROXY=${HTTP_PROXY:-$LOBSTER_FRONTIER_PROXY}
-	export HTTP_PROXY=${HTTP_PROXY:-$LOBSTER_CVMFS_PROXY}
-	export HTTP_PROXY=$(echo $HTTP_PROXY|perl -ple 's/(?<=:\/\/)([^|:;]+)/@ls=split(\/\s\/,`nslookup $1`);$ls[-1]||$1/eg')
+	if [ -z "$probe_cached" ]; then
+		# Last safeguard, if everything else fails.  We need a
+		# proxy for parrot!
+		export FRONTIER_PROXY=${HTTP_PROXY:-$LOBSTER_FRONTIER_PROXY}
+		export HTTP_PROXY=${HTTP_PROXY:-$LOBSTER_CVMFS_PROXY}
+		export HTTP_PROXY=$(echo $HTTP_PROXY|perl -ple 's/(?<=:\/\/)([^|:;]+)/@ls=split(\/\s\/,`nslookup $1`);$ls[-1]||$1/eg')
+	fi
 
 	log "using CVMFS proxy: $HTTP_PROXY"
 	log "using Frontier proxy: $FRONTIER_PROXY"
@@ -111,13 +228,18 @@ elif [ ! \( -f "/cvmfs/cms.cern.ch/cmsset_default.sh" \
 	log "OSG certificate location: $OASIS_CERTIFICATES"
 
 	log "testing parrot usage"
-	if [ -n "$(ldd $PARROT_PATH/parrot_run 2>&1 | grep 'not found')" ]; then
+	if [ -n "$LOBSTER_PARROT_OK" ]; then
+		log "parrot OK (cached)"
+	elif [ -n "$(ldd $PARROT_PATH/parrot_run 2>&1 | grep 'not found')" ]; then
 		log "ldd" "linkage of parrot" ldd $PARROT_PATH/parrot_run
 		exit 169
 	else
 		log "parrot OK"
+		LOBSTER_PARROT_OK=1
 	fi
 
+	save_probes
+
 	# FIXME the -M could be removed once local site setting via
 	# environment works
 	log "starting parrot to access CMSSW..."
@@ -125,11 +247,13 @@ elif [ ! \( -f "/cvmfs/cms.cern.ch/cmsset_default.sh" \
 	# exec $PARROT_PATH/parrot_run -t "$PARROT_CACHE/ex_parrot_$(whoami)" bash $0 "$*"
 fi
 
+save_probes
+
 log "sourcing CMS setup"
 source /cvmfs/cms.cern.ch/cmsset_default.sh || exit_on_error $? 175 "Failed to source CMS"
 
 slc=$(egrep "Red Hat Enterprise|Scientific|CentOS" /etc/redhat-release | sed 's/.*[rR]elease \([0-9]*\).*/\1/')
-arch=$(echo sandbox-${LOBSTER_CMSSW_VERSION}-slc${slc}*.tar.bz2 | grep -oe "slc${slc}_[^.]*")
+arch=$(echo sandbox-${LOBSTER_CMSSW_VERSION}-slc${slc}*.tar.bz2 | grep -oe "slc${slc}_[^.-]*" | head -n 1)
 
 if [ -z "$LOBSTER_PROXY_INFO" -o \( -z "$LOBSTER_LCG_CP" -a -z "$LOBSTER_GFAL_COPY" \) ]; then
 	log "sourcing OSG setup"
@@ -143,18 +267,39 @@ log "env" "environment after sourcing startup scripts" env
 log "proxy" "proxy information" env X509_USER_PROXY=proxy voms-proxy-info
 log "dir" "working directory at startup" ls -l
 
-log "creating new release $LOBSTER_CMSSW_VERSION for scram arch $arch"
-
 export SCRAM_ARCH=$arch
-scramv1 project -f CMSSW $LOBSTER_CMSSW_VERSION || exit_on_error $? 173 "Failed to create new release"
+basedir=$PWD
+# sandboxes may be split into layers for the release and the user code
+sandbox=
+for layer in sandbox-${LOBSTER_CMSSW_VERSION}-${arch}.tar.bz2 sandbox-${LOBSTER_CMSSW_VERSION}-${arch}-release.tar.bz2 sandbox-${LOBSTER_CMSSW_VERSION}-${arch}-user.tar.bz2; do
+	[ -f "$layer" ] && sandbox="$sandbox $basedir/$layer"
+done
+
+# Releases prepared from the same sandbox are the same for all tasks,
+# and are kept in the temporary directory of the worker while enough
+# disk space (in MB) is free.  Tasks use hardlinked copies, which stay
+# valid when a release is evicted from the cache.
+release_cache=${WORKER_TMPDIR:-${TMPDIR:-/tmp}}/lobster_releases_$(whoami)
+release_free=${LOBSTER_RELEASE_CACHE_FREE:-10240}
+release_cached=
+
+if [ -z "$LOBSTER_DISABLE_RELEASE_CACHE" ] && command -v flock > /dev/null && mkdir -p "$release_cache" 2> /dev/null; then
+	release=$release_cache/$(cat $sandbox | md5sum | cut -d' ' -f1)-$arch
+	log "using release $LOBSTER_CMSSW_VERSION for scram arch $arch cached in $release"
+	if cache_release "$release"; then
+		release_cached=1
+	else
+		log "failed to use cached release, preparing it in the working directory"
+		rm -rf $LOBSTER_CMSSW_VERSION
+	fi
+fi
 
-log "unpacking sandbox-${LOBSTER_CMSSW_VERSION}-${arch}.tar.bz2"
-tar xjf sandbox-${LOBSTER_CMSSW_VERSION}-${arch}.tar.bz2 || exit_on_error $? 170 "Failed to unpack sandbox!"
+if [ -z "$release_cached" ]; then
+	log "creating new release $LOBSTER_CMSSW_VERSION for scram arch $arch and unpacking sandbox"
+	prepare_release
+fi
 
-basedir=$PWD
-cd $LOBSTER_CMSSW_VERSION
-eval $(scramv1 runtime -sh) || exit_on_error $? 174 "The command 'cmsenv' failed!"
-cd "$basedir"
+eval $(cat cmsenv.sh) || exit_on_error $? 174 "The command 'cmsenv' failed!"
 
 log "top" "machine load" top -Mb\|head -n 50
 log "env" "environment before execution" env
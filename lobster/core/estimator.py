@@ -0,0 +1,158 @@
+import bisect
+import json
+import math
+
+
+class UnitTimeEstimator(object):
+
+    """Streaming estimate of the distribution of per-unit processing time.
+
+    Observations are kept in a histogram with logarithmic bins, so that
+    arbitrary quantiles can be calculated with a relative precision given
+    by `ratio`.  Older observations are exponentially down-weighted, with
+    their weight halving after `halflife` newer ones, so that the estimate
+    follows changes in the conditions of the processing, e.g., caches
+    warming up.
+
+    If hosts are to be normalized, each host is assigned a speed factor,
+    the running average of its processing times relative to the median.
+    The histogram then holds normalized times, and quantiles are
+    calculated for the mixture of hosts that recently processed tasks.
+
+    Parameters
+    ----------
+        ratio : float
+            The ratio between the edges of consecutive bins.
+        minimum : float
+            The lower edge of the first bin, in seconds.
+        halflife : float
+            The number of observations after which the weight of an
+            observation has halved.
+        normalize : bool
+            Normalize processing times by host speed.
+        warmup : int
+            How many observations of a host are needed before its speed
+            factor is used.
+    """
+
+    def __init__(self, ratio=1.05, minimum=1e-3, halflife=500., normalize=False, warmup=3):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.halflife = halflife
+        self.normalize = normalize
+        self.warmup = warmup
+
+        self.count = 0
+        self.bins = {}
+        self.hosts = {}
+
+    def __bin(self, value):
+        return max(0, int(math.floor(math.log(max(value, self.minimum) / self.minimum, self.ratio))))
+
+    def __edge(self, index):
+        return self.minimum * self.ratio ** index
+
+    def __decay(self):
+        factor = 0.5 ** (1. / self.halflife)
+        for key in self.bins:
+            self.bins[key] *= factor
+        for host in self.hosts.values():
+            host[0] *= factor
+
+    def __cdf(self):
+        """Returns sorted bin indices and normalized cumulative weights.
+        """
+        keys = sorted(self.bins.keys())
+        total = float(sum(self.bins.values()))
+        cumulative = []
+        running = 0.
+        for key in keys:
+            running += self.bins[key]
+            cumulative.append(running / total)
+        return keys, cumulative
+
+    def __quantile(self, keys, cumulative, q):
+        index = min(bisect.bisect_left(cumulative, q), len(keys) - 1)
+        return self.__edge(keys[index] + 1)
+
+    def __fraction(self, keys, cumulative, value):
+        index = bisect.bisect_right(keys, self.__bin(value))
+        return cumulative[index - 1] if index > 0 else 0.
+
+    def factor(self, host):
+        """Returns the speed factor of `host`, or 1 if unknown.
+        """
+        if not self.normalize or host not in self.hosts:
+            return 1.
+        weight, observations, factor = self.hosts[host]
+        return factor if observations >= self.warmup else 1.
+
+    def add(self, value, host=None):
+        """Record a per-unit processing time of `value` seconds, observed
+        on `host`.
+        """
+        if value <= 0:
+            return
+
+        self.__decay()
+
+        if self.normalize and host:
+            if len(self.bins) > 0:
+                keys, cumulative = self.__cdf()
+                relative = value / self.__quantile(keys, cumulative, .5)
+            else:
+                relative = 1.
+            weight, observations, factor = self.hosts.get(host, [0., 0, relative])
+            normalized = value / self.factor(host)
+            self.hosts[host] = [weight + 1., observations + 1, 0.8 * factor + 0.2 * relative]
+            value = normalized
+
+        key = self.__bin(value)
+        self.bins[key] = self.bins.get(key, 0.) + 1.
+        self.count += 1
+
+    def quantile(self, q):
+        """Returns the `q`-quantile of the per-unit processing time, or
+        `None` without any observations.
+        """
+        if len(self.bins) == 0:
+            return None
+
+        keys, cumulative = self.__cdf()
+
+        hosts = [(w, f) for (w, n, f) in self.hosts.values() if n >= self.warmup]
+        if not self.normalize or len(hosts) == 0:
+            return self.__quantile(keys, cumulative, q)
+
+        total = sum(w for (w, f) in hosts)
+
+        def cdf(value):
+            return sum(w * self.__fraction(keys, cumulative, value / f) for (w, f) in hosts) / total
+
+        # Bisect the quantile of the host mixture in log-space
+        low = math.log(self.minimum)
+        high = math.log(self.__edge(keys[-1] + 1) * max([1.] + [f for (w, f) in hosts]))
+        for _ in range(60):
+            middle = 0.5 * (low + high)
+            if cdf(math.exp(middle)) < q:
+                low = middle
+            else:
+                high = middle
+        return math.exp(high)
+
+    def dumps(self):
+        return json.dumps({
+            'count': self.count,
+            'bins': self.bins.items(),
+            'hosts': self.hosts
+        })
+
+    @classmethod
+    def loads(cls, state, **kwargs):
+        res = cls(**kwargs)
+        if state:
+            data = json.loads(state)
+            res.count = data['count']
+            res.bins = dict((int(k), v) for (k, v) in data['bins'])
+            res.hosts = data['hosts']
+        return res
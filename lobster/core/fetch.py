@@ -0,0 +1,120 @@
+import logging
+
+logger = logging.getLogger('lobster.fetch')
+
+
+class FetchController(object):
+
+    """Adapt how tasks are collected from WorkQueue.
+
+    Determines how long the main loop waits for tasks to return, and how
+    many returned tasks are handed to the task source in one batch.  The
+    decisions are based on the observed rate at which tasks return, the
+    cost of releasing a task, and the depth of the queue:
+
+    1. The batch size is chosen such that releasing a batch takes about
+       `target` seconds.
+    2. The wait window is chosen such that a batch is collected in it,
+       at the observed return rate.
+    3. If no tasks are waiting in the queue, but more can be created,
+       the window is reduced to `minimum`, so that new tasks are created
+       sooner.  If no tasks returned at all, the maximum window is used.
+
+    Both quantities are kept within their bounds, and measurements are
+    smoothed exponentially.
+
+    Parameters
+    ----------
+        interval : int
+            The initial wait window, in seconds.
+        minimum : int
+            The minimum wait window, in seconds.
+        maximum : int
+            The maximum wait window, in seconds.
+        target : int
+            The time, in seconds, releasing one batch of tasks should take.
+        batch_minimum : int
+            The minimum number of tasks per batch.
+        batch_maximum : int
+            The maximum number of tasks per batch.
+        smoothing : float
+            The weight of a new measurement in the running averages.
+    """
+
+    def __init__(self, interval=120, minimum=15, maximum=300, target=60,
+                 batch_minimum=10, batch_maximum=2000, smoothing=0.3):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.batch_minimum = batch_minimum
+        self.batch_maximum = batch_maximum
+        self.smoothing = smoothing
+
+        self.interval = interval
+        self.interval_minimum = min(interval, max(minimum, interval / 4))
+        self.batch = batch_maximum
+
+        self.rate = None
+        self.cost = None
+
+    def __smooth(self, old, new):
+        if old is None:
+            return new
+        return self.smoothing * new + (1 - self.smoothing) * old
+
+    @property
+    def attributes(self):
+        """Current decisions and measurements, to be logged.
+        """
+        return {
+            'fetch_batch': self.batch,
+            'fetch_interval': self.interval,
+            'fetch_interval_minimum': self.interval_minimum,
+            'release_cost': self.cost or 0.,
+            'return_rate': self.rate or 0.
+        }
+
+    def returned(self, count, duration):
+        """Record that `count` tasks returned in `duration` seconds.
+        """
+        if duration > 0:
+            self.rate = self.__smooth(self.rate, count / float(duration))
+
+    def released(self, count, duration):
+        """Record that releasing `count` tasks took `duration` seconds.
+        """
+        if count > 0:
+            self.cost = self.__smooth(self.cost, duration / float(count))
+
+    def adjust(self, waiting, left):
+        """Determine the wait window and batch size for the next cycle.
+
+        Parameters
+        ----------
+            waiting : int
+                The number of tasks waiting in the queue.
+            left : int
+                The number of tasks that can still be created.
+        """
+        batch = self.batch_maximum
+        if self.cost:
+            batch = int(self.target / self.cost)
+        batch = max(self.batch_minimum, min(self.batch_maximum, batch))
+
+        interval = self.interval
+        if waiting == 0 and left > 0:
+            interval = self.minimum
+        elif self.rate is not None:
+            interval = int(batch / self.rate) if self.rate > 0 else self.maximum
+        interval = max(self.minimum, min(self.maximum, interval))
+
+        if self.rate and self.cost and self.rate * self.cost > 1:
+            logger.debug("returning tasks takes longer than they arrive")
+
+        if (interval, batch) != (self.interval, self.batch):
+            logger.debug("waiting up to {0}s for up to {1} tasks (return rate {2:.3f}/s, release cost {3:.3f}s/task)".format(
+                interval, batch, self.rate or 0., self.cost or 0.))
+
+        self.interval = interval
+        self.interval_minimum = min(interval, max(self.minimum, interval / 4))
+        self.batch = batch
@@ -8,16 +8,20 @@ import shutil
 import socket
 import subprocess
 import sys
+import time
 import work_queue as wq
 
 from collections import defaultdict, Counter
 from hashlib import sha1
+from multiprocessing.pool import ThreadPool
 
-from lobster import fs, util
+from lobster import fs, se, util
 from lobster.cmssw import dash
 from lobster.core import unit
 from lobster.core import Algo
+from lobster.core.cleanup import Cleanup
 from lobster.core import MergeTaskHandler
+from lobster.core import PilotTask
 
 from WMCore.Storage.SiteLocalConfig import loadSiteLocalConfig, SiteConfigError
 
@@ -106,37 +110,11 @@ class TaskProvider(util.Timing):
 
         self.__algo = Algo(config)
         self.__host = socket.getfqdn()
-        try:
-            siteconf = loadSiteLocalConfig()
-            self.__ce = siteconf.siteName
-            self.__se = siteconf.localStageOutPNN()
-            self.__frontier_proxy = siteconf.frontierProxies[0]
-        except SiteConfigError:
-            logger.error("can't load siteconfig, defaulting to hostname")
-            self.__ce = socket.getfqdn()
-            self.__se = socket.getfqdn()
-            try:
-                self.__frontier_proxy = os.environ['HTTP_PROXY']
-            except KeyError:
-                logger.error("can't determine proxy for Frontier via $HTTP_PROXY")
-                sys.exit(1)
 
-        try:
-            with open('/etc/cvmfs/default.local') as f:
-                lines = f.readlines()
-        except:
-            lines = []
-        for l in lines:
-            m = re.match('\s*CVMFS_HTTP_PROXY\s*=\s*[\'"]?(.*)[\'"]?', l)
-            if m:
-                self.__cvmfs_proxy = m.group(1)
-                break
-        else:
-            try:
-                self.__cvmfs_proxy = os.environ['HTTP_PROXY']
-            except KeyError:
-                logger.error("can't determine proxy for CVMFS via $HTTP_PROXY")
-                sys.exit(1)
+        startup = util.Timing('proxies', 'inputs', 'siteconf', 'workflows', 'elk', 'dashboard', 'binaries')
+
+        with startup.measure('proxies'):
+            self.__ce, self.__se, self.__frontier_proxy, self.__cvmfs_proxy = self.__determine_proxies()
 
         logger.debug("using {} as proxy for CVMFS".format(self.__cvmfs_proxy))
         logger.debug("using {} as proxy for Frontier".format(self.__frontier_proxy))
@@ -144,10 +122,23 @@ class TaskProvider(util.Timing):
         util.sendemail("Your Lobster project has started!", self.config)
 
         self.__taskhandlers = {}
+        # Submitted WQ tasks by WQ id, and when the running ones started
+        # on their workers.  Only updated by the thread talking to WQ.
+        self.__submitted = {}
+        self.__started = {}
+        self.__pilots = defaultdict(list)
+        # Speculatively duplicated tasks: running pairs point to each
+        # other, while losers have to be discarded when they return.
+        self.__twins = {}
+        self.__losers = set()
         self.__store = unit.UnitStore(self.config)
+        self.__cleanup = Cleanup(self.workdir)
+        self.__health = se.EndpointHealth()
 
-        self.__setup_inputs()
-        self.copy_siteconf()
+        with startup.measure('inputs'):
+            self.__setup_inputs()
+        with startup.measure('siteconf'):
+            self.copy_siteconf()
 
         create = not util.checkpoint(self.workdir, 'id')
         if create:
@@ -177,26 +168,23 @@ class TaskProvider(util.Timing):
 
             util.register_checkpoint(self.workdir, 'executable', exename)
 
-        for wflow in self.config.workflows:
-            if create and not util.checkpoint(self.workdir, wflow.label):
-                wflow.setup(self.workdir, self.basedirs)
-                logger.info("querying backend for {0}".format(wflow.label))
-                with fs.alternative():
-                    dataset_info = wflow.dataset.get_info()
-
-                logger.info("registering {0} in database".format(wflow.label))
-                self.__store.register_dataset(wflow, dataset_info, wflow.category.runtime)
-                util.register_checkpoint(self.workdir, wflow.label, 'REGISTERED')
-            elif os.path.exists(os.path.join(wflow.workdir, 'running')):
-                for id in self.get_taskids(wflow.label):
-                    util.move(wflow.workdir, id, 'failed')
+        with startup.measure('workflows'):
+            pending = []
+            for wflow in self.config.workflows:
+                if create and not util.checkpoint(self.workdir, wflow.label):
+                    pending.append(wflow)
+                elif os.path.exists(os.path.join(wflow.workdir, 'running')):
+                    for id in self.get_taskids(wflow.label):
+                        util.move(wflow.workdir, id, 'failed')
 
-        for wflow in self.config.workflows:
-            if wflow.parent:
-                getattr(self.config.workflows, wflow.parent.label).register(wflow)
-                if create:
-                    total_units = wflow.dataset.total_units * len(wflow.unique_arguments)
-                    self.__store.register_dependency(wflow.label, wflow.parent.label, total_units)
+            self.__register_workflows(pending)
+
+            for wflow in self.config.workflows:
+                if wflow.parent:
+                    getattr(self.config.workflows, wflow.parent.label).register(wflow)
+                    if create:
+                        total_units = wflow.dataset.total_units * len(wflow.unique_arguments)
+                        self.__store.register_dependency(wflow.label, wflow.parent.label, total_units)
 
         if not util.checkpoint(self.workdir, 'sandbox cmssw version'):
             util.register_checkpoint(self.workdir, 'sandbox', 'CREATED')
@@ -204,40 +192,190 @@ class TaskProvider(util.Timing):
             if len(versions) == 1:
                 util.register_checkpoint(self.workdir, 'sandbox cmssw version', list(versions)[0])
 
-        if self.config.elk:
+        with startup.measure('elk'):
+            if self.config.elk:
+                if create:
+                    categories = {wflow.category.name: [] for wflow in self.config.workflows}
+                    for category in categories:
+                        for workflow in self.config.workflows:
+                            if workflow.category.name == category:
+                                categories[category].append(workflow.label)
+                    self.config.elk.create(categories)
+                else:
+                    self.config.elk.resume()
+
+        with startup.measure('dashboard'):
+            self.config.advanced.dashboard.setup(self.config)
             if create:
-                categories = {wflow.category.name: [] for wflow in self.config.workflows}
-                for category in categories:
-                    for workflow in self.config.workflows:
-                        if workflow.category.name == category:
-                            categories[category].append(workflow.label)
-                self.config.elk.create(categories)
+                self.config.save()
+                self.config.advanced.dashboard.register_run()
             else:
-                self.config.elk.resume()
+                self.config.advanced.dashboard.update_task_status(
+                    (id_, dash.ABORTED) for id_ in self.__store.reset_units()
+                )
+
+        with startup.measure('binaries'):
+            self.__copy_binaries()
+
+        outstanding = self.__cleanup.outstanding()
+        if len(outstanding) > 0:
+            logger.info("resuming removal of {0} files".format(sum(outstanding.values())))
+        self.__cleanup.start()
+
+        logger.info("startup timing: {0}".format(", ".join(
+            "{0} {1:.2f} s".format(k, v * 1e-6) for k, v in sorted(startup.times.items(), key=lambda (k, v): -v))))
+
+    def __register_workflows(self, workflows):
+        """Set up `workflows` and register them in the database.
+
+        The setup and dataset discovery of independent workflows are
+        performed concurrently, using at most
+        `config.advanced.discovery_threads` threads.  Workflows depending
+        on another workflow are only discovered once their parent has
+        been.  Database registration is performed serially as soon as
+        the discovery of a workflow finished.
+        """
+        def discover(wflow):
+            wflow.setup(self.workdir, self.basedirs)
+            logger.info("querying backend for {0}".format(wflow.label))
+            return wflow, wflow.dataset.get_info()
 
-        self.config.advanced.dashboard.setup(self.config)
-        if create:
-            self.config.save()
-            self.config.advanced.dashboard.register_run()
+        def depth(wflow):
+            return 0 if not wflow.parent else 1 + depth(wflow.parent)
+
+        levels = defaultdict(list)
+        for wflow in workflows:
+            levels[depth(wflow)].append(wflow)
+
+        done = 0
+        pool = ThreadPool(max(1, min(self.config.advanced.discovery_threads, len(workflows))))
+        try:
+            # fs.alternative() is not thread-safe, and needs to be active
+            # for all threads
+            with fs.alternative():
+                for level in sorted(levels.keys()):
+                    for wflow, dataset_info in pool.imap_unordered(discover, levels[level]):
+                        done += 1
+                        logger.info("registering {0} in database ({1}/{2})".format(wflow.label, done, len(workflows)))
+                        self.__store.register_dataset(wflow, dataset_info, wflow.task_runtime)
+                        util.register_checkpoint(self.workdir, wflow.label, 'REGISTERED')
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def __cached(self, key, fingerprint, targets=None):
+        """Look up a startup artifact in the cache.
+
+        Returns the value stored for `key` if the `fingerprint` of its
+        sources matches the one recorded, and all `targets` still exist.
+        Otherwise returns `None`.
+        """
+        cache = util.checkpoint(self.workdir, 'startup cache') or {}
+        entry = cache.get(key)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return None
+        if targets and not all(os.path.exists(t) for t in targets):
+            return None
+        logger.debug("reusing cached startup artifact '{0}'".format(key))
+        return entry['value']
+
+    def __cache(self, key, fingerprint, value=True):
+        cache = util.checkpoint(self.workdir, 'startup cache') or {}
+        cache[key] = {'fingerprint': fingerprint, 'value': value}
+        util.register_checkpoint(self.workdir, 'startup cache', cache)
+
+    def __determine_proxies(self):
+        """Determine the site information and the proxies to use for CVMFS
+        and Frontier.
+
+        The result is cached, keyed by the site-local configuration, the
+        CVMFS configuration, and the environment they are derived from.
+        """
+        sitelocal = os.environ.get('WMAGENT_SITE_CONFIG_OVERRIDE') or \
+            os.path.expandvars('$CMS_PATH/SITECONF/local/JobConfig/site-local-config.xml')
+        fingerprint = [
+            util.checksum(sitelocal, '/etc/cvmfs/default.local'),
+            os.environ.get('HTTP_PROXY'),
+            socket.getfqdn()
+        ]
+
+        cached = self.__cached('proxies', fingerprint)
+        if cached:
+            return [str(v) for v in cached]
+
+        try:
+            siteconf = loadSiteLocalConfig()
+            ce = siteconf.siteName
+            se = siteconf.localStageOutPNN()
+            frontier_proxy = siteconf.frontierProxies[0]
+        except SiteConfigError:
+            logger.error("can't load siteconfig, defaulting to hostname")
+            ce = socket.getfqdn()
+            se = socket.getfqdn()
+            try:
+                frontier_proxy = os.environ['HTTP_PROXY']
+            except KeyError:
+                logger.error("can't determine proxy for Frontier via $HTTP_PROXY")
+                sys.exit(1)
+
+        try:
+            with open('/etc/cvmfs/default.local') as f:
+                lines = f.readlines()
+        except:
+            lines = []
+        for l in lines:
+            m = re.match('\s*CVMFS_HTTP_PROXY\s*=\s*[\'"]?(.*)[\'"]?', l)
+            if m:
+                cvmfs_proxy = m.group(1)
+                break
         else:
-            self.config.advanced.dashboard.update_task_status(
-                (id_, dash.ABORTED) for id_ in self.__store.reset_units()
-            )
+            try:
+                cvmfs_proxy = os.environ['HTTP_PROXY']
+            except KeyError:
+                logger.error("can't determine proxy for CVMFS via $HTTP_PROXY")
+                sys.exit(1)
+
+        result = [ce, se, frontier_proxy, cvmfs_proxy]
+        self.__cache('proxies', fingerprint, result)
+        return result
+
+    def __copy_binaries(self):
+        """Copy `parrot_run` and the `chirp` tools into the working
+        directory, stripping them to reduce the size of the task inputs.
 
+        Binaries are only copied and stripped again if the hash of their
+        source changed.
+        """
         for p in (self.parrot_bin, self.parrot_lib):
             if not os.path.exists(p):
                 os.makedirs(p)
 
         for exe in ('parrot_run', 'chirp', 'chirp_put', 'chirp_get'):
-            shutil.copy(util.which(exe), self.parrot_bin)
-            subprocess.check_call(["strip", os.path.join(self.parrot_bin, exe)])
+            source = util.which(exe)
+            target = os.path.join(self.parrot_bin, exe)
+            fingerprint = util.checksum(source)
+            if self.__cached(exe, fingerprint, [target]):
+                continue
+            shutil.copy(source, self.parrot_bin)
+            subprocess.check_call(["strip", target])
+            self.__cache(exe, fingerprint)
 
         p_helper = os.path.join(os.path.dirname(self.parrot_path), 'lib', 'lib64', 'libparrot_helper.so')
-        shutil.copy(p_helper, self.parrot_lib)
+        fingerprint = util.checksum(p_helper)
+        if not self.__cached('libparrot_helper.so', fingerprint, [os.path.join(self.parrot_lib, 'libparrot_helper.so')]):
+            shutil.copy(p_helper, self.parrot_lib)
+            self.__cache('libparrot_helper.so', fingerprint)
 
     def copy_siteconf(self):
         storage_in = os.path.join(os.path.dirname(__file__), 'data', 'siteconf', 'PhEDEx', 'storage.xml')
         storage_out = os.path.join(self.siteconf, 'PhEDEx', 'storage.xml')
+        jobconfig_in = os.path.join(os.path.dirname(__file__), 'data', 'siteconf', 'JobConfig', 'site-local-config.xml')
+        jobconfig_out = os.path.join(self.siteconf, 'JobConfig', 'site-local-config.xml')
+
+        fingerprint = [util.checksum(storage_in, jobconfig_in), self.config.advanced.xrootd_servers]
+        if self.__cached('siteconf', fingerprint, [storage_out, jobconfig_out]):
+            return
+
         if not os.path.exists(os.path.dirname(storage_out)):
             os.makedirs(os.path.dirname(storage_out))
         xml = ''
@@ -249,8 +387,6 @@ class TaskProvider(util.Timing):
             with open(storage_out, 'w') as fout:
                 fout.write(fin.read().format(xrootd_rules=xml))
 
-        jobconfig_in = os.path.join(os.path.dirname(__file__), 'data', 'siteconf', 'JobConfig', 'site-local-config.xml')
-        jobconfig_out = os.path.join(self.siteconf, 'JobConfig', 'site-local-config.xml')
         if not os.path.exists(os.path.dirname(jobconfig_out)):
             os.makedirs(os.path.dirname(jobconfig_out))
         xml = ''
@@ -261,6 +397,8 @@ class TaskProvider(util.Timing):
             with open(jobconfig_out, 'w') as fout:
                 fout.write(fin.read().format(xrootd_catalogs=xml))
 
+        self.__cache('siteconf', fingerprint)
+
     def __find_root(self, label):
         while getattr(self.config.workflows, label).parent:
             label = getattr(self.config.workflows, label).parent
@@ -333,12 +471,16 @@ class TaskProvider(util.Timing):
             infos = self.__store.pop_units(label, ntasks, taper)
             logger.debug("created {} tasks for workflow {}".format(len(infos), label))
             taskinfos += infos
+        if getattr(self.config.advanced, 'speculation_threshold', 0) > 0:
+            taskinfos += self.__speculate()
 
         if not taskinfos or len(taskinfos) == 0:
             return []
 
         tasks = []
+        pilots = defaultdict(list)
         ids = []
+        shared = self.__shared(taskinfos) if self._storage.cache_inputs() else set()
         registration = dict(
             zip(
                 [t[0] for t in taskinfos],
@@ -425,26 +567,148 @@ class TaskProvider(util.Timing):
             handler = wflow.handler(id, files, lumis, jdir, merge=merge)
 
             # set input/output transfer parameters
-            self._storage.preprocess(config, merge or wflow.parent)
+            self._storage.preprocess(config, merge or wflow.parent, self.__health)
             # adjust file and lumi information in config, add task specific
             # input/output files
-            handler.adjust(config, inputs, outputs, self._storage)
+            handler.adjust(config, inputs, outputs, self._storage, shared)
 
             with open(os.path.join(jdir, 'parameters.json'), 'w') as f:
                 json.dump(config, f, indent=2)
                 f.write('\n')
 
-            tasks.append(('merge' if merge else wflow.category.name, cmd, id, inputs, outputs, env, jdir))
+            task = ('merge' if merge else wflow.category.name, cmd, id, inputs, outputs, env, jdir)
+            if getattr(wflow, 'pilot_tasks', 1) > 1 and not merge and id not in self.__twins:
+                pilots[wflow.label].append(task)
+            else:
+                tasks.append(task)
 
             self.__taskhandlers[id] = handler
 
         logger.info("creating task(s) {0}".format(", ".join(map(str, ids))))
 
+        for label, group in pilots.items():
+            size = getattr(self.config.workflows, label).pilot_tasks
+            for i in range(0, len(group), size):
+                tasks.append(self.__pilot(group[i:i + size]))
+
         self.config.advanced.dashboard.free()
 
         return tasks
 
+    def __pilot(self, tasks):
+        """Combine tasks into a pilot, which runs them one after the other
+        in a single Work Queue task.
+
+        Inputs needed by all tasks are shared, all other inputs and
+        outputs are placed in a directory per task.
+        """
+        if len(tasks) == 1:
+            return tasks[0]
+
+        category, _, _, _, _, env, jdir = tasks[0]
+        ids = [id for (_, _, id, _, _, _, _) in tasks]
+        tag = 'pilot-' + ids[0]
+
+        shared = set(tasks[0][3])
+        for task in tasks[1:]:
+            shared &= set(task[3])
+
+        inputs = [i for i in tasks[0][3] if i in shared]
+        inputs.append((os.path.join(os.path.dirname(__file__), 'data', 'pilot.py'), 'pilot.py', True))
+        outputs = []
+        for (_, _, id, ins, outs, _, taskdir) in tasks:
+            inputs += [(local, os.path.join(id, remote), cache) for (local, remote, cache) in ins if (local, remote, cache) not in shared]
+            outputs += [(local, os.path.join(id, remote)) for (local, remote) in outs]
+            self.__pilots[tag].append((id, taskdir, [local for (local, remote) in outs]))
+
+        logger.info("running task(s) {0} in pilot {1}".format(", ".join(ids), tag))
+
+        cmd = 'sh wrapper.sh python pilot.py ' + ' '.join(ids)
+        return (category, cmd, tag, inputs, outputs, env, jdir)
+
+    def __unpilot(self, tasks):
+        """Replace returned pilots with the tasks they ran.
+        """
+        for task in tasks:
+            if task.tag not in self.__pilots:
+                yield task
+                continue
+            for pilot_task in PilotTask.split(task, self.__pilots.pop(task.tag)):
+                yield pilot_task
+
+    def __shared(self, taskinfos):
+        """Returns the input files of `taskinfos` which are read by several
+        tasks, including ones created earlier or later.
+
+        These are worth caching on the workers, so that `WorkQueue` can
+        send the other tasks reading them to the workers holding them.
+        """
+        reads = Counter()
+        names = defaultdict(dict)
+        units = defaultdict(Counter)
+        for (_, label, files, lumis, _, merge) in taskinfos:
+            if merge:
+                continue
+            reads.update(f for (_, f) in files if f)
+            names[label].update((id, f) for (id, f) in files if f)
+            for (_, file, _, _) in lumis:
+                units[label][file] += 1
+        shared = set(f for f, count in reads.items() if count > 1)
+
+        for label, counts in units.items():
+            for id in self.__store.partial_files(label, counts):
+                if id in names[label]:
+                    shared.add(names[label][id])
+        return shared
+
+    def __speculate(self):
+        """Duplicate straggling tasks of workflows in their end game.
+
+        Only tasks that have been running longer than `speculation_age`
+        times the average runtime of their workflow are duplicated, the
+        oldest ones first, and at most `speculation_limit` per workflow.
+        Tasks run within pilots are not duplicated, as they can neither be
+        cancelled individually, nor is their runtime known.
+        """
+        threshold = self.config.advanced.speculation_threshold
+        age = getattr(self.config.advanced, 'speculation_age', 1.5)
+        limit = getattr(self.config.advanced, 'speculation_limit', 10)
+        started = self.__started
+        now = time.time()
+
+        piloted = set(id for tasks in self.__pilots.values() for (id, _, _) in tasks)
+
+        candidates = defaultdict(list)
+        for id, handler in self.__taskhandlers.items():
+            if id not in started or id in self.__twins or id in self.__losers or id in piloted \
+                    or isinstance(handler, MergeTaskHandler):
+                continue
+            candidates[handler.dataset].append((started[id], id))
+
+        taskinfos = []
+        for label, tasks in candidates.items():
+            if not self.__store.endgame(label, threshold):
+                continue
+            runtime = self.__store.average_runtime(label)
+            if runtime is None:
+                continue
+            stragglers = [id for (start, id) in sorted(tasks) if now - start > age * runtime]
+            for original, info in self.__store.pop_duplicates(label, stragglers[:limit]):
+                logger.info("duplicating straggling task {0} of {1} as {2}".format(original, label, info[0]))
+                self.__twins[original] = info[0]
+                self.__twins[info[0]] = original
+                taskinfos.append(info)
+        return taskinfos
+
     def release(self, tasks):
+        """Process returned tasks and update the project accordingly.
+
+        Returns the ids of tasks to cancel, because a duplicate of them
+        has succeeded.  These tasks should still be handed back to this
+        method, so that they can be discarded.
+        """
+        cancel = []
+        reassign = []
         fail_cleanup = []
         merge_cleanup = []
         input_cleanup = []
@@ -454,6 +718,8 @@ class TaskProvider(util.Timing):
         summary = ReleaseSummary()
         transfers = defaultdict(lambda: defaultdict(Counter))
 
+        tasks = list(self.__unpilot(tasks))
+
         with self.measure('dash'):
             self.config.advanced.dashboard.update_task_status(
                 (task.tag, dash.DONE) for task in tasks
@@ -463,9 +729,28 @@ class TaskProvider(util.Timing):
             with self.measure('updates'):
                 handler = self.__taskhandlers[task.tag]
                 failed, task_update, file_update, unit_update = handler.process(task, summary, transfers)
+                self.__health.record(handler.endpoints)
 
                 wflow = getattr(self.config.workflows, handler.dataset)
 
+                if task.tag in self.__losers:
+                    # a duplicate already succeeded
+                    self.__losers.remove(task.tag)
+                    file_update, unit_update = handler.supersede(task_update, unit.ABORTED)
+                    failed = True
+                elif task.tag in self.__twins:
+                    twin = self.__twins.pop(task.tag)
+                    del self.__twins[twin]
+                    # the units may still be held by the twin
+                    if failed:
+                        reassign.append((handler.dataset, task.tag, twin))
+                        file_update, unit_update = handler.supersede(task_update, unit.FAILED)
+                    else:
+                        logger.info("task {0} finished before its duplicate {1}".format(task.tag, twin))
+                        reassign.append((handler.dataset, twin, task.tag))
+                        self.__losers.add(twin)
+                        cancel.append(twin)
+
             with self.measure('elk'):
                 if self.config.elk:
                     self.config.elk.index_task(task)
@@ -505,20 +790,17 @@ class TaskProvider(util.Timing):
         if len(update) > 0:
             with self.measure('sqlite'):
                 logger.info(summary)
+                if len(reassign) > 0:
+                    self.__store.reassign_units(reassign)
                 self.__store.update_units(update)
 
         with self.measure('cleanup'):
             if len(input_files) > 0:
                 input_cleanup.extend(self.__store.finished_files(input_files))
 
-            for cleanup in [fail_cleanup, merge_cleanup + input_cleanup]:
-                if len(cleanup) > 0:
-                    try:
-                        fs.remove(*cleanup)
-                    except (IOError, OSError):
-                        pass
-                    except ValueError as e:
-                        logger.error("error removing {0}:\n{1}".format(task.tag, e))
+            self.__cleanup.add(fail_cleanup, 'failed')
+            self.__cleanup.add(merge_cleanup, 'merged')
+            self.__cleanup.add(input_cleanup, 'input')
 
         with self.measure('propagate'):
             for label, infos in propagate.items():
@@ -536,10 +818,26 @@ class TaskProvider(util.Timing):
                 except Exception as e:
                     logger.error('ELK failed to index summary:\n{}'.format(e))
 
-    def terminate(self):
+        return cancel
+
+    def terminate(self, timeout=60):
         self.config.advanced.dashboard.update_task_status(
             (str(id), dash.CANCELLED) for id in self.__store.running_tasks()
         )
+        self.__cleanup.stop(timeout=timeout)
+
+    def finish(self, timeout=300):
+        """Wait for outstanding files to be removed, for at most `timeout`
+        seconds.  Files not removed by then are left in the cleanup
+        journal.
+        """
+        outstanding = self.__cleanup.outstanding()
+        if len(outstanding) > 0:
+            logger.info("waiting for the removal of {0} files".format(sum(outstanding.values())))
+        self.__cleanup.stop(wait=True, timeout=timeout)
+        left = sum(self.__cleanup.outstanding().values())
+        if left > 0:
+            logger.warning("{0} files remain in the cleanup journal, use 'lobster validate' to remove them".format(left))
 
     def done(self):
         left = self.__store.unfinished_units()
@@ -548,7 +846,21 @@ class TaskProvider(util.Timing):
     def max_taskid(self):
         return self.__store.max_taskid()
 
-    def update(self, queue):
+    def update(self, queue, lock):
+        """Update the state of running tasks from `queue`.
+
+        Only the tasks submitted by the main thread are inspected, so the
+        snapshot is taken without `lock`, which guards the task source
+        against the helper thread, and merely swapped in while holding it.
+        """
+        if getattr(self.config.advanced, 'speculation_threshold', 0) > 0:
+            started = self.__running(queue)
+        else:
+            self.__submitted.clear()
+            started = {}
+        with lock:
+            self.__started = started
+
         # update dashboard status for all unfinished tasks.
         # WAITING_RETRIEVAL is not a valid status in dashboard,
         # so skipping it for now.
@@ -559,6 +871,30 @@ class TaskProvider(util.Timing):
             logger.warning("could not update task states to dashboard")
             logger.exception(e)
 
+    def submitted(self, tasks):
+        """Keep track of the WQ `tasks` submitted, to find out when they
+        start running.
+        """
+        if getattr(self.config.advanced, 'speculation_threshold', 0) > 0:
+            for task in tasks:
+                self.__submitted[task.id] = task
+
+    def __running(self, queue):
+        """Returns when the running tasks submitted to `queue` started
+        executing, by task tag.  Tasks which have been retrieved are
+        forgotten.
+        """
+        started = {}
+        for id_, task in self.__submitted.items():
+            state = queue.task_state(id_)
+            if state == wq.WORK_QUEUE_TASK_RUNNING:
+                start = task.execute_cmd_start or task.send_input_start
+                if start:
+                    started[task.tag] = start / 1000000.
+            elif state not in (wq.WORK_QUEUE_TASK_READY, wq.WORK_QUEUE_TASK_WAITING_RETRIEVAL):
+                del self.__submitted[id_]
+        return started
+
     def update_stuck(self):
         """Have the unit store updated the statistics for stuck units.
         """
@@ -571,9 +907,16 @@ class TaskProvider(util.Timing):
         update = []
         for wflow in self.config.workflows:
             if wflow.category == category:
-                update.append((category.runtime, wflow.label))
+                update.append((wflow.task_runtime, wflow.label))
         self.__store.update_workflow_runtime(update)
 
+    @property
+    def allocations(self):
+        """The cores allocated to each workflow when tasks were last
+        created.
+        """
+        return self.__algo.allocations
+
     def tasks_left(self):
         return self.__store.estimate_tasks_left()
 
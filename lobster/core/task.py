@@ -11,11 +11,136 @@ import unit
 
 from WMCore.DataStructs.LumiList import LumiList
 
-__all__ = ['TaskHandler', 'MergeTaskHandler', 'ProductionTaskHandler']
+__all__ = ['TaskHandler', 'MergeTaskHandler', 'ProductionTaskHandler', 'PilotTask']
 
 logger = logging.getLogger('lobster.cmssw.taskhandler')
 
 
+class PilotTask(object):
+
+    """A task run within a pilot, standing in for the Work Queue task of
+    the pilot when processing its results.
+
+    The exit status is taken from the report of the task, and the result
+    only reflects missing outputs of this task, rather than of all tasks
+    in the pilot.  The execution time is taken from the timing in the
+    report of the task.  Transferred bytes and the time spent
+    transferring are split evenly between the tasks of the pilot, so that
+    they are only accounted once.  All other attributes are those of the
+    pilot.
+
+    Use :meth:`split` to obtain the tasks of a pilot.
+
+    Parameters
+    ----------
+        pilot : work_queue.Task
+            The Work Queue task that ran the pilot.
+        tag : str
+            The id of the task within the pilot.
+        taskdir : str
+            The directory of the task.
+        outputs : list
+            The local paths of the outputs of the task.
+        index : int
+            The position of the task within the pilot.
+        count : int
+            The number of tasks in the pilot.
+    """
+
+    # Totals of the pilot, split evenly between its tasks
+    _totals = ['total_bytes_received', 'total_bytes_sent', 'total_cmd_execution_time', 'total_cmd_exhausted_execute_time']
+    _measured = ['bytes_received', 'bytes_sent']
+    _windows = [('send_input_start', 'send_input_finish'), ('receive_output_start', 'receive_output_finish')]
+
+    def __init__(self, pilot, tag, taskdir, outputs, index=0, count=1):
+        self.__pilot = pilot
+        self.tag = tag
+
+        self.completed = False
+        self.return_status = pilot.return_status
+        self.cmd_execution_time = pilot.cmd_execution_time / count
+        try:
+            with open(os.path.join(taskdir, 'report.json'), 'r') as f:
+                data = json.load(f)
+            self.return_status = data['task_exit_code']
+            self.completed = True
+        except (IOError, ValueError, KeyError):
+            if self.return_status == 0:
+                self.return_status = 1
+        else:
+            timing = data.get('task_timing', {})
+            if timing.get('wrapper_start'):
+                end = max(t for t in timing.values() if t)
+                self.cmd_execution_time = (end - timing['wrapper_start']) * 1000000
+
+        self.result = pilot.result
+        if self.completed or pilot.result in (wq.WORK_QUEUE_RESULT_SUCCESS, wq.WORK_QUEUE_RESULT_OUTPUT_MISSING):
+            if all(os.path.exists(f) for f in outputs):
+                self.result = wq.WORK_QUEUE_RESULT_SUCCESS
+            else:
+                self.result = wq.WORK_QUEUE_RESULT_OUTPUT_MISSING
+
+        for attr in self._totals:
+            setattr(self, attr, getattr(pilot, attr) / count)
+        for start, end in self._windows:
+            begin = getattr(pilot, start)
+            length = (getattr(pilot, end) - begin) / count
+            setattr(self, start, begin + index * length)
+            setattr(self, end, begin + (index + 1) * length)
+
+        self.resources_measured = None
+        if pilot.resources_measured:
+            self.resources_measured = _Split(pilot.resources_measured, self._measured, count)
+
+    def __getattr__(self, attr):
+        return getattr(self.__pilot, attr)
+
+    @classmethod
+    def split(cls, pilot, tasks):
+        """Returns the tasks run by `pilot`.
+
+        Tasks are run in order, and stop being run when the pilot fails.
+        Thus the first task without a report bears the failure of the
+        pilot, i.e., exceeded resources and the remaining execution time,
+        while all later ones have not been run.
+
+        Parameters
+        ----------
+            pilot : work_queue.Task
+                The Work Queue task that ran the pilot.
+            tasks : list
+                A list of tuples `(tag, taskdir, outputs)` in the order the
+                pilot ran them.
+        """
+        res = [cls(pilot, tag, taskdir, outputs, n, len(tasks)) for n, (tag, taskdir, outputs) in enumerate(tasks)]
+        if pilot.result in (wq.WORK_QUEUE_RESULT_SUCCESS, wq.WORK_QUEUE_RESULT_OUTPUT_MISSING):
+            return res
+
+        incomplete = [task for task in res if not task.completed]
+        if incomplete:
+            used = sum(task.cmd_execution_time for task in res if task.completed)
+            incomplete[0].cmd_execution_time = max(pilot.cmd_execution_time - used, 0)
+            for task in incomplete[1:]:
+                task.result = wq.WORK_QUEUE_RESULT_UNKNOWN
+                task.cmd_execution_time = 0
+        return res
+
+
+class _Split(object):
+
+    """Proxy for the share of one of `count` tasks in `obj`, with the
+    attributes in `attrs` divided evenly.
+    """
+
+    def __init__(self, obj, attrs, count):
+        self.__obj = obj
+        for attr in attrs:
+            setattr(self, attr, getattr(obj, attr) / count)
+
+    def __getattr__(self, attr):
+        return getattr(self.__obj, attr)
+
+
 class TaskHandler(object):
 
     """
@@ -36,6 +161,7 @@ class TaskHandler(object):
 
         self.__output_info = {}
         self.__output_size = 0
+        self.__endpoints = {}
 
     @property
     def dataset(self):
@@ -50,6 +176,13 @@ class TaskHandler(object):
         res.size = self.__output_size
         return res
 
+    @property
+    def endpoints(self):
+        """The stage-in and stage-out attempts per storage endpoint, as
+        reported by the task.
+        """
+        return self.__endpoints
+
     @property
     def id(self):
         return self._id
@@ -102,10 +235,30 @@ class TaskHandler(object):
 
         return file_update, unit_update
 
-    def adjust(self, parameters, inputs, outputs, se):
+    def supersede(self, task_update, status):
+        """Discard the outcome of a task that has been duplicated.
+
+        The units of the task are accounted for by its duplicate, so
+        neither the units nor the files are updated, and the task is
+        recorded with `status`.
+        """
+        task_update.events_read = 0
+        task_update.events_written = 0
+        task_update.units_processed = 0
+        task_update.status = status
+
+        return [], []
+
+    def adjust(self, parameters, inputs, outputs, se, shared=None):
+        """Add the task specific inputs and outputs, and set the files and
+        lumis to process in `parameters`.  Input files transferred by
+        `WorkQueue` are cached on the workers if they are in `shared`,
+        i.e., read by other tasks, too.
+        """
         local = self._local
         if local and se.transfer_inputs():
-            inputs += [(se.local(f), os.path.basename(f), False) for id, f in self._files if f]
+            shared = shared or set()
+            inputs += [(se.local(f), os.path.basename(f), se.cache_inputs() and f in shared) for id, f in self._files if f]
         if se.transfer_outputs():
             outputs += [(se.local(rf), os.path.basename(lf)) for lf, rf in self.outputs]
 
@@ -148,6 +301,7 @@ class TaskHandler(object):
 
             for protocol in data['transfers']:
                 transfers[self._dataset][protocol] += collections.Counter(data['transfers'][protocol])
+            self.__endpoints = data.get('endpoints', {})
 
             return files_info, files_skipped, events_written, exe_exit_code, stageout_exit_code, task_exit_code
 
@@ -286,8 +440,8 @@ class ProductionTaskHandler(TaskHandler):
         super(ProductionTaskHandler, self).__init__(id_, dataset, [], lumis, outputs, taskdir)
         self._file_based = True
 
-    def adjust(self, parameters, inputs, outputs, se):
-        super(ProductionTaskHandler, self).adjust(parameters, inputs, outputs, se)
+    def adjust(self, parameters, inputs, outputs, se, shared=None):
+        super(ProductionTaskHandler, self).adjust(parameters, inputs, outputs, se, shared)
         parameters['mask']['first lumi'] = self._units[0][3]
 
     def get_unit_info(self, failed, task_update, files_info, files_skipped, events_written):
@@ -301,8 +455,8 @@ class MultiProductionTaskHandler(ProductionTaskHandler):
         super(ProductionTaskHandler, self).__init__(id_, dataset, gridpacks, lumis, outputs, taskdir)
         self._file_based = True
 
-    def adjust(self, parameters, inputs, outputs, se):
-        super(MultiProductionTaskHandler, self).adjust(parameters, inputs, outputs, se)
+    def adjust(self, parameters, inputs, outputs, se, shared=None):
+        super(MultiProductionTaskHandler, self).adjust(parameters, inputs, outputs, se, shared)
         parameters['mask']['first run'] = self._units[0][2]
         parameters['gridpack'] = True
 
@@ -8,6 +8,7 @@ import sqlite3
 import uuid
 
 from lobster import util
+from lobster.core.estimator import UnitTimeEstimator
 
 logger = logging.getLogger('lobster.unit')
 
@@ -82,10 +83,17 @@ class UnitStore:
     def __init__(self, config):
         self.uuid = str(uuid.uuid4()).replace('-', '')
         self.db_path = os.path.join(config.workdir, "lobster.db")
-        self.db = sqlite3.connect(self.db_path, timeout=90)
+        # The main loop hands database work to a helper thread, but never
+        # accesses the store from two threads at the same time.
+        self.db = sqlite3.connect(self.db_path, timeout=90, check_same_thread=False)
 
         self.config = config
 
+        # Which host processed an unfinished input file last, per
+        # workflow.  Only kept when `locality` is enabled for the storage,
+        # and only a hint: it is not preserved across restarts.
+        self.__served = defaultdict(dict)
+
         self.db.execute("""create table if not exists workflows(
             cfg text,
             dataset text,
@@ -166,6 +174,11 @@ class UnitStore:
             workdir_num_files int default 0 not null,
             foreign key(workflow) references workflows(id))""")
 
+        self.db.execute("""create table if not exists estimators(
+            workflow int primary key,
+            state text,
+            foreign key(workflow) references workflows(id))""")
+
         self.db.execute("create index if not exists index_w_label on workflows(label)")
         self.db.execute("create index if not exists index_t_workflow on tasks(workflow, status)")
         self.db.execute("create index if not exists index_t_workflowplus on tasks(workflow, status, type)")
@@ -180,6 +193,13 @@ class UnitStore:
             'select ifnull(max(id), 0) from tasks').fetchone()[0]
         return maxid
 
+    def task_summary(self):
+        """Returns a summary of the tasks, which changes whenever tasks
+        are added or change their status.
+        """
+        return list(self.db.execute(
+            'select count(*), ifnull(max(id), 0), ifnull(sum(status), 0) from tasks').fetchone())
+
     def register_dataset(self, wflow, dataset_info, taskruntime=None):
         label = wflow.label
         unique_args = wflow.unique_arguments
@@ -346,14 +366,17 @@ class UnitStore:
             )
             )
 
-            fileinfo = list(self.db.execute("""select id, filename
+            fileinfo = list(self.db.execute("""select id, filename, skipped
                         from files_{0}
                         where
                             (units_done + units_running < units) and
                             (skipped < ?)
                         order by skipped asc""".format(workflow), (self.config.advanced.threshold_for_skipping,)))
-            files = [x for (x, y) in fileinfo]
-            fileinfo = dict(fileinfo)
+            files = [x for (x, y, z) in fileinfo]
+            locality = getattr(self.config.storage, 'locality', False)
+            if locality:
+                files = self.__group_files(workflow, fileinfo)
+            fileinfo = dict((x, y) for (x, y, z) in fileinfo)
 
             tasksize = int(math.ceil(tasksize * taper))
 
@@ -369,6 +392,11 @@ class UnitStore:
                     order by file
                     """.format(workflow, ', '.join('?' for _ in chunk)), chunk))
 
+            if locality:
+                # keep the order of the files, rather than their ids
+                position = dict((f, i) for (i, f) in enumerate(files))
+                rows.sort(key=lambda row: position[row[1]])
+
             logger.debug("creating tasks from {} files, {} units".format(len(files), len(rows)))
 
             # files and lumis for individual tasks
@@ -465,6 +493,71 @@ class UnitStore:
 
             return tasks if len(unit_update) > 0 else []
 
+    def __group_files(self, workflow, fileinfo):
+        """Order files for task creation to keep data local.
+
+        Files are still ordered by how often they have been skipped.
+        Within that order, files last processed by the same host follow
+        each other, so that the input files of a task made from them are
+        cached on the same worker, where `WorkQueue` prefers to send it.
+        This only steers tasks with input files transferred by
+        `WorkQueue`.  Files without a known host come last.
+
+        Parameters
+        ----------
+            workflow : str
+                The label of the workflow.
+            fileinfo : list
+                A list of tuples of file id, filename, and how often the
+                file has been skipped.
+        """
+        served = self.__served[workflow]
+
+        def key(info):
+            id, filename, skipped = info
+            host, seen = served.get(id, (None, 0))
+            return (skipped, host is None, host, -seen)
+        return [id for (id, filename, skipped) in sorted(fileinfo, key=key)]
+
+    def partial_files(self, workflow, counts):
+        """Returns the ids of input files of `workflow` which are also read
+        by other tasks than the ones at hand.
+
+        Parameters
+        ----------
+            workflow : str
+                The label of the workflow.
+            counts : dict
+                The number of units per file id in the tasks at hand.
+        """
+        ids = list(counts.keys())
+        partial = set()
+        for i in range(0, len(ids), 40):
+            chunk = ids[i:i + 40]
+            for (id, units) in self.db.execute("""
+                    select id, units
+                    from files_{0}
+                    where id in ({1})
+                    """.format(workflow, ', '.join('?' for _ in chunk)), chunk):
+                if units > counts[id]:
+                    partial.add(id)
+        return partial
+
+    def __forget_finished(self, workflow, ids):
+        """Drop the hosts that processed the files with `ids` of
+        `workflow` from memory, if all units of the file are done.
+        """
+        served = self.__served[workflow]
+        ids = [id for id in set(ids) if id in served]
+        for i in range(0, len(ids), 40):
+            chunk = ids[i:i + 40]
+            for (id,) in self.db.execute("""
+                    select id
+                    from files_{0}
+                    where id in ({1}) and units_done >= units
+                    """.format(workflow, ', '.join('?' for _ in chunk)), chunk):
+                del served[id]
+
     def reset_units(self):
         with self.db as db:
             ids = [id for (id,) in db.execute(
@@ -482,9 +575,142 @@ class UnitStore:
                 self.update_workflow_stats(label)
         return ids
 
+    def endgame(self, label, threshold):
+        """Returns `True` if all units of the workflow `label` have been
+        assigned to tasks, and the ones still running make up less than
+        `threshold` of all units.
+        """
+        units, running, left = self.db.execute("""
+            select units, units_running, units - (units_masked + units_running + units_done + units_stuck)
+            from workflows where label=?""", (label,)).fetchone()
+        return left == 0 and 0 < running <= threshold * units
+
+    def average_runtime(self, label):
+        """Returns the average time from the start of the input transfer to
+        retrieval of successful processing tasks of the workflow `label`,
+        or `None` if there are less than 10 of them.  Time spent waiting
+        in the queue is not included.
+        """
+        tasks, runtime = self.db.execute("""
+            select count(*), avg(time_retrieved - time_transfer_in_start)
+            from tasks
+            where
+                workflow=(select id from workflows where label=?) and
+                status in (2, 6, 7, 8) and
+                type=0 and
+                time_transfer_in_start > 0""", (label,)).fetchone()
+        return runtime if tasks >= 10 else None
+
+    @retry(stop_max_attempt_number=10)
+    def pop_duplicates(self, workflow, tasks):
+        """Create duplicates of running tasks.
+
+        The units stay assigned to the original task, and are neither
+        marked as running a second time nor counted towards the new task.
+        Use :meth:`reassign_units` to hand them over to the duplicate.
+
+        Parameters
+        ----------
+            workflow : str
+                The label of the workflow.
+            tasks : list
+                The ids of the tasks to duplicate.
+
+        Returns
+        -------
+            duplicates : list
+                A list of tuples of the original task id and the task
+                information of the duplicate, in the same format as
+                :meth:`pop_units`.
+        """
+        res = []
+        with self.db:
+            workflow_id = self.db.execute("select id from workflows where label=?", (workflow,)).fetchone()[0]
+            for task in tasks:
+                units = list(self.db.execute("""
+                    select id, file, run, lumi, arg
+                    from units_{0}
+                    where task=? and status=1""".format(workflow), (task,)))
+                if len(units) == 0:
+                    continue
+
+                fileids = list(set(file for (_, file, _, _, _) in units))
+                files = list(self.db.execute(
+                    "select id, filename from files_{0} where id in ({1})".format(workflow, ', '.join('?' for _ in fileids)),
+                    fileids))
+
+                cur = self.db.cursor()
+                cur.execute("insert into tasks(workflow, status, type, units) values (?, 1, 0, ?)",
+                            (workflow_id, len(units)))
+
+                res.append((task, (
+                    str(cur.lastrowid),
+                    workflow,
+                    files,
+                    [(id, file, run, lumi) for (id, file, run, lumi, arg) in units],
+                    units[0][4],
+                    False)))
+        return res
+
+    @retry(stop_max_attempt_number=10)
+    def reassign_units(self, reassignments):
+        """Hand running units over from one task to its duplicate.
+
+        Parameters
+        ----------
+            reassignments : list
+                A list of tuples of workflow label, the id of the task
+                currently holding the units, and the id of the task to hand
+                them to.
+        """
+        with self.db:
+            for label, old, new in reassignments:
+                self.db.execute("update units_{0} set task=? where task=? and status=1".format(label), (new, old))
+
+    def __category(self, label):
+        """Returns the category of the workflow `label`, or `None` if it is
+        not part of the configuration.
+        """
+        return getattr(getattr(self.config.workflows, label, None), 'category', None)
+
+    def estimator(self, label):
+        """Returns the estimator of the processing time per unit for the
+        workflow `label`.
+        """
+        category = self.__category(label)
+        row = self.db.execute("""
+            select state
+            from estimators
+            where workflow=(select id from workflows where label=?)""", (label,)).fetchone()
+        return UnitTimeEstimator.loads(row[0] if row else None, normalize=getattr(category, 'normalize_hosts', False))
+
+    def update_estimators(self, unittimes):
+        """Add processing times per unit to the estimators.
+
+        Only workflows with a `runtime_percentile` set in their category
+        keep an estimator.
+
+        Parameters
+        ----------
+            unittimes : dict
+                Contains a list of `(time, host)` tuples for each workflow
+                label.
+        """
+        for label, times in unittimes.items():
+            if not getattr(self.__category(label), 'runtime_percentile', None):
+                continue
+            estimator = self.estimator(label)
+            for time, host in times:
+                estimator.add(time, host)
+            self.db.execute("""
+                insert or replace into estimators(workflow, state)
+                values ((select id from workflows where label=?), ?)""", (label, estimator.dumps()))
+
     @retry(stop_max_attempt_number=10)
     def update_units(self, taskinfos):
         task_updates = []
+        unittimes = defaultdict(list)
+        locality = getattr(self.config.storage, 'locality', False)
 
         with self.db:
             for ((dset, unit_source), updates) in taskinfos.items():
@@ -497,6 +723,15 @@ class UnitStore:
                     task_updates.append(task_update)
                     file_updates += file_update
 
+                    if unit_source != 'tasks' and task_update.status == SUCCESSFUL and task_update.units_processed > 0:
+                        processing = task_update.time_epilogue_end - task_update.time_stage_in_end
+                        unittimes[dset].append((processing / float(task_update.units_processed), task_update.host))
+
+                    if locality and unit_source != 'tasks' and task_update.host:
+                        for (read, skipped, id) in file_update:
+                            if not skipped:
+                                self.__served[dset][id] = (task_update.host, task_update.time_retrieved)
+
                     # units either fail or are successful
                     # FIXME this should really go into the task handler
                     if unit_source == 'tasks':
@@ -539,10 +774,15 @@ class UnitStore:
                         where id=?""".format(dset),
                                         file_updates)
 
+                    if locality and unit_source != 'tasks':
+                        self.__forget_finished(dset, [id for (_, _, id) in file_updates])
+
             query = "update tasks set {0} where id=?".format(
                 TaskUpdate.sql_fragment(stop=-1))
             self.db.executemany(query, task_updates)
 
+            self.update_estimators(unittimes)
+
             for label, _ in taskinfos.keys():
                 self.update_workflow_stats(label)
 
@@ -587,6 +827,13 @@ class UnitStore:
                 from tasks where workflow=? and status in (2, 6, 7, 8) and type=0""", (id,)).fetchone()
 
             if tasks > 10:
+                percentile = getattr(self.__category(label), 'runtime_percentile', None)
+                estimator = self.estimator(label) if percentile else None
+                if estimator and estimator.count > 10:
+                    estimate = estimator.quantile(percentile)
+                    logger.debug("{0:.0%} quantile of the processing time per unit for {1}: {2:.1f}s (average: {3:.1f}s)".format(
+                        percentile, label, estimate, unittime))
+                    unittime = max(estimate, 1)
                 bettersize = max(1, int(math.ceil(targettime / unittime)))
                 logger.debug("newly calculated task size for {}: {} (old: {})".format(
                     label, bettersize, size))
@@ -6,6 +6,7 @@ import re
 import shlex
 import shutil
 import sys
+import threading
 
 from lobster import fs, util
 from lobster.core.dataset import EmptyDataset, MultiProductionDataset, ProductionDataset
@@ -16,6 +17,11 @@ import work_queue as wq
 
 logger = logging.getLogger('lobster.workflow')
 
+# Loading parameter sets alters `sys.argv` and reuses the same module name,
+# and workflows may share sandboxes: serialize both when setting up
+# workflows concurrently.
+setup_lock = threading.RLock()
+
 
 class Category(Configurable):
 
@@ -32,6 +38,7 @@ class Category(Configurable):
     * `tasks_min`
     * `tasks_max`
     * `runtime`
+    * `runtime_percentile`
 
     Parameters
     ----------
@@ -61,6 +68,16 @@ class Category(Configurable):
             The runtime of the task in seconds.  Lobster will add a grace
             period to this time, and try to adjust the task size such that
             this runtime is achieved.
+        runtime_percentile : float
+            If set, adjust the task size such that this fraction of tasks
+            finishes within `runtime`, based on the distribution of
+            processing time per unit observed in recent tasks.  Otherwise,
+            the average processing time per unit is used.  Processing
+            times are only collected while this is set.
+        normalize_hosts : bool
+            Account for the speed of individual hosts when estimating the
+            distribution of processing time per unit, weighing hosts by
+            how many tasks they recently processed.
         tasks_max : int
             How many tasks should be in the queue (running or waiting) at
             the same time.
@@ -71,7 +88,8 @@ class Category(Configurable):
     _mutable = {
         'tasks_max': (None, [], False),
         'tasks_min': (None, [], False),
-        'runtime': ('source.update_runtime', [], True)
+        'runtime': ('source.update_runtime', [], True),
+        'runtime_percentile': (None, [], False)
     }
 
     def __init__(self,
@@ -81,12 +99,16 @@ class Category(Configurable):
                  memory=None,
                  disk=None,
                  runtime=None,
+                 runtime_percentile=None,
+                 normalize_hosts=False,
                  tasks_max=None,
                  tasks_min=None
                  ):
         self.name = name
         self.cores = cores
         self.runtime = runtime
+        self.runtime_percentile = runtime_percentile
+        self.normalize_hosts = normalize_hosts
         self.memory = memory
         self.disk = disk
         self.tasks_max = tasks_max
@@ -125,6 +147,11 @@ class Workflow(Configurable):
     """
     A specification for processing a dataset.
 
+    Attributes modifiable at runtime:
+
+    * `deadline`
+    * `priority`
+
     Parameters
     ----------
         label : str
@@ -183,8 +210,39 @@ class Workflow(Configurable):
             Tells Lobster if the output of this workflow is in EDM format.
             If `True`, cmssw will be used to merge output files. Otherwise,
             `hadd` will be used.
+        priority : float
+            The weight of this workflow when sharing cores with other
+            workflows.  Workflows with a priority of 0 only receive cores
+            not needed by any other workflow.  Only used with
+            `share_by_priority` set in the advanced options.
+        deadline : datetime.datetime
+            When this workflow should be done.  Lobster will try to
+            allocate enough cores to this workflow to process the
+            remaining units in time, based on the runtime of its category.
+            Only used with `share_by_priority` set in the advanced
+            options.
+        pipelined_runs : int
+            Overlap the stage-in of input files with processing for CMSSW
+            tasks, by running `cmsRun` up to this many times in sequence,
+            each time over the input files staged in so far.  The outputs
+            of the runs are merged on the worker, as determined by
+            `edm_output`.  Only applies to tasks with more than one input
+            file and without a limit on the number of events, which copy
+            their input files, i.e., with input streaming disabled or
+            input access via SRM or Chirp only.
+        pilot_tasks : int
+            How many tasks to run in a single Work Queue task, which
+            sets up the environment only once for all of them.  Useful
+            for short tasks, where setting up the environment takes a
+            significant part of the runtime.  The runtime limits of the
+            category apply to all tasks of a pilot together, and each
+            task is sized to take the corresponding fraction of the
+            runtime of the category.
     """
-    _mutable = {}
+    _mutable = {
+        'deadline': (None, [], False),
+        'priority': (None, [], False)
+    }
 
     def __init__(self,
                  label,
@@ -203,7 +261,11 @@ class Workflow(Configurable):
                  local=False,
                  pset=None,
                  globaltag=None,
-                 edm_output=True):
+                 edm_output=True,
+                 priority=1.,
+                 deadline=None,
+                 pipelined_runs=1,
+                 pilot_tasks=1):
         self.label = label
         if not re.match(r'^[A-Za-z][A-Za-z0-9_]*$', label):
             raise ValueError("Workflow label contains illegal characters: {}".format(label))
@@ -236,6 +298,10 @@ class Workflow(Configurable):
         self.globaltag = globaltag
         self.local = local or hasattr(dataset, 'files')
         self.edm_output = edm_output
+        self.priority = priority
+        self.deadline = deadline
+        self.pipelined_runs = pipelined_runs
+        self.pilot_tasks = pilot_tasks
 
         from lobster.cmssw.sandbox import Sandbox
         self.sandbox = sandbox or Sandbox()
@@ -244,6 +310,16 @@ class Workflow(Configurable):
         override = {'category': 'category_' + self.category.name}
         return Configurable.__repr__(self, override)
 
+    @property
+    def task_runtime(self):
+        """The runtime a single task should take, or `None` if the
+        category does not specify one.  Tasks run within a pilot share
+        the runtime of the category.
+        """
+        if not self.category.runtime:
+            return None
+        return max(1, self.category.runtime // max(1, getattr(self, 'pilot_tasks', 1)))
+
     def __check_merge(self, size):
         if size <= 0:
             return size
@@ -376,22 +452,28 @@ class Workflow(Configurable):
         archs = set()
         self.sandboxes = []
         for box in boxes:
-            version, arch, sandbox = box.package(basedirs, workdir)
+            with setup_lock:
+                version, arch, sandbox = box.package(basedirs, workdir)
             versions.add(version)
             if arch in archs:
                 raise ValueError("More than one sandbox supplied for the same architecture!")
             archs.add(arch)
-            self.sandboxes.append(sandbox)
+            # sandboxes may consist of several layers
+            if isinstance(sandbox, list):
+                self.sandboxes.extend(sandbox)
+            else:
+                self.sandboxes.append(sandbox)
         if len(versions) > 1:
             raise ValueError("More than one CMSSW version specified!")
         self.version = versions.pop()
 
         self.copy_inputs(basedirs)
-        if self.pset and self.outputs is None:
-            self.determine_outputs(basedirs)
+        with setup_lock:
+            if self.pset and self.outputs is None:
+                self.determine_outputs(basedirs)
 
-        if self.pset and self.globaltag is None:
-            self.determine_globaltag(basedirs)
+            if self.pset and self.globaltag is None:
+                self.determine_globaltag(basedirs)
 
         # Working directory for workflow
         # TODO Should we really check if this already exists?  IMO that
@@ -453,9 +535,15 @@ class Workflow(Configurable):
             if self.category.runtime:
                 # cap task runtime at desired runtime (CMSSW 7.4 and higher
                 # only)
-                params['task runtime'] = self.category.runtime
+                params['task runtime'] = self.task_runtime
             params['cores'] = self.category.cores
 
+            runs = getattr(self, 'pipelined_runs', 1)
+            if pset and runs > 1:
+                params['pipeline'] = {'runs': runs, 'edm output': self.edm_output}
+                if self.edm_output:
+                    inputs.append((os.path.join(os.path.dirname(__file__), 'data', 'merge_cfg.py'), 'merge_cfg.py', True))
+
         if pset:
             inputs.append((pset, os.path.basename(pset), True))
             outputs.append((os.path.join(taskdir, 'report.xml.gz'), 'report.xml.gz'))
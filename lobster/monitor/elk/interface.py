@@ -1093,11 +1093,11 @@ class ElkInterface(Configurable):
                 stats['time_other_lobster'] = \
                     max(stats['timestamp_diff'] -
                         stats['total_status_time'] -
-                        stats['total_create_time'] -
+                        stats['total_submit_time'] -
                         stats['total_action_time'] -
                         stats['total_update_time'] -
                         stats['total_fetch_time'] -
-                        stats['total_return_time'], 0)
+                        stats['total_sync_time'], 0)
 
                 stats['time_other_wq'] = \
                     max(stats['timestamp_diff'] - stats['time_send'] -
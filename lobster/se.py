@@ -1,17 +1,31 @@
+import errno
+import itertools
 import logging
 import os
 import random
 import re
 import snakebite.client
 import snakebite.errors
+import socket
 import subprocess
+import threading
+import time
 import xml.dom.minidom
 
+from collections import defaultdict
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from lobster.util import Configurable
 
 import Chirp as chirp
 
+try:
+    from XRootD import client as xrdclient
+    from XRootD.client import flags as xrdflags
+except ImportError:
+    xrdclient = None
+    xrdflags = None
+
 
 logger = logging.getLogger('lobster.se')
 
@@ -20,6 +34,19 @@ logger = logging.getLogger('lobster.se')
 url_re = re.compile(r'^([a-z]+)://([^/]*)(.*)/?$')
 
 
+# Errors showing that a storage element cannot be reached
+unreachable = set([
+    errno.ECONNABORTED,
+    errno.ECONNREFUSED,
+    errno.ECONNRESET,
+    errno.EHOSTDOWN,
+    errno.EHOSTUNREACH,
+    errno.ENETDOWN,
+    errno.ENETUNREACH,
+    errno.ETIMEDOUT
+])
+
+
 class FileSystem(object):
 
     """Singleton class as an interface for filesystem interactions.
@@ -27,39 +54,222 @@ class FileSystem(object):
     Needs to be configured before first use, with two lists of
     `StorageElement` implementations.  See the documentation of
     ``configure()`` for details.
+
+    Storage elements are tried in order, starting with the one that last
+    succeeded for the method and directory of the first argument.
+    Storage elements failing a method where another one succeeds, or
+    which cannot be reached, are tried last for it, until `negative_ttl`
+    seconds have passed.
     """
 
     _defaults = []
     _alternatives = []
 
+    # Storage element which last succeeded, per method and path prefix
+    _resolved = {}
+    # Expiry of the demotion of failed storage elements, per method
+    _failed = {}
+    # Number of successful and failed calls, and time spent, per
+    # storage element
+    _stats = defaultdict(lambda: [0, 0, 0.])
+
+    negative_ttl = 300
+    cache_size = 10000
+
+    # Held while the alternative methods are active
+    _switching = threading.RLock()
+    # Methods pinned by ``fs.default()`` for the current thread
+    _pinned = threading.local()
+
     def __init__(self):
         self.__file__ = __file__
         self.__name__ = 'fs'
 
+    @staticmethod
+    def __prefix(args):
+        if len(args) > 0 and isinstance(args[0], basestring):
+            return os.path.dirname(args[0])
+        return None
+
+    @staticmethod
+    def __demote(attr, failed, error=None):
+        """Try the storage elements in `failed` last for `attr`.  With an
+        `error`, only demote them if it shows that the storage could not
+        be reached, as other errors are likely shared by all storage
+        elements.
+        """
+        if error is not None and not isinstance(error, socket.timeout) \
+                and getattr(error, 'errno', None) not in unreachable:
+            return
+        expiry = time.time() + FileSystem.negative_ttl
+        for imp in failed:
+            FileSystem._failed[(attr, imp)] = expiry
+
+    @staticmethod
+    def __methods():
+        """Returns the storage elements currently in use by this thread.
+        """
+        pinned = getattr(FileSystem._pinned, 'methods', None)
+        return pinned if pinned is not None else FileSystem._defaults
+
+    def __order(self, attr, prefix, methods=None):
+        now = time.time()
+        preferred = FileSystem._resolved.get((attr, prefix))
+        good = []
+        bad = []
+        for imp in (self.__methods() if methods is None else methods):
+            if FileSystem._failed.get((attr, imp), 0) > now:
+                bad.append(imp)
+            elif imp is preferred:
+                good.insert(0, imp)
+            else:
+                good.append(imp)
+        return good + bad
+
     def __getattr__(self, attr):
         if attr in self.__dict__:
             return self.__dict__[attr]
 
+        # calls may be issued by other threads, e.g., by ``remove``
+        methods = self.__methods()
+
         def switch(*args, **kwargs):
-            logger.debug("resolving file system method '{0}' with arguments {1!r}, {2!r}".format(attr, args, kwargs))
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                logger.debug("resolving file system method '{0}' with arguments {1!r}, {2!r}".format(attr, args, kwargs))
+            prefix = self.__prefix(args)
             lasterror = None
-            for imp in FileSystem._defaults:
+            failed = []
+            for imp in self.__order(attr, prefix, methods):
+                stats = FileSystem._stats[imp]
+                start = time.time()
                 try:
-                    return imp.fixresult(getattr(imp, attr)(*map(imp.lfn2pfn, args), **kwargs))
+                    res = imp.fixresult(getattr(imp, attr)(*map(imp.lfn2pfn, args), **kwargs))
+                    stats[0] += 1
+                    stats[2] += time.time() - start
+                    if len(FileSystem._resolved) > FileSystem.cache_size:
+                        FileSystem._resolved.clear()
+                    FileSystem._resolved[(attr, prefix)] = imp
+                    FileSystem._failed.pop((attr, imp), None)
+                    self.__demote(attr, failed)
+                    return res
                 except imp.errors as e:
-                    logger.debug(
-                        "method {0} of {1} failed with {2}, using args {3}, {4}".format(attr, imp, e, args, kwargs))
+                    if debug:
+                        logger.debug(
+                            "method {0} of {1} failed with {2}, using args {3}, {4}".format(attr, imp, e, args, kwargs))
                     lasterror = e
                 except TypeError as e:
                     logger.error("binding received an unexpected type; method {0} of {1} failed with {2}, using "
                                  "args {3}, {4}".format(attr, imp, e, args, kwargs))
                     lasterror = e
+                stats[1] += 1
+                stats[2] += time.time() - start
+                failed.append(imp)
+                self.__demote(attr, [imp], lasterror)
             raise AttributeError(
                 "no resolution found for method '{0}' with arguments '{1}': {2}".format(attr, args, lasterror))
         return switch
 
+    def remove(self, *paths, **kwargs):
+        """Remove `paths`, in batches removed concurrently.
+
+        The size of the batches and the number of batches removed at the
+        same time are taken from the `remove_batch` and `remove_threads`
+        attributes of the storage element to be tried first.  All batches
+        are attempted, and the first error encountered raised afterwards.
+
+        Parameters
+        ----------
+            paths : list
+                The paths to remove.
+            progress : callable
+                Called with the number of paths removed so far and the
+                total number of paths, after each batch.
+        """
+        progress = kwargs.get('progress')
+        paths = sorted(set(paths))
+        if len(paths) == 0:
+            return
+
+        order = self.__order('remove', self.__prefix(paths))
+        if len(order) == 0:
+            return self.__getattr__('remove')(*paths)
+        batch = max(1, order[0].remove_batch)
+        threads = max(1, min(order[0].remove_threads, (len(paths) + batch - 1) // batch))
+
+        switch = self.__getattr__('remove')
+        batches = [paths[i:i + batch] for i in range(0, len(paths), batch)]
+
+        def remove(chunk):
+            try:
+                switch(*chunk)
+                return len(chunk), None
+            except Exception as e:
+                return len(chunk), e
+
+        done = 0
+        errors = []
+        last = time.time()
+        pool = ThreadPool(threads) if threads > 1 else None
+        try:
+            results = pool.imap_unordered(remove, batches) if pool else (remove(b) for b in batches)
+            for count, error in results:
+                done += count
+                if error:
+                    errors.append(error)
+                if progress:
+                    progress(done, len(paths))
+                if len(batches) > 1 and (time.time() - last > 10 or done == len(paths)):
+                    logger.info("removed {0} of {1} paths".format(done, len(paths)))
+                    last = time.time()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        if len(errors) > 0:
+            raise errors[0]
+
+    def iterls(self, path):
+        """List `path`, yielding entries as they are returned by the storage
+        element, instead of collecting them first like ``ls``.
+
+        Only failures before the first entry is listed fall back to the
+        next storage element.
+        """
+        prefix = self.__prefix([path])
+        lasterror = None
+        failed = []
+        for imp in self.__order('ls', prefix):
+            try:
+                entries = iter(imp.ls(imp.lfn2pfn(path)))
+                first = next(entries, None)
+            except imp.errors as e:
+                FileSystem._stats[imp][1] += 1
+                failed.append(imp)
+                self.__demote('ls', [imp], e)
+                lasterror = e
+                continue
+            FileSystem._stats[imp][0] += 1
+            FileSystem._resolved[('ls', prefix)] = imp
+            self.__demote('ls', failed)
+            if first is None:
+                return
+            yield imp.fixresult(first)
+            for entry in entries:
+                yield imp.fixresult(entry)
+            return
+        raise AttributeError(
+            "no resolution found for method 'iterls' with arguments '{0}': {1}".format(path, lasterror))
+
+    def statistics(self):
+        """Returns the number of successful and failed calls, and the time
+        spent in them, per storage element.
+        """
+        return dict((repr(imp), {'hits': hits, 'misses': misses, 'time': spent})
+                    for imp, (hits, misses, spent) in FileSystem._stats.items())
+
     def lfn2pfn(self, lfn, instance):
-        for imp in FileSystem._defaults:
+        for imp in self.__methods():
             if isinstance(imp, instance):
                 return imp.lfn2pfn(lfn)
 
@@ -80,15 +290,37 @@ class FileSystem(object):
         """
         cls._defaults = defaults
         cls._alternatives = alternatives
+        cls._resolved.clear()
+        cls._failed.clear()
 
     @contextmanager
     def alternative(self):
-        tmp = FileSystem._defaults
-        FileSystem._defaults = FileSystem._alternatives
+        with FileSystem._switching:
+            tmp = FileSystem._defaults
+            FileSystem._defaults = FileSystem._alternatives
+            try:
+                yield
+            finally:
+                FileSystem._defaults = tmp
+
+    @contextmanager
+    def default(self):
+        """Ensure that the default methods are used by the current thread
+        within the context.
+
+        As ``fs.alternative()`` affects all threads, this waits for other
+        threads to leave it, but only to look up the default methods.
+        Other threads may switch to the alternative methods while this
+        context is active.
+        """
+        with FileSystem._switching:
+            methods = FileSystem._defaults
+        previous = getattr(FileSystem._pinned, 'methods', None)
+        FileSystem._pinned.methods = methods
         try:
             yield
         finally:
-            FileSystem._defaults = tmp
+            FileSystem._pinned.methods = previous
 
 
 class StorageElement(object):
@@ -99,6 +331,11 @@ class StorageElement(object):
     implementations.
     """
 
+    # How many paths to pass to `remove` at once, and how many calls of
+    # `remove` to run at the same time
+    remove_batch = 100
+    remove_threads = 4
+
     def __init__(self, pfnprefix):
         """Baseclass of a storage element.
 
@@ -112,6 +349,9 @@ class StorageElement(object):
         if not self._pfnprefix.endswith('/'):
             self._pfnprefix += '/'
 
+    def __repr__(self):
+        return '{0}({1})'.format(self.__class__.__name__, self._pfnprefix)
+
     @property
     def errors(self):
         return (IOError, OSError)
@@ -160,6 +400,8 @@ class StorageElement(object):
 
 class Local(StorageElement):
 
+    remove_threads = 8
+
     def __init__(self, pfnprefix=''):
         super(Local, self).__init__(pfnprefix)
         self.exists = os.path.exists
@@ -191,16 +433,31 @@ class Local(StorageElement):
     def remove(self, *paths):
         for path in paths:
             try:
-                os.remove(path)
+                if os.path.isdir(path):
+                    os.rmdir(path)
+                else:
+                    os.remove(path)
             except OSError:
                 pass
 
 
 class Hadoop(StorageElement):
 
+    # the client is not thread-safe, but deletes many paths at once
+    remove_batch = 1000
+    remove_threads = 1
+
     def __init__(self, host, port, pfnprefix='/hadoop'):
         super(Hadoop, self).__init__(pfnprefix)
         self.__c = snakebite.client.Client(host, int(port))
+        # the client may be used by several threads, but can only handle
+        # one request at a time
+        self.__lock = threading.RLock()
+
+    def __call(self, method, paths, **kwargs):
+        with self.__lock:
+            res = getattr(self.__c, method)(paths, **kwargs)
+            return res if isinstance(res, dict) else list(res)
 
     @property
     def errors(self):
@@ -208,30 +465,32 @@ class Hadoop(StorageElement):
 
     def exists(self, path):
         try:
-            self.__c.stat([path])
+            self.__call('stat', [path])
             return True
         except snakebite.errors.FileNotFoundException:
             return False
 
     def getsize(self, path):
-        return self.__c.stat([path])['blocksize']
+        return self.__call('stat', [path])['blocksize']
 
     def isdir(self, path):
-        return self.__c.stat([path])['file_type'] == 'd'
+        return self.__call('stat', [path])['file_type'] == 'd'
 
     def isfile(self, path):
-        return self.__c.stat([path])['file_type'] == 'f'
+        return self.__call('stat', [path])['file_type'] == 'f'
 
     def ls(self, path):
-        for data in self.__c.ls([path]):
-            yield data['path']
+        # the listing is requested while iterating, and holds the client
+        # until done
+        with self.__lock:
+            for data in self.__c.ls([path]):
+                yield data['path']
 
     def mkdir(self, path, mode):
-        for data in self.__c.mkdir([path], mode=mode):
-            pass
+        self.__call('mkdir', [path], mode=mode)
 
     def permissions(self, path):
-        return self.__c.stat([path])['permission']
+        return self.__call('stat', [path])['permission']
 
     def remove(self, *paths):
         """Remove paths.
@@ -244,65 +503,82 @@ class Hadoop(StorageElement):
 
         """
         try:
-            for data in self.__c.delete(list(paths)):
-                pass
+            self.__call('delete', list(paths))
         except snakebite.errors.FileNotFoundException:
             for path in paths:
                 try:
-                    self.__c.delete([path]).next()
+                    self.__call('delete', [path])
                 except snakebite.errors.FileNotFoundException:
                     pass
 
 
 class Chirp(StorageElement):
 
+    # requests share one connection
+    remove_threads = 1
+
     def __init__(self, server, pfnprefix):
         super(Chirp, self).__init__(pfnprefix)
 
         self.__c = chirp.Client(server, timeout=10)
+        # the connection may be used by several threads
+        self.__lock = threading.Lock()
+
+    def __call(self, method, path, *args):
+        with self.__lock:
+            return getattr(self.__c, method)(str(path), *args)
 
     def exists(self, path):
         try:
-            self.__c.stat(str(path))
+            self.__call('stat', path)
             return True
         except IOError:
             return False
 
     def getsize(self, path):
-        return self.__c.stat(str(path)).size
+        return self.__call('stat', path).size
 
     def isdir(self, path):
-        return len(self.__c.ls(str(path))) > 0
+        return len(self.__call('ls', path)) > 0
 
     def isfile(self, path):
-        return len(self.__c.ls(str(path))) == 0
+        return len(self.__call('ls', path)) == 0
 
     def ls(self, path):
-        for f in self.__c.ls(str(path)):
+        for f in self.__call('ls', path):
             if f.path not in ('.', '..'):
                 yield os.path.join(path, f.path)
 
     def mkdir(self, path, mode=None):
-        self.__c.mkdir(str(path))
+        self.__call('mkdir', path)
         if mode:
-            self.__c.chmod(str(path), mode)
+            self.__call('chmod', path, mode)
 
     def permissions(self, path):
-        return self.__c.stat(str(path)).mode & 0777
+        return self.__call('stat', path).mode & 0777
 
     def remove(self, *paths):
         for path in paths:
-            self.__c.rm(str(path))
+            try:
+                self.__call('rm', path)
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
 
 
 class SRM(StorageElement):
 
+    # The prefix of the command line utilities to use
+    gfal = 'gfal-'
+
+    remove_batch = 50
+
     def __init__(self, pfnprefix):
         super(SRM, self).__init__(pfnprefix)
 
     def execute(self, cmd, *paths, **kwargs):
         cmds = cmd.split()
-        args = ['gfal-' + cmds[0]] + cmds[1:] + list(paths)
+        args = [self.gfal + cmds[0]] + cmds[1:] + list(paths)
         try:
             p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env={})
             pout, err = p.communicate()
@@ -355,100 +631,362 @@ class SRM(StorageElement):
     def remove(self, *paths):
         while len(paths) != 0:
             # FIXME safe is active because SRM does not care about directories.
-            self.execute('rm -r', *(paths[:50]), safe=True)
-            paths = paths[50:]
+            self.execute('rm -r', *(paths[:self.remove_batch]), safe=True)
+            paths = paths[self.remove_batch:]
+
+
+class XrdfsSession(object):
+
+    """Access to an XrootD server via the `xrdfs` command line utility.
+
+    Spawns one process per request, and is used when the XrootD python
+    bindings are not available.  See :class:`XrootDSession` for the
+    interface.
+    """
+
+    def __init__(self, server, executable='xrdfs'):
+        self.server = server
+        self.executable = executable
+
+    def execute(self, *args):
+        args = [self.executable, self.server] + list(args)
+        try:
+            p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env={})
+            pout, err = p.communicate()
+        except OSError:
+            raise AttributeError("xrd utilities not available")
+        if p.returncode != 0:
+            error = IOError("Failed to execute '{0}':\n{1}\n{2}".format(' '.join(args), err, pout))
+            if 'No such file' in err:
+                error.errno = errno.ENOENT
+            return error, None
+        return None, pout
+
+    def stat(self, paths):
+        res = []
+        for path in paths:
+            error, output = self.execute('stat', path)
+            if error:
+                res.append((error, None))
+                continue
+            size = None
+            isdir = False
+            for line in output.splitlines():
+                if ':' not in line:
+                    continue
+                field, value = line.split(':', 1)
+                if field == 'Size':
+                    size = int(value.strip())
+                elif field == 'Flags':
+                    # Do some silly stuff to get the flags...
+                    isdir = 'IsDir' in value.split()[-1].strip('()').split('|')
+            res.append((None, (size, isdir)))
+        return res
+
+    def ls(self, path):
+        error, output = self.execute('ls', path)
+        if error:
+            raise error
+        return output.splitlines()
+
+    def mkdir(self, path, mode=None):
+        error, _ = self.execute('mkdir', '-p', path)
+        if error:
+            raise error
+
+    def rm(self, paths):
+        return [self.execute('rm', path)[0] for path in paths]
+
+    def rmdir(self, paths):
+        return [self.execute('rmdir', path)[0] for path in paths]
+
+
+class XrootDSession(object):
+
+    """A persistent session with an XrootD server.
+
+    Uses the XrootD python bindings, with requests for many paths issued
+    asynchronously over the same connection.  Batched methods return a
+    list with an error (or `None`) per path, paired with the result where
+    applicable.
+
+    Parameters
+    ----------
+        server : str
+            The server to connect to, including the port, if needed.
+        client : module
+            The XrootD client module to use.
+        flags : module
+            The XrootD flags module to use.
+        batch : int
+            How many requests to have in flight at the same time.
+        timeout : int
+            The timeout for individual requests, in seconds.
+    """
+
+    def __init__(self, server, client, flags, batch=100, timeout=300):
+        self.server = server
+        self.flags = flags
+        self.batch = batch
+        self.timeout = timeout
+        self.__fs = client.FileSystem('root://' + server)
+
+    class Response(object):
+
+        def __init__(self):
+            self.__done = threading.Event()
+            self.result = None
+
+        def __call__(self, status, response, hostlist=None):
+            self.result = (status, response)
+            self.__done.set()
+
+        def wait(self):
+            self.__done.wait()
+            return self.result
+
+    def __run(self, method, paths, **kwargs):
+        res = []
+        for i in range(0, len(paths), self.batch):
+            pending = []
+            for path in paths[i:i + self.batch]:
+                response = XrootDSession.Response()
+                status = getattr(self.__fs, method)(path, timeout=self.timeout, callback=response, **kwargs)
+                pending.append((path, status, response))
+            for path, status, response in pending:
+                if status.ok:
+                    status, result = response.wait()
+                else:
+                    result = None
+                if status.ok:
+                    res.append((None, result))
+                else:
+                    error = IOError("Failed to {0} {1} on {2}: {3}".format(method, path, self.server, status.message))
+                    if getattr(status, 'errno', None) == 3011:
+                        # kXR_NotFound
+                        error.errno = errno.ENOENT
+                    res.append((error, None))
+        return res
+
+    def stat(self, paths):
+        isdir = self.flags.StatInfoFlags.IS_DIR
+        return [(e, None if e else (info.size, bool(info.flags & isdir)))
+                for (e, info) in self.__run('stat', list(paths))]
+
+    def ls(self, path):
+        error, listing = self.__run('dirlist', [path])[0]
+        if error:
+            raise error
+        return [os.path.join(path, entry.name) for entry in listing]
+
+    def mkdir(self, path, mode=None):
+        error, _ = self.__run('mkdir', [path], flags=self.flags.MkDirFlags.MAKEPATH)[0]
+        if error:
+            raise error
+
+    def rm(self, paths):
+        return [e for (e, _) in self.__run('rm', list(paths))]
+
+    def rmdir(self, paths):
+        return [e for (e, _) in self.__run('rmdir', list(paths))]
 
 
 class XrootD(StorageElement):
 
+    """Storage access via XrootD.
+
+    Keeps one session per server, using the XrootD python bindings when
+    available, and the `xrdfs` command line utility otherwise.  Requests
+    for multiple paths are batched per server.
+    """
+
+    # The command line utility to fall back to
+    xrdfs = 'xrdfs'
+    _sessions = {}
+
+    remove_batch = 200
+
     def __init__(self, pfnprefix):
         super(XrootD, self).__init__(pfnprefix)
 
-    def execute(self, cmd, *paths, **kwargs):
-        cmds = cmd.split()
+    @classmethod
+    def session(cls, server):
+        if server not in cls._sessions:
+            if xrdclient:
+                cls._sessions[server] = XrootDSession(server, xrdclient, xrdflags)
+            else:
+                cls._sessions[server] = XrdfsSession(server, cls.xrdfs)
+        return cls._sessions[server]
 
-        output = []
-        for path in paths:
-            # Break the path into server and directory
+    def __split(self, paths):
+        # Groups paths by server, keeping track of their position
+        res = defaultdict(list)
+        for n, path in enumerate(paths):
             protocol, server, path = url_re.match(path).groups()
-            args = ['xrdfs', server] + cmds + [path]
-            try:
-                p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env={})
-                pout, err = p.communicate()
-                if p.returncode != 0 and not kwargs.get('safe', False):
-                    msg = "Failed to execute '{0}':\n{1}\n{2}".format(' '.join(args), err, pout)
-                    raise IOError(msg)
-                output.append(pout)
-            except OSError:
-                raise AttributeError("xrd utilities not available")
-        return '/n'.join(output)
+            res[(protocol, server)].append((n, path.rstrip('/') or '/'))
+        return res
+
+    def stat(self, *paths):
+        """Returns the size and whether it is a directory for every path,
+        or `None` if it cannot be accessed.
+        """
+        res = [None] * len(paths)
+        for (_, server), items in self.__split(paths).items():
+            for (n, _), (error, info) in zip(items, self.session(server).stat([p for (_, p) in items])):
+                res[n] = info
+        return res
 
     def exists(self, path):
         try:
-            self.execute('stat', path)
-            return True
+            return self.stat(path)[0] is not None
         except Exception:
             return False
 
     def getsize(self, path):
-        output = self.execute('stat', path)
-        for line in output.splitlines():
-            field, value = line.split(':')
-            if field == 'Size':
-                return value.strip()
-        # Shouldn't get here unless we don't find the size.  Raise an exception
-        msg = 'xrdfs stat did not return file size.  Command output:\n{}'.format(output)
-        raise AttributeError(msg)
+        info = self.stat(path)[0]
+        if info is None or info[0] is None:
+            raise IOError("xrootd stat did not return a file size for {0}".format(path))
+        return info[0]
 
     def isdir(self, path):
         try:
-            output = self.execute('stat', path)
-            for line in output.splitlines():
-                field, value = line.split(':', 1)
-                if field == 'Flags':
-                    # Do some silly stuff to get the flags...
-                    flags = value.split()[-1].strip('()').split('|')
-                    return 'IsDir' in flags
-
-            # If we got here, never found any mention of flags, just say false.
-            return False
+            info = self.stat(path)[0]
+            return info is not None and info[1]
         except Exception:
             return False
 
     def isfile(self, path):
         try:
-            output = self.execute('stat', path)
-            for line in output.splitlines():
-                field, value = line.split(':', 1)
-                if field == 'Flags':
-                    # Do some silly stuff to get the flags...
-                    flags = value.split()[-1].strip('()').split('|')
-                    return 'IsDir' not in flags
-
-            # If we got here, never found any mention of flags, just say false.
-            return False
+            info = self.stat(path)[0]
+            return info is not None and not info[1]
         except Exception:
             return False
 
     def ls(self, path):
-        protocol, server, _ = url_re.match(path).groups()
-        for p in self.execute('ls', path).splitlines():
+        protocol, server, directory = url_re.match(path).groups()
+        for p in self.session(server).ls(directory.rstrip('/') or '/'):
             # We need to add the protocol back so that `lfn2pfn` above
             # can recognize and remove just the pfnprefix.
             yield "{0}://{1}{2}".format(protocol, server, p)
 
     def mkdir(self, path, mode=None):
-        self.execute('mkdir -p', path)
+        protocol, server, path = url_re.match(path).groups()
+        self.session(server).mkdir(path.rstrip('/') or '/', mode)
+
+    def makedirs(self, path):
+        # Parents are created by the server, and permissions can't be
+        # queried to copy them
+        self.mkdir(path)
 
     def remove(self, *paths):
-        # It doesn't seem like Xrdfs supports either recursive or batch removal, so let's do it one at a time.
-        for path in paths:
-            if self.isdir(path):
-                for dirpath in self.ls(path):
-                    self.remove(dirpath)  # Recursive because the directory might contain directories
-                self.execute('rmdir', path)
+        # XrootD does not support recursive removal, so contents of
+        # directories are removed level by level, batching all requests.
+        if len(paths) == 0:
+            return
+
+        files = []
+        dirs = []
+        for path, info in zip(paths, self.stat(*paths)):
+            if info is None:
+                files.append(path)
+            elif info[1]:
+                dirs.append(path)
             else:
-                self.execute('rm', path)
+                files.append(path)
+
+        contents = []
+        for path in dirs:
+            contents.extend(self.ls(path))
+        self.remove(*contents)
+
+        errors = []
+        for method, targets in (('rm', files), ('rmdir', dirs)):
+            for (protocol, server), items in self.__split(targets).items():
+                session = self.session(server)
+                errors += [e for e in getattr(session, method)([p for (_, p) in items])
+                           if e and e.errno != errno.ENOENT]
+        if len(errors) > 0:
+            raise errors[0]
+
+
+class EndpointHealth(object):
+
+    """Keeps a rolling score of the storage endpoints used by tasks.
+
+    Every stage-in and stage-out attempt reported by the tasks updates
+    exponentially weighted averages of the success rate and the time
+    taken per attempt of the endpoint, so that recent attempts dominate
+    the score.  Endpoints without any reported attempts are considered
+    healthy.
+
+    Parameters
+    ----------
+        weight : float
+            The weight of a single attempt in the averages.
+        granularity : float
+            The resolution with which success rates are compared when
+            ordering endpoints.  Endpoints with success rates within the
+            same bin are ordered by the time taken per attempt.
+    """
+
+    def __init__(self, weight=0.05, granularity=0.1):
+        self.weight = weight
+        self.granularity = granularity
+        self.__scores = {}
+
+    def record(self, endpoints):
+        """Add the attempts of a task report, given as a dictionary
+        mapping endpoint URLs to the number of successful and failed
+        attempts and the total time they took.
+        """
+        for url, stats in endpoints.items():
+            attempts = stats.get('success', 0) + stats.get('failure', 0)
+            if attempts == 0:
+                continue
+            rate, latency = self.__scores.get(url, (1., None))
+            keep = (1. - self.weight) ** attempts
+            rate = keep * rate + (1. - keep) * float(stats.get('success', 0)) / attempts
+            mean = float(stats.get('time', 0)) / attempts
+            latency = mean if latency is None else keep * latency + (1. - keep) * mean
+            self.__scores[url] = (rate, latency)
+
+    def score(self, url):
+        """Returns the success rate and the time per attempt of the
+        endpoint `url`, or `None` for the time if no attempts have been
+        reported.
+        """
+        return self.__scores.get(url, (1., None))
+
+    def order(self, urls, exploration=0.):
+        """Returns `urls` ordered by the health of the endpoints.
+
+        Endpoints are ordered by their success rate first.  Within the
+        same bin of success rates, endpoints with reports are ordered by
+        the time taken per attempt, while endpoints without reports keep
+        their configured position, and never pass an endpoint with
+        reports.  With a probability of `exploration`, endpoints which
+        were demoted by their success rate are moved up by one place,
+        so that endpoints which have recovered receive traffic again.
+        """
+        def rank(url):
+            return -round(self.score(url)[0] / self.granularity)
+
+        ordered = []
+        for _, group in itertools.groupby(sorted(urls, key=rank), key=rank):
+            group = list(group)
+            measured = iter(sorted(
+                (u for u in group if self.score(u)[1] is not None),
+                key=lambda u: self.score(u)[1]))
+            ordered.extend(u if self.score(u)[1] is None else next(measured) for u in group)
+
+        if random.random() < exploration:
+            i = 1
+            while i < len(ordered):
+                if rank(ordered[i]) > rank(ordered[i - 1]):
+                    ordered[i - 1], ordered[i] = ordered[i], ordered[i - 1]
+                    i += 1
+                i += 1
+        return ordered
 
 
 class StorageConfiguration(Configurable):
@@ -476,6 +1014,7 @@ class StorageConfiguration(Configurable):
 
     * `input`
     * `output`
+    * `exploration`
 
     Parameters
     ----------
@@ -502,10 +1041,40 @@ class StorageConfiguration(Configurable):
             for the first successful one, which will then be used to access
             the remaining input files.  By using this setting, all input
             URLs will be attempted for all input files.
+        stage_in_threads : int
+            How many input files a task should stage in at the same time.
+            The order of input files passed to the executable is not
+            affected.
+        stage_out_threads : int
+            How many output files a task should stage out at the same
+            time.
+        locality : bool
+            Try to keep input data close to the workers processing it:
+            units of the same input file are grouped into consecutive
+            tasks.  Input files transferred by `WorkQueue` and read by
+            several tasks, including ones created at a different time,
+            are cached on the workers, and `WorkQueue` sends tasks
+            preferably to the workers already holding them.  Input files
+            recently processed by the same host are grouped together, so
+            that the cached inputs of a task are on the same worker.
+            Tasks reading their input files directly from the storage
+            element, e.g., via XrootD, are not steered to any worker.
+        removal : dict
+            Tuning of the removal of files on the master, per protocol, as
+            in ``{'root': {'threads': 8, 'batch': 500}}``.  `threads`
+            sets how many removal requests run at the same time, and
+            `batch` how many paths each of them removes.
+        exploration : float
+            Input and output URLs are passed to tasks ordered by the
+            health of their endpoints, as reported by previous tasks.
+            This is the fraction of tasks for which endpoints demoted by
+            their failures are moved up by one place, so that endpoints
+            which have recovered are used again.
     """
     _mutable = {
         'input': ('config.storage.activate', [], False),
-        'output': ('config.storage.activate', [], False)
+        'output': ('config.storage.activate', [], False),
+        'exploration': (None, [], False)
     }
 
     # Map protocol shorthands to actual protocol names
@@ -527,7 +1096,12 @@ class StorageConfiguration(Configurable):
                  shuffle_inputs=False,
                  shuffle_outputs=False,
                  disable_input_streaming=False,
-                 disable_stage_in_acceleration=False):
+                 disable_stage_in_acceleration=False,
+                 stage_in_threads=1,
+                 stage_out_threads=1,
+                 locality=False,
+                 removal=None,
+                 exploration=0.1):
         if input is None:
             self.input = []
         else:
@@ -543,6 +1117,12 @@ class StorageConfiguration(Configurable):
 
         self.disable_input_streaming = disable_input_streaming
         self.disable_stage_in_acceleration = disable_stage_in_acceleration
+        self.stage_in_threads = stage_in_threads
+        self.stage_out_threads = stage_out_threads
+
+        self.locality = locality
+        self.removal = removal or {}
+        self.exploration = exploration
 
         logger.debug("using input location {0}".format(self.input))
         logger.debug("using output location {0}".format(self.output))
@@ -593,6 +1173,12 @@ class StorageConfiguration(Configurable):
         """
         return self.use_work_queue_for_inputs
 
+    def cache_inputs(self):
+        """Indicates whether input files transferred manually should be
+        cached on the workers, if they are read by several tasks.
+        """
+        return getattr(self, 'locality', False)
+
     def transfer_outputs(self):
         """Indicates whether output files need to be transferred manually.
         """
@@ -616,21 +1202,30 @@ class StorageConfiguration(Configurable):
 
             if protocol == 'chirp':
                 try:
-                    yield Chirp(server, path)
+                    imp = Chirp(server, path)
                 except chirp.AuthenticationFailure:
                     if failures:
                         raise AttributeError("cannot access chirp server")
+                    continue
             elif protocol == 'file':
-                yield Local(path)
+                imp = Local(path)
             elif protocol == 'hdfs':
                 host, port = server.split(':')
-                yield Hadoop(host, port, path)
+                imp = Hadoop(host, port, path)
             elif protocol == 'srm':
-                yield SRM(url)
+                imp = SRM(url)
             elif protocol == 'root':
-                yield XrootD(url)
+                imp = XrootD(url)
             else:
                 logger.debug("implementation of master access missing for URL {0}".format(url))
+                continue
+
+            tuning = getattr(self, 'removal', {}).get(protocol, {})
+            if 'threads' in tuning:
+                imp.remove_threads = int(tuning['threads'])
+            if 'batch' in tuning:
+                imp.remove_batch = int(tuning['batch'])
+            yield imp
 
     def activate(self, failures=True):
         """Sets file system access methods.
@@ -643,7 +1238,7 @@ class StorageConfiguration(Configurable):
             list(self._initialize(self.input, failures))
         )
 
-    def preprocess(self, parameters, merge):
+    def preprocess(self, parameters, merge, health=None):
         """Adjust the storage transfer parameters sent with a task.
 
         Parameters
@@ -653,14 +1248,26 @@ class StorageConfiguration(Configurable):
             'input', 'output', and 'disable streaming'.
         merge : bool
             Specify if this is a merging parameter set.
+        health : EndpointHealth
+            The health of the storage endpoints, used to order the
+            input and output URLs.
         """
         if self.shuffle_inputs:
             random.shuffle(self.input)
         if self.shuffle_outputs or (self.shuffle_inputs and merge):
             random.shuffle(self.output)
 
-        parameters['input'] = self.input if not merge else self.output
-        parameters['output'] = self.output
+        inputs = self.input if not merge else self.output
+        outputs = self.output
+        if health:
+            exploration = getattr(self, 'exploration', 0.1)
+            inputs = health.order(inputs, exploration)
+            outputs = health.order(outputs, exploration)
+
+        parameters['input'] = inputs
+        parameters['output'] = outputs
         parameters['disable streaming'] = self.disable_input_streaming
         if not self.disable_stage_in_acceleration:
             parameters['accelerate stage-in'] = 3
+        parameters['stage-in threads'] = getattr(self, 'stage_in_threads', 1)
+        parameters['stage-out threads'] = getattr(self, 'stage_out_threads', 1)
@@ -40,14 +40,15 @@ def boil():
 
         if util.checkpoint(cfg.workdir, 'version'):
             cfg = config.Config.load(cfg.workdir)
-        elif args.plugin.__class__.__name__.lower() == 'process':
+        elif args.plugin.__class__.__name__.lower() in ('process', 'sandbox', 'bench'):
             # This is the original configuration file!
             with util.PartiallyMutable.unlock():
                 cfg.base_directory = os.path.abspath(os.path.dirname(args.checkpoint))
                 cfg.base_configuration = os.path.abspath(args.checkpoint)
                 cfg.startup_directory = os.path.abspath(os.getcwd())
-                for w in cfg.workflows:
-                    w.validate()
+                if args.plugin.__class__.__name__.lower() == 'process':
+                    for w in cfg.workflows:
+                        w.validate()
         else:
             parser.error("""
                 Cannot find working directory at '{0}'.
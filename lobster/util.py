@@ -9,6 +9,7 @@
 # scope.
 
 import collections
+import hashlib
 import inspect
 import json
 import logging
@@ -17,6 +18,7 @@ import shlex
 import shutil
 import smtplib
 import subprocess
+import threading
 import time
 
 from contextlib import contextmanager
@@ -43,6 +45,8 @@ class PartiallyMutable(type):
     constructed.
     """
     _actions = set()
+    _unlocked = 0
+    _unlock_guard = threading.Lock()
 
     def __init__(cls, name, bases, attrs):
         key = '_mutable'
@@ -83,9 +87,18 @@ class PartiallyMutable(type):
     @classmethod
     @contextmanager
     def unlock(cls):
-        cls._fixed = False
-        yield
-        cls._fixed = True
+        # Nested or concurrent unlocks from different threads must not
+        # re-lock objects while another one is still modifying them.
+        with cls._unlock_guard:
+            cls._unlocked += 1
+            cls._fixed = False
+        try:
+            yield
+        finally:
+            with cls._unlock_guard:
+                cls._unlocked -= 1
+                if cls._unlocked == 0:
+                    cls._fixed = True
 
     @classmethod
     def changes(cls):
@@ -323,6 +336,22 @@ def id2dir(id):
     return os.path.join(oku, man)
 
 
+def checksum(*paths):
+    """Calculate a combined SHA1 digest of the contents of `paths`.
+
+    Paths that are not files only contribute their name, so that files
+    appearing or vanishing change the digest.
+    """
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(path)
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
 def findpath(dirs, path):
     if len(dirs) == 0:
         return path
@@ -0,0 +1,27 @@
+import unittest
+
+from lobster import se
+from lobster.commands.bench import Bench, StandIns, Transfers, parse_size
+
+
+class TestBench(unittest.TestCase):
+
+    def test_parse_size(self):
+        assert parse_size('10') == 10
+        assert parse_size('1k') == 1024
+        assert parse_size('1.5M') == 3 * 512 * 1024
+
+    def test_standins(self):
+        with StandIns() as standins:
+            transfers = Transfers(standins.env)
+            for url in standins.urls:
+                summary = Bench().benchmark(url, 3, 2048, transfers).summary()
+                assert all(stats['failures'] == 0 for stats in summary.values()), (url, summary)
+                assert summary['exists']['calls'] == 3
+                assert summary['remove']['files per second'] > 0
+                assert summary['stage-in']['bytes per second'] > 0
+                if not url.startswith('root://'):
+                    assert summary['stage-out']['bytes per second'] > 0
+                else:
+                    assert 'stage-out' not in summary
+        assert se.SRM.gfal == 'gfal-'
@@ -8,7 +8,7 @@ from lobster.cmssw.dataset import DatasetInfo
 from lobster.core.task import TaskHandler
 from lobster.core.unit import TaskUpdate, UnitStore
 from lobster.core.config import Config, AdvancedOptions
-from lobster.core.workflow import Workflow
+from lobster.core.workflow import Category, Workflow
 
 
 class DummyInterface(object):
@@ -196,6 +196,44 @@ class TestSQLBackend(object):
         assert stop_on_file_boundary == 1
         # }}}
 
+    def test_average_runtime(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_dbs_dataset('test_average_runtime', lumis=20, filesize=2.2, tasksize=2))
+        (id,) = self.interface.db.execute("select id from workflows where label='test_average_runtime'").fetchone()
+        with self.interface.db as db:
+            db.executemany("""
+                insert into tasks(workflow, status, type, time_submit, time_transfer_in_start, time_retrieved)
+                values (?, 2, 0, 100, ?, ?)""", [(id, 1000 + i, 1600 + i) for i in range(9)])
+        assert self.interface.average_runtime('test_average_runtime') is None
+
+        with self.interface.db as db:
+            db.execute("""
+                insert into tasks(workflow, status, type, time_submit, time_transfer_in_start, time_retrieved)
+                values (?, 2, 0, 100, 1000, 1600)""", (id,))
+        # the time queued is not part of the runtime
+        assert self.interface.average_runtime('test_average_runtime') == 600
+        # }}}
+
+    def test_pilot_runtime(self):
+        # {{{
+        wflow = Workflow('test_pilot_runtime', None, category=Category('test', runtime=3600), pilot_tasks=4)
+        assert wflow.task_runtime == 900
+        assert wflow.category.wq()['wall_time'] >= wflow.pilot_tasks * wflow.task_runtime * 10 ** 6
+        assert Workflow('test_runtime', None, category=Category('test', runtime=3600)).task_runtime == 3600
+        # }}}
+
+    def test_partial_files(self):
+        # {{{
+        self.interface.register_dataset(
+            *self.create_dbs_dataset('test_partial_files', lumis=20, filesize=2.2, tasksize=2))
+        (id, label, files, lumis, arg, _) = self.interface.pop_units('test_partial_files', 1)[0]
+
+        assert [fid for (fid, fn) in files] == [1]
+        assert self.interface.partial_files(label, {1: len(lumis)}) == set([1])
+        assert self.interface.partial_files(label, {1: 3}) == set()
+        # }}}
+
     def test_return_good(self):
         # {{{
         self.interface.register_dataset(
@@ -245,6 +283,9 @@ class TestSQLBackend(object):
         assert jr == 0
         assert jd == 3
         assert er == 60
+
+        # not configured to size tasks by a percentile
+        assert self.interface.db.execute("select count(*) from estimators").fetchone()[0] == 0
         # }}}
 
     def test_return_good_split(self):
@@ -30,8 +30,8 @@ class TestSandbox(unittest.TestCase):
 
     def test_include(self):
         sandbox = lobster.cmssw.sandbox.Sandbox(release='data/sandbox/CMSSW_1_2_3', include=['Foo/mydir'])
-        version, arch, box = sandbox.package([os.path.dirname(__file__)], self.workdir)
-        files = [f.name for f in tarfile.open(box)]
+        version, arch, (release, user) = sandbox.package([os.path.dirname(__file__)], self.workdir)
+        files = [f.name for f in tarfile.open(user)]
         assert 'CMSSW_2_3_4/src/Foo/mydir' in files
 
     def test_recycle(self):
@@ -40,11 +40,30 @@ class TestSandbox(unittest.TestCase):
 
         tmpdir = os.path.join(self.workdir, 'tmpbox')
         os.makedirs(tmpdir)
-        shutil.move(box, tmpdir)
-        box = os.path.join(tmpdir, os.path.basename(box))
+        for layer in box:
+            shutil.move(layer, tmpdir)
+        box = [os.path.join(tmpdir, os.path.basename(layer)) for layer in box]
 
         sandbox2 = lobster.cmssw.sandbox.Sandbox(recycle=box)
         version2, arch2, box2 = sandbox2.package([os.path.dirname(__file__)], self.workdir)
 
         assert version2 == version
         assert arch2 == arch
+        assert len(box2) == 2
+
+    def test_layers(self):
+        sandbox = lobster.cmssw.sandbox.Sandbox(release='data/sandbox/CMSSW_1_2_3', include=['Foo/mydir'])
+        version, arch, box = sandbox.package([os.path.dirname(__file__)], self.workdir)
+        mtimes = [os.path.getmtime(layer) for layer in box]
+
+        sandbox2 = lobster.cmssw.sandbox.Sandbox(release='data/sandbox/CMSSW_1_2_3', include=['Foo/mydir'])
+        version2, arch2, box2 = sandbox2.package([os.path.dirname(__file__)], self.workdir)
+
+        assert box2 == box
+        assert [os.path.getmtime(layer) for layer in box2] == mtimes
+
+        sandbox3 = lobster.cmssw.sandbox.Sandbox(release='data/sandbox/CMSSW_1_2_3')
+        version3, arch3, box3 = sandbox3.package([os.path.dirname(__file__)], self.workdir)
+
+        assert box3[0] == box[0]
+        assert box3[1] != box[1]
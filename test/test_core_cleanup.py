@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from lobster import se
+from lobster.core.cleanup import Cleanup
+
+
+class BrokenLocal(se.Local):
+
+    def remove(self, *paths):
+        raise IOError("storage element unavailable")
+
+
+class FlakyLocal(se.Local):
+
+    """Fails to remove files the first time only.
+    """
+
+    def __init__(self, *args):
+        super(FlakyLocal, self).__init__(*args)
+        self.failed = False
+
+    def remove(self, *paths):
+        if not self.failed:
+            self.failed = True
+            raise IOError("storage element unavailable")
+        super(FlakyLocal, self).remove(*paths)
+
+
+class SlowLocal(se.Local):
+
+    """Takes its time to remove files, recording how many at once.
+    """
+
+    def __init__(self, *args):
+        super(SlowLocal, self).__init__(*args)
+        self.calls = []
+
+    def remove(self, *paths):
+        self.calls.append(len(paths))
+        time.sleep(0.5)
+        super(SlowLocal, self).remove(*paths)
+
+
+class TestCleanup(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.storage = os.path.join(self.workdir, 'storage')
+        os.makedirs(self.storage)
+        self.files = []
+        for i in range(5):
+            self.files.append(str(i) + '.root')
+            with open(os.path.join(self.storage, self.files[-1]), 'w') as f:
+                f.write('eggs')
+        se.FileSystem.configure([se.Local(self.storage)], [])
+
+    def tearDown(self):
+        se.FileSystem.configure([], [])
+        shutil.rmtree(self.workdir)
+
+    def test_background(self):
+        cleanup = Cleanup(self.workdir)
+        cleanup.start()
+        cleanup.add(self.files[:2], 'failed')
+        cleanup.add(self.files[2:], 'merged')
+        cleanup.stop(wait=True)
+
+        assert os.listdir(self.storage) == []
+        assert len(Cleanup(self.workdir).outstanding()) == 0
+
+    def test_compact(self):
+        cleanup = Cleanup(self.workdir, compact=2)
+        cleanup.start()
+        for fn in self.files:
+            cleanup.add([fn], 'failed')
+        cleanup.stop(wait=True)
+
+        assert os.listdir(self.storage) == []
+        with open(cleanup.journal) as f:
+            # one removed batch after the last compaction
+            assert len(f.readlines()) == 2
+        assert len(Cleanup(self.workdir).outstanding()) == 0
+
+    def test_resume(self):
+        cleanup = Cleanup(self.workdir)
+        cleanup.add(self.files[:2], 'failed')
+        cleanup.add(self.files[2:], 'merged')
+
+        cleanup = Cleanup(self.workdir)
+        assert cleanup.outstanding() == {'failed': 2, 'merged': 3}
+        assert cleanup.drain() == 0
+        assert os.listdir(self.storage) == []
+
+    def test_failure(self):
+        se.FileSystem.configure([BrokenLocal(self.storage)], [])
+        cleanup = Cleanup(self.workdir, retries=1, delay=0)
+        cleanup.start()
+        cleanup.add(self.files, 'input')
+        cleanup.stop(wait=True)
+
+        assert len(os.listdir(self.storage)) == 5
+        assert Cleanup(self.workdir).outstanding() == {'input': 5}
+
+    def test_retry_while_busy(self):
+        se.FileSystem.configure([FlakyLocal(self.storage)], [])
+        cleanup = Cleanup(self.workdir, delay=0.1)
+        cleanup.start()
+        cleanup.add(self.files[:1], 'failed')
+
+        # keep adding files to remove for longer than the retry delay
+        for i in range(20):
+            with open(os.path.join(self.storage, 'busy.root'), 'w') as f:
+                f.write('eggs')
+            cleanup.add(['busy.root'], 'merged')
+            time.sleep(0.02)
+        assert self.files[0] not in os.listdir(self.storage)
+        cleanup.stop(wait=True)
+
+    def test_timeout(self):
+        se.FileSystem.configure([BrokenLocal(self.storage)], [])
+        cleanup = Cleanup(self.workdir, retries=5, delay=60)
+        cleanup.start()
+        cleanup.add(self.files, 'input')
+
+        start = time.time()
+        cleanup.stop(wait=True, timeout=0.5)
+        assert time.time() - start < 5
+        assert Cleanup(self.workdir).outstanding() == {'input': 5}
+
+    def test_slow_removal(self):
+        slow = SlowLocal(self.storage)
+        se.FileSystem.configure([slow], [])
+        cleanup = Cleanup(self.workdir, size=2)
+        cleanup.start()
+        cleanup.add(self.files, 'input')
+        time.sleep(0.1)
+
+        # the removal in progress does not hold up stopping
+        start = time.time()
+        cleanup.stop(wait=True, timeout=0.2)
+        assert time.time() - start < 0.5
+        time.sleep(1)
+
+        assert max(slow.calls) <= 2
+        assert len(os.listdir(self.storage)) > 0
+        assert Cleanup(self.workdir).outstanding() == {'input': 5}
@@ -0,0 +1,102 @@
+import datetime
+import time
+import unittest
+
+from lobster.core.create import Algo, share
+
+
+class DummyCategory(object):
+
+    def __init__(self, cores=1, runtime=3600):
+        self.name = 'processing'
+        self.cores = cores
+        self.runtime = runtime
+        self.tasks_min = None
+        self.tasks_max = None
+
+
+class DummyWorkflow(object):
+
+    def __init__(self, label, priority=1., deadline=None, category=None):
+        self.label = label
+        self.priority = priority
+        self.deadline = deadline
+        self.category = category or DummyCategory()
+
+
+class DummyAdvanced(object):
+
+    def __init__(self, share_by_priority):
+        self.payload = 10
+        self.share_by_priority = share_by_priority
+
+
+class DummyConfig(object):
+
+    def __init__(self, workflows, share_by_priority=True):
+        self.workflows = workflows
+        self.advanced = DummyAdvanced(share_by_priority)
+
+
+class TestShare(unittest.TestCase):
+
+    def test_equal(self):
+        assert share(100, {'a': 1000, 'b': 1000}, {'a': 1, 'b': 1}) == {'a': 50, 'b': 50}
+
+    def test_weighted(self):
+        assert share(100, {'a': 1000, 'b': 1000}, {'a': 3, 'b': 1}) == {'a': 75, 'b': 25}
+
+    def test_small_demand(self):
+        # small workflows are not starved by large ones
+        assert share(100, {'a': 1000, 'b': 10}, {'a': 1, 'b': 1}) == {'a': 90, 'b': 10}
+
+    def test_background(self):
+        assert share(100, {'a': 60, 'b': 1000}, {'a': 1, 'b': 0}) == {'a': 60, 'b': 40}
+        assert share(100, {'a': 1000, 'b': 1000}, {'a': 1, 'b': 0}) == {'a': 100, 'b': 0}
+
+
+class TestAlgo(unittest.TestCase):
+
+    def test_starvation(self):
+        big = DummyWorkflow('big', priority=1000.)
+        small = DummyWorkflow('small', priority=0.001)
+        algo = Algo(DummyConfig([big, small]))
+        allocation = algo.allocate(100, {big: 1000, small: 1000})
+        assert allocation[small] >= 1
+
+    def test_deadline(self):
+        now = int(time.time())
+        deadline = datetime.datetime.fromtimestamp(now + 7200)
+        urgent = DummyWorkflow('urgent', deadline=deadline)
+        other = DummyWorkflow('other', priority=10.)
+        algo = Algo(DummyConfig([urgent, other]))
+        allocation = algo.allocate(100, {urgent: 100, other: 1000}, now=now)
+        # 100 tasks of one hour need 50 cores to finish within two hours,
+        # the rest is shared by priority after one core each has been
+        # set aside to avoid starvation
+        assert abs(allocation[urgent] - (50 + 49 / 11.)) < 1e-6
+        assert abs(allocation[other] - (1 + 490 / 11.)) < 1e-6
+
+    def test_proportional(self):
+        a = DummyWorkflow('a', priority=10.)
+        b = DummyWorkflow('b', category=DummyCategory(cores=4))
+        algo = Algo(DummyConfig([a, b], share_by_priority=False))
+        allocation = algo.allocate(100, {a: 200, b: 50})
+        assert allocation == {a: 50, b: 50}
+
+    def test_allocations(self):
+        a = DummyWorkflow('a')
+        b = DummyWorkflow('b')
+        remaining = {a: (True, 900, 900.), b: (True, 100, 100.)}
+        queued = {'processing': {'running': 0, 'queued': 0}}
+
+        algo = Algo(DummyConfig([a, b], share_by_priority=False))
+        assert algo.allocations == {'a': 0, 'b': 0}
+        # 110 cores to fill, split by the remaining work
+        algo.run(100, dict((k, dict(v)) for k, v in queued.items()), remaining)
+        assert algo.allocations == {'a': 99, 'b': 11}
+
+        algo = Algo(DummyConfig([a, b]))
+        # one core each to avoid starvation, then an equal share
+        algo.run(100, dict((k, dict(v)) for k, v in queued.items()), remaining)
+        assert algo.allocations == {'a': 55, 'b': 55}
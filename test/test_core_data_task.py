@@ -0,0 +1,306 @@
+from collections import Counter, defaultdict
+import imp
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+
+def load_task():
+    path = os.path.join(os.path.dirname(__file__), '..', 'lobster', 'core', 'data', 'task.py')
+    return imp.load_source('lobster_task', path)
+
+
+class TestStagedInputs(unittest.TestCase):
+
+    def setUp(self):
+        self.task = load_task()
+
+    def test_batches(self):
+        inputs = self.task.StagedInputs()
+        inputs.put('a')
+        inputs.put('b')
+        assert inputs.wait()
+        assert inputs.take() == ['a', 'b']
+
+        inputs.put('c')
+        thread = threading.Thread(target=inputs.finish)
+        thread.start()
+        assert inputs.take(everything=True) == ['c']
+        thread.join()
+        assert inputs.take() == []
+        assert inputs.end is not None
+        assert not inputs.failed
+
+    def test_empty(self):
+        inputs = self.task.StagedInputs()
+        inputs.finish(failed=True)
+        assert not inputs.wait()
+        assert inputs.failed
+
+    def test_check(self):
+        data = {'task_timing': {'stage_in_end': 1, 'stage_in_background_end': 0}}
+        inputs = self.task.StagedInputs()
+        inputs.finish()
+        self.task.check_inputs(data, inputs)
+        assert data['task_timing']['stage_in_end'] == 1
+        assert data['task_timing']['stage_in_background_end'] == inputs.end
+
+        inputs.finish(failed=True)
+        with self.assertRaises(SystemExit) as e:
+            self.task.check_inputs(data, inputs)
+        assert e.exception.code == 179
+        assert data['task_exit_code'] == 179
+
+
+class Batches(object):
+
+    """Hands out input files in fixed batches, as if staged in while
+    processing.
+    """
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+
+    def take(self, everything=False):
+        return self.batches.pop(0) if self.batches else []
+
+
+def report(files, events, runs, written, cputime=1.):
+    return {
+        'files': {
+            'info': dict((f, [events, []]) for f in files),
+            'output_info': {
+                'out.root': {'events': written, 'runs': runs}
+            },
+            'skipped': []
+        },
+        'events_written': written,
+        'cpu_time': cputime,
+        'events_per_run': events
+    }
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.task = load_task()
+        self.workdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.workdir)
+
+    def test_merge_reports(self):
+        previous = report(['a'], 10, {'1': [1, 2]}, 8)
+        data = report(['b'], 5, {'1': [3], '2': [1]}, 4)
+        data['files']['skipped'] = ['c']
+
+        self.task.merge_fwk_reports(data, previous)
+        assert sorted(data['files']['info']) == ['a', 'b']
+        assert data['files']['skipped'] == ['c']
+        assert data['files']['output_info']['out.root']['events'] == 12
+        assert data['files']['output_info']['out.root']['runs'] == {'1': [1, 2, 3], '2': [1]}
+        assert data['events_written'] == 12
+        assert data['cpu_time'] == 2.
+        assert data['events_per_run'] == 15
+
+    def test_pipelined(self):
+        config = {
+            'executable': 'cmsRun',
+            'gridpack': False,
+            'mask': {'events': -1, 'files': ['a', 'b']},
+            'pipeline': {'runs': 2},
+            'input': ['root://spam/', 'srm://ham/'],
+            'disable streaming': False
+        }
+        # streamed inputs are not staged in
+        assert not self.task.pipelined(config)
+        config['input'] = ['srm://ham/', 'chirp://eggs/']
+        assert self.task.pipelined(config)
+        config['input'] = ['root://spam/']
+        config['disable streaming'] = True
+        assert self.task.pipelined(config)
+        config['pipeline']['runs'] = 1
+        assert not self.task.pipelined(config)
+
+    def run_pipelined(self, inputs, runs, failing=None):
+        task = self.task
+        masks = {}
+        commands = []
+
+        class Process(object):
+
+            def __init__(self, returncode):
+                self.returncode = returncode
+
+        def edit_process_source(pset, config):
+            masks[pset] = config['mask']['files']
+
+        def run_subprocess(cmd, env=None):
+            commands.append(cmd)
+            if cmd[0] == 'hadd':
+                open(cmd[4], 'w').close()
+                return Process(0)
+            n = len(commands)
+            with open(cmd[2], 'w') as f:
+                json.dump(masks[cmd[3]], f)
+            open('out.root', 'w').close()
+            return Process(65 if n == failing else 0)
+
+        def parse_fwk_report(data, config, filename, exitcode=0):
+            with open(filename) as f:
+                processed = json.load(f)
+            data.update(report(processed, 10, {'1': [len(commands)]}, 10 * len(processed)))
+
+        task.edit_process_source = edit_process_source
+        task.run_subprocess = run_subprocess
+        task.parse_fwk_report = parse_fwk_report
+
+        open('pset.py', 'w').close()
+        config = {
+            'executable': 'cmsRun',
+            'arguments': [],
+            'pset': 'pset.py',
+            'mask': {'files': []},
+            'output files': [('out.root', 'remote/out.root')],
+            'pipeline': {'runs': runs, 'edm output': False}
+        }
+        data = report([], 0, {}, 0, 0.)
+        p = task.run_pipelined(data, config, {}, inputs)
+        return p, data, commands
+
+    def test_run(self):
+        inputs = self.task.StagedInputs()
+        for f in ['a', 'b', 'c']:
+            inputs.put(f)
+        inputs.finish()
+
+        p, data, commands = self.run_pipelined(inputs, 2)
+        assert p.returncode == 0
+        # all files staged before the first run are processed at once
+        assert len(commands) == 1
+        assert sorted(data['files']['info']) == ['a', 'b', 'c']
+        assert data['events_written'] == 30
+        assert os.path.exists('out.root')
+
+    def test_failed_run(self):
+        p, data, commands = self.run_pipelined(Batches([['a'], ['b']]), 2, failing=1)
+        assert p.returncode == 65
+        assert len(commands) == 1
+        assert not os.path.exists('part1_out.root')
+
+    def test_merge_parts(self):
+        p, data, commands = self.run_pipelined(Batches([['a'], ['b', 'c']]), 2)
+        assert len(commands) == 3
+        assert commands[2][:4] == ['hadd', '-n', '0', '-f']
+        assert commands[2][4:] == ['out.root', 'part1_out.root', 'part2_out.root']
+        assert sorted(data['files']['info']) == ['a', 'b', 'c']
+        assert data['files']['output_info']['out.root']['runs'] == {'1': [1, 2]}
+        assert data['events_written'] == 30
+
+
+class TestEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.task = load_task()
+        self.workdir = tempfile.mkdtemp()
+        with open(os.path.join(self.workdir, 'present.root'), 'w') as f:
+            f.write('eggs')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_stage_in(self):
+        inputs = ['file:///nonexistent', 'file://' + self.workdir]
+        filename, input, transfers = self.task.stage_in({}, {}, 'missing.root', inputs)
+        assert filename is None
+        # files that are not accessible locally are no endpoint failures
+        assert self.task.endpoints.stats == {}
+
+        filename, input, transfers = self.task.stage_in({}, {}, 'present.root', inputs)
+        assert input == inputs[1]
+        assert self.task.endpoints.stats.keys() == [inputs[1]]
+        assert self.task.endpoints.stats[inputs[1]]['success'] == 1
+        assert self.task.endpoints.stats[inputs[1]]['failure'] == 0
+
+    def test_parallel_stage_in(self):
+        files = ['{0}.root'.format(i) for i in range(8)]
+        for fn in files:
+            open(os.path.join(self.workdir, fn), 'w').close()
+        data = {'transfers': defaultdict(Counter)}
+        config = {'input': ['file://' + self.workdir], 'file map': {}, 'stage-in threads': 3}
+        filenames = list(self.task.stage_inputs(data, config, {}, files))
+        assert filenames == ['file:' + os.path.join(self.workdir, fn) for fn in files]
+        assert data['transfers']['file']['stage-in success'] == 8
+        assert len(config['file map']) == 8
+
+    def test_xrootd_stat(self):
+        task = self.task
+        calls = []
+
+        class Status(object):
+
+            def __init__(self, code):
+                self.ok = code == 0
+                self.code = code
+                self.message = str(code)
+
+        class Info(object):
+            size = 4
+
+        class FileSystem(object):
+
+            def __init__(self, url):
+                pass
+
+            def stat(self, path, timeout=None):
+                code = {'/present.root': 0, '/missing.root': 400}.get(path, 108)
+                return Status(code), Info() if code == 0 else None
+
+        class Client(object):
+            pass
+
+        class Process(object):
+            returncode = 0
+            stdout = 'Size: 5'
+
+        def run_subprocess(args, **kwargs):
+            calls.append(args)
+            return Process()
+
+        task.xrdclient = Client()
+        task.xrdclient.FileSystem = FileSystem
+        task.run_subprocess = run_subprocess
+
+        assert task.xrootd_stat('spam', 'present.root') == 4
+        # missing files are reported by the session alone
+        assert task.xrootd_stat('spam', 'missing.root') is None
+        assert calls == []
+        # unreachable servers are retried with xrdfs
+        assert task.xrootd_stat('spam', 'unreachable.root') == 5
+        assert len(calls) == 1
+        assert 'spam' not in task.xrootd_sessions
+
+    def test_checksum_fallback(self):
+        task = self.task
+        calls = []
+
+        class Process(object):
+            returncode = 0
+
+        def checksum(filename):
+            calls.append(filename)
+            if len(calls) == 1:
+                raise IOError("read failed")
+            return '0badcafe'
+
+        task.checksum = checksum
+        task.run_subprocess = lambda args, env=None: Process()
+        p, adler32 = task.run_checksummed(['true'], 'present.root', {})
+        assert adler32 == '0badcafe'
+        assert len(calls) == 2
@@ -0,0 +1,47 @@
+import random
+import unittest
+
+from lobster.core.estimator import UnitTimeEstimator
+
+
+class TestUnitTimeEstimator(unittest.TestCase):
+
+    def test_empty(self):
+        assert UnitTimeEstimator().quantile(.9) is None
+
+    def test_quantiles(self):
+        estimator = UnitTimeEstimator(halflife=1e9)
+        for value in range(1, 101):
+            estimator.add(value)
+        # bins are 5% wide, and quantiles are rounded up
+        assert 50 <= estimator.quantile(.5) <= 50 * 1.1
+        assert 90 <= estimator.quantile(.9) <= 90 * 1.1
+        assert estimator.quantile(1.) >= 100
+
+    def test_decay(self):
+        estimator = UnitTimeEstimator(halflife=10)
+        for _ in range(100):
+            estimator.add(100.)
+        for _ in range(100):
+            estimator.add(10.)
+        assert estimator.quantile(.9) < 11
+
+    def test_hosts(self):
+        rng = random.Random(0)
+        plain = UnitTimeEstimator(halflife=1e9)
+        normalized = UnitTimeEstimator(halflife=1e9, normalize=True)
+        for _ in range(1000):
+            host, speed = rng.choice([('fast', 1.), ('slow', 2.)])
+            value = speed * rng.uniform(9, 11)
+            plain.add(value, host)
+            normalized.add(value, host)
+        assert abs(normalized.factor('slow') / normalized.factor('fast') - 2) < .2
+        assert abs(normalized.quantile(.9) / plain.quantile(.9) - 1) < .1
+
+    def test_persistence(self):
+        estimator = UnitTimeEstimator(normalize=True)
+        for value in range(1, 50):
+            estimator.add(value, 'host{0}'.format(value % 3))
+        copy = UnitTimeEstimator.loads(estimator.dumps(), normalize=True)
+        assert copy.count == estimator.count
+        assert copy.quantile(.9) == estimator.quantile(.9)
@@ -0,0 +1,46 @@
+import unittest
+
+from lobster.core.fetch import FetchController
+
+
+class TestFetchController(unittest.TestCase):
+
+    def test_defaults(self):
+        fetch = FetchController()
+        fetch.adjust(100, 100)
+        assert fetch.interval == 120
+        assert fetch.batch == 2000
+
+    def test_heavy_load(self):
+        fetch = FetchController()
+        fetch.returned(1000, 20)
+        fetch.released(1000, 100)
+        fetch.adjust(100, 100)
+        # releasing 10 tasks per second within 60s
+        assert fetch.batch == 600
+        # 50 tasks returning per second
+        assert fetch.interval == 15
+        assert fetch.interval_minimum == 15
+
+    def test_light_load(self):
+        fetch = FetchController()
+        fetch.returned(0, 120)
+        fetch.adjust(100, 100)
+        assert fetch.interval == 300
+        assert fetch.interval_minimum == 75
+
+    def test_starved_queue(self):
+        fetch = FetchController()
+        fetch.returned(0, 120)
+        fetch.adjust(0, 100)
+        assert fetch.interval == 15
+        fetch.adjust(0, 0)
+        assert fetch.interval == 300
+
+    def test_smoothing(self):
+        fetch = FetchController(smoothing=0.5)
+        fetch.released(10, 10)
+        fetch.released(10, 30)
+        assert fetch.cost == 2.
+        fetch.adjust(100, 100)
+        assert fetch.batch == 30
@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lobster import util
+from lobster.core import source
+from lobster.core.source import TaskProvider
+
+
+class DummyAdvanced(object):
+
+    def __init__(self, xrootd_servers):
+        self.xrootd_servers = xrootd_servers
+
+
+class DummyConfig(object):
+
+    def __init__(self, xrootd_servers):
+        self.advanced = DummyAdvanced(xrootd_servers)
+
+
+class TestStartupCache(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.install = os.path.join(self.workdir, 'cctools')
+        os.makedirs(os.path.join(self.install, 'bin'))
+        os.makedirs(os.path.join(self.install, 'lib', 'lib64'))
+        for exe in ('parrot_run', 'chirp', 'chirp_put', 'chirp_get'):
+            self.write(os.path.join(self.install, 'bin', exe), exe)
+        self.write(os.path.join(self.install, 'lib', 'lib64', 'libparrot_helper.so'), 'helper')
+
+        # skip the setup of the task provider, only the paths used by the
+        # startup cache are needed
+        self.provider = TaskProvider.__new__(TaskProvider)
+        self.provider.config = DummyConfig(['spam.example.com'])
+        self.provider.workdir = self.workdir
+        self.provider.siteconf = os.path.join(self.workdir, 'siteconf')
+        self.provider.parrot_path = os.path.join(self.install, 'bin')
+        self.provider.parrot_bin = os.path.join(self.workdir, 'bin')
+        self.provider.parrot_lib = os.path.join(self.workdir, 'lib')
+
+        self.stripped = []
+        self.which = source.util.which
+        self.check_call = source.subprocess.check_call
+        source.util.which = lambda exe: os.path.join(self.install, 'bin', exe)
+        source.subprocess.check_call = lambda args: self.stripped.append(os.path.basename(args[-1]))
+
+    def tearDown(self):
+        source.util.which = self.which
+        source.subprocess.check_call = self.check_call
+        shutil.rmtree(self.workdir)
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_checksum(self):
+        path = os.path.join(self.install, 'bin', 'chirp')
+        missing = os.path.join(self.install, 'bin', 'missing')
+        digest = util.checksum(path, missing)
+        assert util.checksum(path, missing) == digest
+        self.write(path, 'changed')
+        assert util.checksum(path, missing) != digest
+        assert util.checksum(path) != util.checksum(path, missing)
+
+    def test_binaries(self):
+        self.provider._TaskProvider__copy_binaries()
+        assert sorted(self.stripped) == ['chirp', 'chirp_get', 'chirp_put', 'parrot_run']
+        assert os.path.exists(os.path.join(self.workdir, 'lib', 'libparrot_helper.so'))
+
+        # unchanged binaries are not copied again
+        self.stripped = []
+        self.write(os.path.join(self.workdir, 'lib', 'libparrot_helper.so'), 'stale')
+        self.provider._TaskProvider__copy_binaries()
+        assert self.stripped == []
+        assert self.read(os.path.join(self.workdir, 'lib', 'libparrot_helper.so')) == 'stale'
+
+        self.write(os.path.join(self.install, 'bin', 'chirp'), 'updated')
+        self.write(os.path.join(self.install, 'lib', 'lib64', 'libparrot_helper.so'), 'updated')
+        self.provider._TaskProvider__copy_binaries()
+        assert self.stripped == ['chirp']
+        assert self.read(os.path.join(self.workdir, 'bin', 'chirp')) == 'updated'
+        assert self.read(os.path.join(self.workdir, 'lib', 'libparrot_helper.so')) == 'updated'
+
+        # vanished copies are restored
+        self.stripped = []
+        os.unlink(os.path.join(self.workdir, 'bin', 'chirp_get'))
+        self.provider._TaskProvider__copy_binaries()
+        assert self.stripped == ['chirp_get']
+
+    def test_siteconf(self):
+        storage = os.path.join(self.workdir, 'siteconf', 'PhEDEx', 'storage.xml')
+
+        self.provider.copy_siteconf()
+        assert 'spam.example.com' in self.read(storage)
+
+        # an unchanged configuration is not written again
+        self.write(storage, 'stale')
+        self.provider.copy_siteconf()
+        assert self.read(storage) == 'stale'
+
+        self.provider.config.advanced.xrootd_servers = ['eggs.example.com']
+        self.provider.copy_siteconf()
+        assert 'eggs.example.com' in self.read(storage)
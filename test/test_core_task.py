@@ -1,8 +1,13 @@
 from collections import defaultdict, Counter
 import os
+import shutil
+import tempfile
 import unittest
+import work_queue as wq
 
-from lobster.core.task import TaskHandler
+from lobster import se
+from lobster.core import unit
+from lobster.core.task import PilotTask, TaskHandler
 from lobster.core.source import ReleaseSummary
 
 
@@ -36,3 +41,82 @@ class TestTask(unittest.TestCase):
                                  (1, 276), (1, 277), (1, 278), (1, 279), (1, 280)]
         assert outinfo.events == 4000
         assert outinfo.size == 15037503
+
+    def test_supersede(self):
+        summary = ReleaseSummary()
+        handler = TaskHandler(1, "test", [], [], [],
+                              os.path.join(os.path.dirname(__file__), "data/handler/successful"))
+        failed, task_update, file_update, unit_update = handler.process(
+            DummyTask(), summary, defaultdict(lambda: defaultdict(Counter)))
+        file_update, unit_update = handler.supersede(task_update, unit.ABORTED)
+        assert (file_update, unit_update) == ([], [])
+        assert task_update.status == unit.ABORTED
+        assert task_update.units_processed == 0
+        assert task_update.events_written == 0
+
+    def test_pilot_task(self):
+        taskdir = os.path.join(os.path.dirname(__file__), "data/handler/successful")
+        pilot = DummyTask(tag='pilot-1', exitcode=5, result=wq.WORK_QUEUE_RESULT_OUTPUT_MISSING)
+
+        task = PilotTask(pilot, '1', taskdir, [os.path.join(taskdir, 'report.json')])
+        assert task.tag == '1'
+        assert task.return_status == 0
+        assert task.result == wq.WORK_QUEUE_RESULT_SUCCESS
+        assert task.hostname == 'fake'
+
+        task = PilotTask(pilot, '2', os.path.dirname(taskdir), [os.path.join(taskdir, 'missing.root')])
+        assert task.return_status == 5
+        assert task.result == wq.WORK_QUEUE_RESULT_OUTPUT_MISSING
+
+    def test_pilot_accounting(self):
+        taskdir = os.path.join(os.path.dirname(__file__), "data/handler/successful")
+        pilot = DummyTask(tag='pilot-1', result=wq.WORK_QUEUE_RESULT_SUCCESS)
+        pilot.total_bytes_received = 3000
+        pilot.send_input_start = 100
+        pilot.send_input_finish = 400
+
+        tasks = PilotTask.split(pilot, [(str(n), taskdir, []) for n in range(3)])
+        assert [t.total_bytes_received for t in tasks] == [1000] * 3
+        assert [(t.send_input_start, t.send_input_finish) for t in tasks] == [(100, 200), (200, 300), (300, 400)]
+        # timing from the report of each task
+        assert tasks[0].cmd_execution_time == (1449091533 - 1449084335) * 1000000
+
+    def test_pilot_exhausted(self):
+        taskdir = os.path.join(os.path.dirname(__file__), "data/handler/successful")
+        pilot = DummyTask(tag='pilot-1', exitcode=1, result=wq.WORK_QUEUE_RESULT_RESOURCE_EXHAUSTION)
+        pilot.cmd_execution_time = 8000 * 1000000
+
+        tasks = PilotTask.split(pilot, [
+            ('1', taskdir, []),
+            ('2', os.path.dirname(taskdir), []),
+            ('3', os.path.dirname(taskdir), [])
+        ])
+        assert tasks[0].result == wq.WORK_QUEUE_RESULT_SUCCESS
+        assert tasks[0].return_status == 0
+        assert tasks[1].result == wq.WORK_QUEUE_RESULT_RESOURCE_EXHAUSTION
+        assert tasks[1].cmd_execution_time == (8000 - 1449091533 + 1449084335) * 1000000
+        assert tasks[2].result == wq.WORK_QUEUE_RESULT_UNKNOWN
+        assert tasks[2].cmd_execution_time == 0
+
+    def test_cache_shared_inputs(self):
+        datadir = tempfile.mkdtemp()
+        try:
+            for fn in ('a.root', 'b.root'):
+                open(os.path.join(datadir, fn), 'w').close()
+            storage = se.StorageConfiguration(output=[], input=['file://' + datadir],
+                                              use_work_queue_for_inputs=True, locality=True)
+            files = [(1, 'a.root'), (2, 'b.root')]
+            lumis = [(1, 'a.root', -1, -1), (2, 'b.root', -1, -1)]
+            handler = TaskHandler(1, "test", files, lumis, [], datadir, local=True)
+
+            inputs = []
+            handler.adjust({'mask': {}}, inputs, [], storage, shared=set(['a.root']))
+            assert sorted((remote, cache) for local, remote, cache in inputs) == [('a.root', True), ('b.root', False)]
+
+            storage = se.StorageConfiguration(output=[], input=['file://' + datadir],
+                                              use_work_queue_for_inputs=True)
+            inputs = []
+            handler.adjust({'mask': {}}, inputs, [], storage, shared=set(['a.root']))
+            assert all(not cache for local, remote, cache in inputs)
+        finally:
+            shutil.rmtree(datadir)
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import lobster.cmssw.sandbox
+from lobster.commands.sandbox import Profile
+
+
+class TestProfile(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.release = os.path.join(self.workdir, 'CMSSW_1_2_3')
+
+        def create(name, content):
+            path = os.path.join(self.release, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+            return os.path.realpath(path)
+
+        create('.SCRAM/slc1_234', '')
+        create('.SCRAM/Environment', 'SCRAM_PROJECTVERSION=CMSSW_1_2_3\n')
+        big = os.urandom(1024 ** 2)
+        create('src/Foo/Bar/data/big.root', big)
+        create('src/Foo/Baz/data/copy.root', big)
+        create('src/Foo/Bar/data/doc/manual.pdf', 'manual')
+        self.used = set([
+            create('src/Foo/Bar/data/small.txt', 'small'),
+            create('src/Foo/Bar/python/cfg.py', 'cfg'),
+            create('src/Foo/Bar/test/input.txt', 'input')
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_contents(self):
+        sandbox = lobster.cmssw.sandbox.Sandbox(release=self.release, blacklist=['doc'])
+        profile = Profile(sandbox, [])
+        names = set(e.arcname for e in profile.files)
+        assert 'src/Foo/Bar/data/big.root' in names
+        assert 'src/Foo/Bar/data/doc/manual.pdf' not in names
+        assert 'src/Foo/Bar/test/input.txt' not in names
+        assert len(profile.removed('data')) == 3
+        assert len(profile.removed('*.root')) == 2
+
+    def test_duplicates(self):
+        sandbox = lobster.cmssw.sandbox.Sandbox(release=self.release)
+        profile = Profile(sandbox, [])
+        duplicates = profile.duplicates()
+        assert len(duplicates) == 1
+        wasted, same = duplicates[0]
+        assert wasted == 1024 ** 2
+        assert sorted(e.arcname for e in same) == ['src/Foo/Bar/data/big.root', 'src/Foo/Baz/data/copy.root']
+
+    def test_prune(self):
+        sandbox = lobster.cmssw.sandbox.Sandbox(release=self.release)
+        profile = Profile(sandbox, [])
+        patterns = profile.prune(self.used, minimum=1024)
+        assert [p for p, files in patterns] == ['*.root']
+        assert profile.missing(self.used) == ['Foo/Bar/test/input.txt']
@@ -1,11 +1,14 @@
 # vim: foldmethod=marker
 from lobster.core import dataset
 from lobster import fs, se, util
+import errno
 import os
 import random
 import shutil
 import subprocess
+import sys
 import tempfile
+import threading
 import unittest
 
 
@@ -126,5 +129,358 @@ class TestFailure(TestSE):
         self.query(['file:///fuckup', 'file://' + self.workdir])
 
 
+class CountingLocal(se.Local):
+
+    def __init__(self, pfnprefix):
+        super(CountingLocal, self).__init__(pfnprefix)
+        self.calls = 0
+        isdir = self.isdir
+
+        def counted(path):
+            self.calls += 1
+            return isdir(path)
+        self.isdir = counted
+
+
+class TestResolution(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.workdir, 'spam'))
+        self.bad = CountingLocal(os.path.join(self.workdir, 'missing'))
+        self.good = CountingLocal(self.workdir)
+        se.FileSystem.configure([self.bad, self.good], [])
+
+    def tearDown(self):
+        se.FileSystem.configure([], [])
+        se.FileSystem.negative_ttl = 300
+        shutil.rmtree(self.workdir)
+
+    def test_negative(self):
+        assert fs.isdir('spam')
+        assert fs.isdir('spam')
+        assert (self.bad.calls, self.good.calls) == (1, 2)
+
+        stats = fs.statistics()
+        assert stats[repr(self.bad)]['misses'] == 1
+        assert stats[repr(self.good)]['hits'] == 2
+
+    def test_expiry(self):
+        os.makedirs(os.path.join(self.workdir, 'spam', 'eggs'))
+        se.FileSystem.negative_ttl = -1
+        assert fs.isdir('spam')
+        assert fs.isdir('spam')
+        assert (self.bad.calls, self.good.calls) == (1, 2)
+
+        # without a successful storage element for the path, the failed
+        # one is tried again
+        assert fs.isdir('spam/eggs')
+        assert (self.bad.calls, self.good.calls) == (2, 3)
+
+    def test_shared_failure(self):
+        # a path missing everywhere does not demote any storage element
+        with self.assertRaises(AttributeError):
+            fs.isdir('eggs')
+        assert se.FileSystem._failed == {}
+        with self.assertRaises(AttributeError):
+            list(fs.iterls('eggs'))
+        assert se.FileSystem._failed == {}
+
+        assert fs.isdir('spam')
+        assert se.FileSystem._failed.keys() == [('isdir', self.bad)]
+
+    def test_unreachable(self):
+        def refused(path):
+            raise IOError(errno.ECONNREFUSED, "connection refused")
+        self.good.isdir = refused
+        with self.assertRaises(AttributeError):
+            fs.isdir('spam')
+        assert se.FileSystem._failed.keys() == [('isdir', self.good)]
+
+
+class TestRemoval(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        for i in range(10):
+            with open(os.path.join(self.workdir, str(i) + '.txt'), 'w') as f:
+                f.write('eggs')
+        s = se.StorageConfiguration(output=['file://' + self.workdir], removal={'file': {'threads': 2, 'batch': 3}})
+        s.activate()
+
+    def tearDown(self):
+        se.FileSystem.configure([], [])
+        shutil.rmtree(self.workdir)
+
+    def test_batches(self):
+        progress = []
+        fs.remove(*[str(i) + '.txt' for i in range(10)], progress=lambda done, total: progress.append((done, total)))
+        assert os.listdir(self.workdir) == []
+        assert len(progress) == 4
+        assert max(progress) == (10, 10)
+
+    def test_default(self):
+        # other threads may switch to the alternative methods, without
+        # affecting the removal
+        entered = threading.Event()
+        leave = threading.Event()
+
+        def switch():
+            with fs.alternative():
+                entered.set()
+                leave.wait()
+        t = threading.Thread(target=switch)
+        with fs.default():
+            t.start()
+            assert entered.wait(5)
+            fs.remove(*[str(i) + '.txt' for i in range(10)])
+            leave.set()
+        t.join()
+        assert os.listdir(self.workdir) == []
+
+
+class TestEndpointHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.urls = ['root://spam/', 'root://ham/', 'file:///eggs/']
+        self.health = se.EndpointHealth()
+
+    def test_unknown(self):
+        assert self.health.order(self.urls) == self.urls
+
+    def test_order(self):
+        self.health.record({
+            'root://spam/': {'success': 2, 'failure': 8, 'time': 100.},
+            'root://ham/': {'success': 10, 'failure': 0, 'time': 50.},
+            'file:///eggs/': {'success': 10, 'failure': 0, 'time': 1.}
+        })
+        assert self.health.order(self.urls) == ['file:///eggs/', 'root://ham/', 'root://spam/']
+
+    def test_recovery(self):
+        self.health.record({
+            'root://spam/': {'success': 0, 'failure': 10, 'time': 10.},
+            'root://ham/': {'success': 10, 'failure': 0, 'time': 50.},
+            'file:///eggs/': {'success': 10, 'failure': 0, 'time': 50.}
+        })
+        assert self.health.order(self.urls)[-1] == 'root://spam/'
+        for i in range(10):
+            self.health.record({'root://spam/': {'success': 10, 'failure': 0, 'time': 1.}})
+        assert self.health.order(self.urls)[0] == 'root://spam/'
+
+    def test_unmeasured(self):
+        urls = ['file:///hadoop/store', 'root://cmsxrootd.fnal.gov/']
+        for i in range(3):
+            self.health.record({urls[0]: {'success': 1, 'failure': 0, 'time': 5.}})
+        assert self.health.order(urls) == urls
+        self.health.record({'root://ham/': {'success': 10, 'failure': 0, 'time': 50.}})
+        self.health.record({'file:///eggs/': {'success': 10, 'failure': 0, 'time': 1.}})
+        assert self.health.order(self.urls) == ['root://spam/', 'file:///eggs/', 'root://ham/']
+
+    def test_exploration(self):
+        self.health.record({'root://spam/': {'success': 0, 'failure': 10, 'time': 10.}})
+        assert self.health.order(self.urls, exploration=0.) == ['root://ham/', 'file:///eggs/', 'root://spam/']
+        assert self.health.order(self.urls, exploration=1.) == ['root://ham/', 'root://spam/', 'file:///eggs/']
+
+    def test_preprocess(self):
+        self.health.record({'root://spam/': {'success': 0, 'failure': 10, 'time': 10.}})
+        s = se.StorageConfiguration(output=self.urls, input=self.urls, exploration=0.)
+        parameters = {}
+        s.preprocess(parameters, False, self.health)
+        assert parameters['input'] == ['root://ham/', 'file:///eggs/', 'root://spam/']
+        assert parameters['output'] == parameters['input']
+        assert s.input == self.urls
+
+
+class MockXrootDServer(object):
+
+    """Serves a local directory like an XrootD server would.
+
+    Provides both an `xrdfs` executable, and a stand-in for the XrootD
+    python bindings.
+    """
+
+    xrdfs = """#!{python}
+import os
+import sys
+
+root = {root!r}
+
+def local(path):
+    return os.path.join(root, path.lstrip('/'))
+
+server, cmd, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+try:
+    if cmd == 'stat':
+        isdir = os.path.isdir(local(args[0]))
+        print 'Path:   {{0}}'.format(args[0])
+        print 'Size:   {{0}}'.format(os.stat(local(args[0])).st_size)
+        print 'Flags:  {{0}} ({{1}})'.format(51 if isdir else 16, 'IsDir|IsReadable' if isdir else 'IsReadable')
+    elif cmd == 'ls':
+        for name in sorted(os.listdir(local(args[0]))):
+            print os.path.join('/', args[0].strip('/'), name)
+    elif cmd == 'mkdir':
+        if not os.path.isdir(local(args[-1])):
+            os.makedirs(local(args[-1]))
+    elif cmd == 'rm':
+        os.unlink(local(args[0]))
+    elif cmd == 'rmdir':
+        os.rmdir(local(args[0]))
+except OSError as e:
+    sys.stderr.write(str(e))
+    sys.exit(54)
+"""
+
+    class Status(object):
+
+        def __init__(self, error=None):
+            self.ok = error is None
+            self.message = str(error)
+
+    class flags(object):
+
+        class StatInfoFlags(object):
+            IS_DIR = 2
+
+        class MkDirFlags(object):
+            MAKEPATH = 1
+
+    def __init__(self):
+        self.root = tempfile.mkdtemp()
+        self.bindir = tempfile.mkdtemp()
+        self.executable = os.path.join(self.bindir, 'xrdfs')
+        with open(self.executable, 'w') as f:
+            f.write(self.xrdfs.format(python=sys.executable, root=self.root))
+        os.chmod(self.executable, 0755)
+        self.connections = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def cleanup(self):
+        shutil.rmtree(self.root)
+        shutil.rmtree(self.bindir)
+
+    def FileSystem(self, url):
+        server = self
+        server.connections += 1
+
+        class FileSystem(object):
+
+            def __call(self, fct, path, callback):
+                try:
+                    result = (server.Status(), fct(os.path.join(server.root, path.lstrip('/'))))
+                except OSError as e:
+                    result = (server.Status(e), None)
+                with server.lock:
+                    server.requests += 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+                # respond asynchronously, like the bindings do
+                def respond():
+                    with server.lock:
+                        server.in_flight -= 1
+                    callback(*result)
+                threading.Timer(0.02, respond).start()
+                return server.Status()
+
+            def stat(self, path, timeout=0, callback=None):
+                def stat(p):
+                    info = os.stat(p)
+                    return util.record('StatInfo', 'size', 'flags')(info.st_size, 2 if os.path.isdir(p) else 0)
+                return self.__call(stat, path, callback)
+
+            def dirlist(self, path, timeout=0, callback=None):
+                def dirlist(p):
+                    return [util.record('ListEntry', 'name')(name) for name in sorted(os.listdir(p))]
+                return self.__call(dirlist, path, callback)
+
+            def mkdir(self, path, flags=0, timeout=0, callback=None):
+                return self.__call(os.makedirs, path, callback)
+
+            def rm(self, path, timeout=0, callback=None):
+                return self.__call(os.unlink, path, callback)
+
+            def rmdir(self, path, timeout=0, callback=None):
+                return self.__call(os.rmdir, path, callback)
+
+        return FileSystem()
+
+
+class TestXrootD(unittest.TestCase):
+
+    def setUp(self):
+        self.server = MockXrootDServer()
+        os.makedirs(os.path.join(self.server.root, 'spam', 'ham'))
+        for i in range(10):
+            with open(os.path.join(self.server.root, 'spam', str(i) + '.txt'), 'w') as f:
+                f.write('eggs')
+        with open(os.path.join(self.server.root, 'spam', 'ham', 'bacon'), 'w') as f:
+            f.write('eggs')
+        se.XrootD._sessions = {'localhost': self.session()}
+        self.xrootd = se.XrootD('root://localhost/')
+
+    def tearDown(self):
+        se.XrootD._sessions = {}
+        self.server.cleanup()
+
+    def session(self):
+        return se.XrdfsSession('localhost', self.server.executable)
+
+    def test_operations(self):
+        url = self.xrootd.lfn2pfn
+        assert self.xrootd.exists(url('spam/1.txt'))
+        assert not self.xrootd.exists(url('spam/10.txt'))
+        assert self.xrootd.isdir(url('spam/ham'))
+        assert self.xrootd.isfile(url('spam/1.txt'))
+        assert self.xrootd.getsize(url('spam/1.txt')) == 4
+        assert len(list(self.xrootd.ls(url('spam')))) == 11
+
+        self.xrootd.mkdir(url('spam/eggs/bacon'))
+        assert self.xrootd.isdir(url('spam/eggs/bacon'))
+
+        self.xrootd.remove(url('spam'))
+        assert not os.path.exists(os.path.join(self.server.root, 'spam'))
+
+
+class TestXrootDSession(TestXrootD):
+
+    def session(self):
+        return se.XrootDSession('localhost', self.server, self.server.flags, batch=4)
+
+    def test_batch(self):
+        session = se.XrootD.session('localhost')
+        calls = []
+        stat = session.stat
+
+        def record(paths):
+            calls.append(list(paths))
+            return stat(paths)
+        session.stat = record
+
+        paths = [self.xrootd.lfn2pfn('spam/{}.txt'.format(i)) for i in range(12)]
+        requests = self.server.requests
+        infos = self.xrootd.stat(*paths)
+        assert infos[:10] == [(4, False)] * 10
+        assert infos[10:] == [None, None]
+
+        # all paths are passed to the session at once, which has at most
+        # a batch of requests in flight
+        assert len(calls) == 1
+        assert len(calls[0]) == 12
+        assert self.server.requests - requests == 12
+        assert 1 < self.server.max_in_flight <= 4
+
+    def test_reuse(self):
+        url = self.xrootd.lfn2pfn
+        assert self.xrootd.exists(url('spam/1.txt'))
+        assert se.XrootD('root://localhost/').isdir(url('spam/ham'))
+        self.xrootd.remove(url('spam/2.txt'))
+
+        # one connection for all requests to the server
+        assert self.server.connections == 1
+
+
 if __name__ == '__main__':
     unittest.main()
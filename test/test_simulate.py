@@ -0,0 +1,151 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from lobster import se
+from lobster.cmssw.dataset import DatasetInfo
+from lobster.commands.simulate import Capacity, Simulation, Workload
+from lobster.core import unit
+from lobster.core.config import AdvancedOptions, Config
+from lobster.core.workflow import Category, Workflow
+
+
+class TestCapacity(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.workdir, 'lobster_stats_all.log')
+        with open(self.log, 'w') as f:
+            f.write('#timestamp units_left total_cores\n')
+            f.write('1000000000 10 0\n')
+            f.write('1100000000 10 8\n')
+            f.write('1200000000 10 4\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_steps(self):
+        capacity = Capacity(self.log)
+        assert capacity(0) == 0
+        assert capacity(99) == 0
+        assert capacity(100) == 8
+        assert capacity(150) == 8
+        assert capacity(1000) == 4
+
+    def test_integral(self):
+        capacity = Capacity(self.log)
+        assert capacity.integral(100) == 0
+        assert capacity.integral(150) == 400
+        assert capacity.integral(300) == 800 + 400
+
+    def test_constant(self):
+        capacity = Capacity(self.log, cores=10)
+        assert capacity(150) == 10
+        assert capacity.integral(10) == 100
+
+
+def history():
+    db = sqlite3.connect(':memory:')
+    db.execute("create table workflows(id integer primary key, label text)")
+    db.execute("""create table tasks(
+        id integer primary key, workflow int, type int, status int, units int,
+        time_on_worker int, time_stage_in_end int, time_epilogue_end int,
+        bytes_bare_output int, bytes_output int)""")
+    return db
+
+
+class TestWorkload(unittest.TestCase):
+
+    def setUp(self):
+        self.db = history()
+        self.db.execute("insert into workflows values (1, 'test')")
+        self.db.executemany("insert into tasks values (?, 1, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            (1, unit.PROCESS, unit.SUCCESSFUL, 10, 120, 10, 110, 1000, 1100),
+            (2, unit.PROCESS, unit.FAILED, 10, 30, 0, 0, 0, 0),
+            (3, unit.PROCESS, unit.ASSIGNED, 10, 0, 0, 0, 0, 0),
+            (4, unit.MERGE, unit.SUCCESSFUL, 2, 50, 5, 45, 2000, 2200),
+        ])
+
+    def test_history(self):
+        workload = Workload(self.db)
+        assert workload.tasksize == {'test': 10}
+        assert workload.failure_rate('test') == 0.5
+        assert workload.failure_rate('test', unit.MERGE) == 0.
+
+    def test_scaling(self):
+        workload = Workload(self.db)
+        for _ in range(20):
+            failed, duration, processing, bare, total = workload.sample('test', 20)
+            if failed:
+                assert duration == 30
+            else:
+                assert (duration, processing, bare, total) == (220, 200, 2000, 2200)
+
+    def test_default(self):
+        workload = Workload(self.db)
+        assert workload.sample('other', 5, default=600) == (False, 600, 600, 0, 0)
+
+
+class TestSimulation(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['LOCALRT'] = ''
+        self.workdir = tempfile.mkdtemp()
+        self.log = os.path.join(self.workdir, 'lobster_stats_all.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def simulate(self, capacity, cores=1, files=20, limit=None):
+        wflow = Workflow('test', None, category=Category('test', cores=cores, runtime=600))
+        config = Config(
+            label='test',
+            workdir=self.workdir,
+            storage=se.StorageConfiguration(output=['file://' + self.workdir]),
+            workflows=[wflow],
+            advanced=AdvancedOptions(proxy=False, dashboard=False, osg_version="3.3")
+        )
+
+        info = DatasetInfo()
+        info.file_based = True
+        info.tasksize = 1
+        info.path = ''
+        for fn in ['/test/{0}.root'.format(i) for i in range(files)]:
+            info.files[fn].lumis = [(-1, -1)]
+        info.total_units = files
+
+        simulation = Simulation(config, Workload(history()), capacity)
+        simulation.store.register_dataset(wflow, info, 600)
+        with simulation.store.db:
+            simulation.store.update_workflow_stats('test')
+        simulation.run(limit)
+        return simulation.report()
+
+    def test_run(self):
+        report = self.simulate(Capacity(cores=4))
+        assert report['tasks'] == 20
+        assert report['units'] == 20
+        assert report['makespan'] == 5 * 600
+        assert report['utilization'] == 1.
+
+    def test_limit(self):
+        # tasks still running do not count as used
+        report = self.simulate(Capacity(cores=4), limit=900)
+        assert report['tasks'] == 4
+        assert report['makespan'] == 600
+        assert report['utilization'] == 1.
+
+    def test_workers_left(self):
+        with open(self.log, 'w') as f:
+            f.write('#timestamp total_cores\n')
+            f.write('0 4\n')
+            f.write('1800000000 0\n')
+        report = self.simulate(Capacity(self.log))
+        assert report['tasks'] == 12
+        assert report['makespan'] == 3 * 600
+
+    def test_too_few_cores(self):
+        report = self.simulate(Capacity(cores=2), cores=4)
+        assert report['tasks'] == 0
@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lobster import se
+from lobster.commands.validate import FAILED, MERGED, SUCCESSFUL, Validate, external_sort, merge_join
+
+
+class TestMergeJoin(unittest.TestCase):
+
+    def test_external_sort(self):
+        items = ['spam/{0}.root'.format(i) for i in range(100, 0, -1)]
+        assert list(external_sort(items, chunksize=7)) == sorted(items)
+        assert list(external_sort(items)) == sorted(items)
+
+    def test_join(self):
+        listing = ['a', 'b', 'd', 'e']
+        expected = [('a', FAILED, 1), ('c', SUCCESSFUL, 2), ('d', SUCCESSFUL, 3), ('d', MERGED, 4)]
+        res = [(fn, present) for fn, kind, task, present in merge_join(listing, expected)]
+        assert res == [('a', True), ('c', False), ('d', True), ('d', True)]
+
+
+class TestValidate(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.workdir, 'spam'))
+        for i in [1, 2, 4]:
+            with open(os.path.join(self.workdir, 'spam', 'out_{0}.root'.format(i)), 'w') as f:
+                f.write('eggs')
+        se.FileSystem.configure([se.Local(self.workdir)], [])
+
+    def tearDown(self):
+        se.FileSystem.configure([], [])
+        shutil.rmtree(self.workdir)
+
+    def test_workflow(self):
+        expected = sorted([
+            ('spam/out_1.root', FAILED, 1),
+            ('spam/out_2.root', MERGED, 2),
+            ('spam/out_3.root', SUCCESSFUL, 3),
+            ('spam/out_4.root', SUCCESSFUL, 4)
+        ])
+        delete = []
+        missing, stats = Validate().process_workflow('spam', iter(expected), False, lambda *fs: delete.extend(fs))
+        assert delete == ['spam/out_1.root', 'spam/out_2.root']
+        assert missing == [3]
+        assert stats == [1, 1, 0]
+
+    def test_cleaning(self):
+        # dependents still cleaning up: failed and merged outputs are
+        # removed, but outputs not found are not missing
+        expected = sorted([
+            ('spam/out_1.root', FAILED, 1),
+            ('spam/out_2.root', MERGED, 2),
+            ('spam/out_3.root', SUCCESSFUL, 3),
+            ('spam/out_4.root', SUCCESSFUL, 4)
+        ])
+        delete = []
+        missing, stats = Validate().process_workflow('spam', iter(expected), False, lambda *fs: delete.extend(fs), False)
+        assert delete == ['spam/out_1.root', 'spam/out_2.root']
+        assert missing == []
+        assert stats == [1, 1, 0]
+
+    def test_cleaned(self):
+        delete = []
+        missing, stats = Validate().process_workflow('spam', None, True, lambda *fs: delete.append(sorted(fs)))
+        assert delete == [['spam/out_1.root', 'spam/out_2.root', 'spam/out_4.root']]
+        assert stats == [0, 0, 3]
+
+    def test_batches(self):
+        validate = Validate()
+        validate.batch = 2
+        delete = []
+        missing, stats = validate.process_workflow('spam', None, True, lambda *fs: delete.append(len(fs)))
+        assert delete == [2, 1]
+
+        missing, stats = validate.process_workflow('spam', None, True)
+        assert stats == [0, 0, 3]
+        assert len(os.listdir(os.path.join(self.workdir, 'spam'))) == 3